@@ -0,0 +1,119 @@
+import eventlet
+import time
+
+from modal_profiles import active_profile, configured_profiles
+
+# One-shot state of every Modal account for the dashboard.
+#
+# For each profile in ~/.modal.toml with tokens (the same list the AppRegistry
+# polls) the overview gathers the wallet balance,
+# the running apps (from the AppRegistry) and when usage was last synced.
+# Every (profile, source) pair is fetched concurrently and waited on only up
+# to its source's timeout. A source that is
+# still running is reported as 'timeout' with its last known value; the fetch
+# keeps going in the background and later requests join it instead of starting
+# another, so a slow account never holds the others back.
+
+SOURCE_TIMEOUTS = {
+    'wallet': 2,
+    'apps': 8
+}
+
+
+class AccountOverview:
+    def __init__(self, list_running_apps, load_wallet, timeouts=None):
+        """
+        Args:
+            list_running_apps: Called as (profile) and returns its running apps.
+            load_wallet: Called as (account_name) and returns the wallet dict.
+            timeouts: { source: seconds } overriding SOURCE_TIMEOUTS.
+        """
+        self.list_running_apps = list_running_apps
+        self.load_wallet = load_wallet
+        self.timeouts = dict(SOURCE_TIMEOUTS, **(timeouts or {}))
+        self.inflight = {} # { (profile, source): GreenThread }
+        self.last = {}     # { (profile, source): { 'value', 'at' } }
+
+    # --- SOURCES ---
+
+    def _wallet(self, profile):
+        wallet = self.load_wallet(profile)
+        return {
+            'balance': wallet.get('balance'),
+            'last_synced_at': wallet.get('last_synced_at'),
+            'last_signal_time': wallet.get('last_signal_time')
+        }
+
+    def _apps(self, profile):
+        return self.list_running_apps(profile)
+
+    def _start(self, profile, source):
+        key = (profile, source)
+        if key in self.inflight:
+            return self.inflight[key]
+        fn = self._wallet if source == 'wallet' else self._apps
+
+        def run():
+            try:
+                value = fn(profile)
+                self.last[key] = {'value': value, 'at': time.time()}
+                return {'status': 'ok', 'value': value}
+            except Exception as e:
+                print(f"AccountOverview: {source} for {profile} failed: {e}")
+                return {'status': 'error', 'error': str(e)}
+            finally:
+                self.inflight.pop(key, None)
+
+        self.inflight[key] = eventlet.spawn(run)
+        return self.inflight[key]
+
+    # --- OVERVIEW ---
+
+    def collect(self, profiles=None):
+        """
+        { 'accounts': [ { 'profile', 'active', 'balance', 'last_synced_at',
+                          'running_apps', 'sources': { source: { 'status', 'error'?, 'as_of'? } } } ],
+          'active_profile', 'partial', 'duration_sec' }
+        """
+        started = time.time()
+        profiles = profiles or configured_profiles()
+        jobs = {(p, source): self._start(p, source) for p in profiles for source in self.timeouts}
+
+        results = {}
+        for (profile, source), job in jobs.items():
+            remaining = started + self.timeouts[source] - time.time()
+            result = None
+            if remaining > 0:
+                with eventlet.Timeout(remaining, False):
+                    result = job.wait()
+            elif job.dead:
+                result = job.wait()
+            if result is None:
+                last = self.last.get((profile, source))
+                result = {'status': 'timeout', 'value': last['value'] if last else None}
+            if result['status'] != 'ok' and (profile, source) in self.last:
+                result = dict(result, value=self.last[(profile, source)]['value'],
+                              as_of=self.last[(profile, source)]['at'])
+            results[(profile, source)] = result
+
+        active = active_profile()
+        accounts = []
+        for profile in profiles:
+            wallet = results[(profile, 'wallet')].get('value') or {}
+            apps = results[(profile, 'apps')].get('value')
+            accounts.append({
+                'profile': profile,
+                'active': profile == active,
+                'balance': wallet.get('balance'),
+                'last_synced_at': wallet.get('last_synced_at'),
+                'running_apps': apps,
+                'sources': {source: {k: v for k, v in results[(profile, source)].items() if k != 'value'}
+                            for source in self.timeouts}
+            })
+
+        return {
+            'accounts': accounts,
+            'active_profile': active,
+            'partial': any(r['status'] != 'ok' for r in results.values()),
+            'duration_sec': round(time.time() - started, 3)
+        }
@@ -9,8 +9,9 @@ import sys
 import subprocess
 import atexit
 import functools
-from flask import Flask, render_template, request, jsonify
-from flask_socketio import SocketIO, emit
+import time
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from flask_socketio import SocketIO, emit, join_room, leave_room
 import socketio as sio_client
 import requests
 import shutil
@@ -18,6 +19,23 @@ import json
 import re
 from dotenv import load_dotenv
 from internal_worker import InternalWorker
+from cluster import Cluster
+import placement
+from job_store import JobStore
+from modal_gateway import ModalGateway, ModalGatewayError, NotFound
+from modal_profiles import UnknownProfile, active_profile, check_profile
+from volume_cache import VolumeCache
+from volume_index import VolumeIndex
+from volume_usage import VolumeUsage
+import volume_batch
+import usage_sync
+from app_watcher import AppReadinessWatcher
+from log_tailer import LogTailer, resolve_profile, stream_key
+from launcher import Launcher, LaunchError
+from account_overview import AccountOverview
+from app_registry import AppRegistry
+from usage_scheduler import UsageSyncScheduler, balance_room
+from volume_transfer import TransferTracker, UploadManager, TransferError, parse_range
 
 load_dotenv()
 
@@ -30,8 +48,14 @@ logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'secret!')
+
+# Cluster mode: set HOST_MESSAGE_QUEUE=redis://... to run several host processes
+# that share Socket.IO traffic and worker state. Unset = single process.
+cluster = Cluster(os.getenv('HOST_MESSAGE_QUEUE'))
+
 # Disable default logger in SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', logger=False, engineio_logger=False)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet', logger=False, engineio_logger=False,
+                    message_queue=cluster.message_queue)
 
 # GPU Rates for Heartbeat
 GPU_RATES = {
@@ -49,6 +73,114 @@ local_worker_id = 'local-internal'
 # Format: { worker_id: { 'client': socketio.Client(), 'url': str, 'status': str, 'sessions': {}, 'closed_sessions': set() } }
 workers = {}
 
+# Handlers that can be forwarded to the process owning a worker (see routed_to_owner)
+routed_handlers = {}
+
+# Long-lived Modal client (SDK, or fake backend for offline use)
+modal_gateway = ModalGateway.from_env()
+volume_cache = VolumeCache(modal_gateway)
+transfers = TransferTracker()
+uploads = UploadManager(modal_gateway, transfers, spool_dir=os.getenv('UPLOAD_SPOOL_DIR'))
+volume_batches = volume_batch.VolumeBatch(modal_gateway, int(os.getenv('VOLUME_BATCH_CONCURRENCY', volume_batch.BATCH_CONCURRENCY)))
+volume_index = VolumeIndex(modal_gateway, os.getenv('VOLUME_INDEX_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'volume_index.db')))
+volume_usage = VolumeUsage(volume_index, modal_gateway)
+
+# Volume that restore_model downloaders write into (see downloader_base.py)
+DOWNLOADER_VOLUME = 'jekverse-comfy-models'
+DOWNLOADER_RUN = re.compile(r'modal\s+run\s+\S*restore_model/')
+
+# One shared `modal app logs` stream per app, fanned out to browsers (room app-logs:<id>)
+# and to the readiness watcher, which pushes app_ready when the marker shows up
+MODAL_BIN = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
+def app_logs_room(app_id, profile):
+    return f'app-logs:{stream_key(app_id, profile)}'
+
+log_tailer = LogTailer(
+    MODAL_BIN,
+    on_line=lambda app_id, profile, entry: socketio.emit(
+        'app_log', {'app_id': app_id, 'profile': profile, **entry}, to=app_logs_room(app_id, profile)),
+    on_end=lambda app_id, profile, reason: socketio.emit(
+        'app_logs_ended', {'app_id': app_id, 'profile': profile, 'reason': reason}, to=app_logs_room(app_id, profile)),
+    cluster=cluster
+)
+app_watcher = AppReadinessWatcher(socketio.emit, log_tailer, cluster)
+
+def on_launch_ready(launch):
+    app_watcher.report_ready(launch['app_id'], launch['gpu'], launch['phases']['building'], launch['phases']['ready'],
+                             profile=launch['profile'])
+
+def on_launch_finished(launch):
+    if launch['file'].startswith('restore_model/'):
+        volume_cache.invalidate_volume(DOWNLOADER_VOLUME, profile=launch['profile'])
+        volume_index.mark_stale(DOWNLOADER_VOLUME, launch['profile'])
+
+def emit_launch_update(event, data):
+    socketio.emit(event, data)
+    if data.get('app_id'):
+        app_registry.poke() # The app appeared or changed state; don't wait for the next poll
+
+# Queue of `modal run --detach` launches (see launcher.py)
+launcher = Launcher(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modal-app-manager', 'images'),
+    MODAL_BIN,
+    emit_launch_update,
+    parallelism=int(os.getenv('LAUNCH_PARALLELISM', 2)),
+    on_ready=on_launch_ready,
+    on_finish=on_launch_finished
+)
+APP_STOP = re.compile(r'modal\s+app\s+stop\s+(\S+)')
+
+# Apps of every profile, polled by one process and pushed to browsers as apps_delta
+app_registry = AppRegistry(MODAL_BIN, socketio.emit, cluster, interval=int(os.getenv('APP_POLL_INTERVAL', 10)))
+
+# Balance, running apps and last sync of every profile in one call (see account_overview.py)
+account_overview = AccountOverview(app_registry.running, lambda account: local_worker.load_wallet(account))
+
+# Usage syncs of every account, run by one process and pushed as balance_updated (created with local_worker)
+usage_scheduler = None
+
+# Exec job history
+job_store = JobStore(os.getenv('JOB_STORE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.db')))
+pending_jobs = {} # { (worker_id, request_id): [ { 'command', 'cwd', 'profile', 'started_at' }, ... ] }
+
+def track_exec_start(worker_id, request_id, command, cwd, profile=None):
+    pending_jobs.setdefault((worker_id, request_id), []).append(
+        {'command': command, 'cwd': cwd, 'profile': profile, 'started_at': time.time()})
+
+def track_exec_result(worker_id, data):
+    """Record an exec_result in the job store if it answers a tracked exec_command."""
+    key = (worker_id, data.get('id'))
+    pending = pending_jobs.get(key)
+    if not pending:
+        return # e.g. get_balance / sync_usage replies share the exec_result event
+    job = pending.pop(0)
+    if not pending:
+        del pending_jobs[key]
+    if DOWNLOADER_RUN.search(job['command']):
+        volume_cache.invalidate_volume(DOWNLOADER_VOLUME, profile=job['profile'])
+        volume_index.mark_stale(DOWNLOADER_VOLUME, job['profile'])
+    stopped = APP_STOP.search(job['command'])
+    if stopped:
+        app_registry.poke() # The CLI may report errors for stops that did go through
+    if stopped and data.get('returncode') == 0:
+        app_watcher.unwatch(stopped.group(1), profile=job['profile'])
+        app_watcher.forget(stopped.group(1), profile=job['profile'])
+        launcher.app_stopped(stopped.group(1))
+    try:
+        job_store.record(job['command'], worker_id, data.get('id'), job['started_at'], data, cwd=job['cwd'])
+    except Exception as e:
+        print(f"Failed to record job: {e}")
+
+def fail_pending_jobs(worker_id, reason):
+    """Record every job still in flight on a worker as failed (its exec_result will not arrive)."""
+    for key in [k for k in pending_jobs if k[0] == worker_id]:
+        for job in pending_jobs.pop(key):
+            try:
+                job_store.record(job['command'], worker_id, key[1], job['started_at'],
+                                 {'error': reason, 'returncode': -1}, cwd=job['cwd'])
+            except Exception as e:
+                print(f"Failed to record job: {e}")
+
 # --- CLOUDFLARE TUNNEL ---
 tunnel_process = None
 
@@ -62,6 +194,7 @@ def cleanup_tunnel():
         except subprocess.TimeoutExpired:
             tunnel_process.kill()
         print("Cloudflare Tunnel stopped.")
+        tunnel_process = None
 
 def start_tunnel():
     global tunnel_process
@@ -80,6 +213,26 @@ def start_tunnel():
     except Exception as e:
         print(f"Failed to start Cloudflare Tunnel: {e}")
 
+def tunnel_lease_loop():
+    """Run the tunnel while this process holds the 'tunnel' lease (re-claimed every few seconds)."""
+    if not os.getenv('APP_CLOUDFLARED_TOKEN'):
+        print("Warning: APP_CLOUDFLARED_TOKEN not set in environment.")
+        return
+    while True:
+        if cluster.claim('tunnel'):
+            if tunnel_process is None or tunnel_process.poll() is not None:
+                start_tunnel()
+        elif tunnel_process is not None and tunnel_process.poll() is None:
+            print("Lost the tunnel lease; stopping the local tunnel")
+            cleanup_tunnel()
+        socketio.sleep(5)
+
+def reset_session_seq(session_state, incarnation):
+    """A recreated session (new incarnation, e.g. after a worker restart) numbers its output from 1 again."""
+    if incarnation and incarnation != session_state.get('incarnation'):
+        session_state['incarnation'] = incarnation
+        session_state['seq'] = 0
+
 def on_worker_output(worker_id, data):
     """Callback for when a worker sends output."""
     output = data.get('output')
@@ -101,8 +254,18 @@ def on_worker_output(worker_id, data):
         
         if target_session not in workers[worker_id]['sessions']:
              workers[worker_id]['sessions'][target_session] = {'logs': []}
+
+        # Remote workers number their output; drop chunks a resume replayed twice
+        seq = data.get('seq')
+        session_state = workers[worker_id]['sessions'][target_session]
+        reset_session_seq(session_state, data.get('incarnation'))
+        if seq is not None:
+            if seq <= session_state.get('seq', 0):
+                return
+            session_state['seq'] = seq
              
         workers[worker_id]['sessions'][target_session]['logs'].append(output)
+        cluster.append_log(worker_id, target_session, output)
         
     # Forward to UI with worker_id so UI knows which terminal to update
     socketio.emit('term_output', {'worker_id': worker_id, 'session_id': session_id, 'output': output})
@@ -112,14 +275,91 @@ def on_worker_connect(worker_id):
     # print(f"Worker {worker_id} connected")
     if worker_id in workers:
         workers[worker_id]['status'] = 'connected'
+        publish_worker(worker_id)
         socketio.emit('worker_status', {'worker_id': worker_id, 'status': 'connected'})
 
+        # Ask the worker to replay whatever we missed while the link was down
+        client = workers[worker_id].get('client')
+        if client:
+            known = workers[worker_id].get('sessions', {})
+            acks = {sid: s.get('seq', 0) for sid, s in known.items()}
+            incarnations = {sid: s.get('incarnation') for sid, s in known.items()}
+            client.emit('resume_sessions', {'acks': acks, 'incarnations': incarnations})
+
 def on_worker_disconnect(worker_id):
     """Callback for when a worker disconnects."""
     # print(f"Worker {worker_id} disconnected")
     if worker_id in workers:
         workers[worker_id]['status'] = 'disconnected'
+        publish_worker(worker_id)
         socketio.emit('worker_status', {'worker_id': worker_id, 'status': 'disconnected'})
+    fail_pending_jobs(worker_id, 'Worker disconnected')
+
+def publish_worker(worker_id):
+    """Mirror a locally owned worker's metadata into the cluster registry."""
+    w = workers.get(worker_id)
+    if not w:
+        return
+    cluster.publish_worker(worker_id, {
+        'type': w.get('type', 'remote'),
+        'url': w['url'],
+        'name': w.get('name', w['url']),
+        'token': w.get('token') or '',
+        'status': w['status'],
+        'sessions': list(w.get('sessions', {}).keys()),
+        'stats': w.get('stats', {})
+    })
+
+STATS_INTERVAL = 10 # seconds between worker load samples
+
+def poll_worker_stats():
+    """Sample load (sessions, CPU, RSS) and RTT of every owned worker for session placement."""
+    while True:
+        for worker_id, w in list(workers.items()):
+            if w['status'] != 'connected':
+                continue
+            try:
+                if w.get('type') == 'internal':
+                    stats = local_worker.get_stats()
+                    stats['rtt_ms'] = 0
+                else:
+                    started = time.time()
+                    stats = w['client'].call('get_stats', {}, timeout=5)
+                    stats['rtt_ms'] = round((time.time() - started) * 1000, 1)
+                w['stats'] = stats
+                publish_worker(worker_id)
+            except Exception as e:
+                # Older workers don't answer get_stats; they just rank as unknown load
+                w['stats'] = {}
+        socketio.sleep(STATS_INTERVAL)
+
+def routed_to_owner(f):
+    """
+    Socket handler decorator: if the target worker link is held by another host
+    process, forward the event there instead of handling it here.
+    """
+    routed_handlers[f.__name__] = f
+
+    @functools.wraps(f)
+    def wrapper(data):
+        worker_id = data.get('worker_id')
+        if not worker_id:
+            emit('request_error', {'event': f.__name__, 'id': data.get('id'), 'error': 'worker_id required'})
+            return
+        if worker_id not in workers and cluster.forward(worker_id, f.__name__, data, request.sid):
+            return
+        return f(data)
+    return wrapper
+
+def dispatch_forwarded(handler_name, data, sid):
+    """Run a handler forwarded by another process, replying to the original client."""
+    handler = routed_handlers.get(handler_name)
+    if not handler:
+        return
+    with app.test_request_context('/'):
+        request.sid = sid
+        request.namespace = '/'
+        handler(data)
 
 
 import datetime
@@ -199,11 +439,21 @@ def allowed_file(filename):
 # Ensure upload dir exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-# Rate Limiting (In-Memory)
-login_attempts = {}
+# Rate Limiting (shared across host processes via the cluster store)
 MAX_ATTEMPTS = 3
 BLOCK_DURATION = datetime.timedelta(minutes=5)
 
+def get_login_attempts(ip):
+    record = cluster.get_json(f'login:{ip}')
+    if record and record['block_until']:
+        record['block_until'] = datetime.datetime.fromtimestamp(record['block_until'])
+    return record
+
+def save_login_attempts(ip, record):
+    block_until = record['block_until'].timestamp() if record['block_until'] else None
+    cluster.set_json(f'login:{ip}', {'count': record['count'], 'block_until': block_until},
+                     ttl=int(BLOCK_DURATION.total_seconds()) * 2)
+
 @app.before_request
 @app.before_request
 def require_login():
@@ -238,8 +488,8 @@ def login():
         now = datetime.datetime.now()
         
         # Check Rate Limit
-        if ip in login_attempts:
-            record = login_attempts[ip]
+        record = get_login_attempts(ip)
+        if record:
             if record['block_until'] and now < record['block_until']:
                 remaining = (record['block_until'] - now).seconds
                 return render_template('login.html', error=f"Too many attempts. Try again in {remaining}s.")
@@ -262,21 +512,22 @@ def login():
             # Success
             session['authenticated'] = True
             session.permanent = True
-            if ip in login_attempts:
-                del login_attempts[ip]
+            cluster.delete_json(f'login:{ip}')
             return redirect(url_for('index'))
         else:
             # Failure
-            if ip not in login_attempts:
-                login_attempts[ip] = {'count': 0, 'block_until': None}
+            if not record:
+                record = {'count': 0, 'block_until': None}
             
-            login_attempts[ip]['count'] += 1
+            record['count'] += 1
             
-            if login_attempts[ip]['count'] >= MAX_ATTEMPTS:
-                login_attempts[ip]['block_until'] = now + BLOCK_DURATION
+            if record['count'] >= MAX_ATTEMPTS:
+                record['block_until'] = now + BLOCK_DURATION
+                save_login_attempts(ip, record)
                 return render_template('login.html', error="Too many attempts. blocked for 5 minutes.")
             
-            remaining = MAX_ATTEMPTS - login_attempts[ip]['count']
+            save_login_attempts(ip, record)
+            remaining = MAX_ATTEMPTS - record['count']
             return render_template('login.html', error=f"Invalid credentials. {remaining} attempts remaining.")
 
     return render_template('login.html')
@@ -637,14 +888,169 @@ def index():
     work_dir = os.path.join(host_dir, 'modal-app-manager', 'images')
     wallet_dir = os.path.join(host_dir, 'modal-credit-tracker')
     
-    # Find modal binary (check PATH, fallback to default locations)
-    modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-    
     return render_template('index.html', 
                          work_dir=work_dir, 
-                         modal_bin=modal_bin,
+                         modal_bin=MODAL_BIN,
                          wallet_dir=wallet_dir)
 
+@app.route('/api/workers/stats')
+def get_worker_stats():
+    """Latest load and output-journal metrics per worker (sampled by poll_worker_stats)."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({wid: {'name': meta['name'], 'status': meta['status'], 'stats': meta.get('stats', {})}
+                    for wid, meta in cluster.list_workers().items()})
+
+@app.route('/api/exec/cache')
+def get_exec_cache_stats():
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    if not local_worker:
+        return jsonify({'error': 'Local Worker Not Initialized'}), 500
+    return jsonify(local_worker.exec_cache.get_stats())
+
+@app.route('/api/jobs')
+def get_jobs():
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    try:
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, 500)
+    jobs = job_store.recent(limit, family=request.args.get('family'), worker_id=request.args.get('worker_id'))
+    return jsonify({'jobs': jobs})
+
+@app.route('/api/jobs/latency')
+def get_job_latency():
+    """Duration percentiles per command family, e.g. ?since_hours=24"""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    since_hours = request.args.get('since_hours')
+    try:
+        since = time.time() - float(since_hours) * 3600 if since_hours else None
+    except ValueError:
+        return jsonify({'error': 'since_hours must be a number'}), 400
+    include_cached = request.args.get('include_cached') == '1'
+    return jsonify({'families': job_store.latency_stats(since, include_cached=include_cached)})
+
+@app.route('/api/apps/readiness')
+def get_app_readiness_stats():
+    """Time-to-ready histograms per GPU type and apps currently being watched."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(app_watcher.get_stats())
+
+@app.route('/api/launches', methods=['GET', 'POST'])
+def launches():
+    """
+    POST { file, app_name?, gpu?, timeout?, region?, disk?, profile? } queues a `modal run --detach`.
+    GET lists recent launches with their state and per-phase timings.
+    """
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    if request.method == 'GET':
+        return jsonify({'launches': launcher.list(), **launcher.get_stats()})
+    try:
+        return jsonify(launcher.submit(request.json or {}))
+    except LaunchError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/launches/<launch_id>')
+def get_launch(launch_id):
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    launch = launcher.get(launch_id)
+    if not launch:
+        return jsonify({'error': 'Launch not found'}), 404
+    return jsonify(launch)
+
+@app.route('/api/launches/<launch_id>/cancel', methods=['POST'])
+def cancel_launch(launch_id):
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    if not launcher.cancel(launch_id):
+        return jsonify({'error': 'Launch is not queued or building'}), 409
+    return jsonify({'status': 'success'})
+
+@app.route('/api/apps')
+def list_apps():
+    """
+    Apps of a profile (default: the active one) from the host's registry, with
+    the registry version. Changes are pushed afterwards as apps_delta.
+    ?refresh=1 waits (briefly) for a fresh poll first.
+    """
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    profile = check_profile(request.args.get('profile')) or active_profile()
+    if request.args.get('refresh') == '1':
+        app_registry.wait_for_poll(timeout=15)
+    return jsonify(app_registry.list(profile))
+
+@app.route('/api/apps/registry')
+def get_app_registry_stats():
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(app_registry.get_stats())
+
+@app.route('/api/usage/scheduler')
+def get_usage_scheduler_stats():
+    """Per-account sync cadence and last result of the background usage sync."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(usage_scheduler.get_stats() if usage_scheduler else {})
+
+@app.route('/api/accounts/overview')
+def get_accounts_overview():
+    """
+    Balance, running apps and last usage sync for every Modal profile (or
+    ?profiles=a,b). Sources are fetched concurrently; slow ones come back as
+    'timeout' with their last known value and `partial` is set.
+    """
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    profiles = [check_profile(p) for p in request.args.get('profiles', '').split(',') if p]
+    return jsonify(account_overview.collect(profiles or None))
+
+@app.route('/api/apps/logs/tails')
+def get_log_tails():
+    """Upstream log streams currently open, with subscriber counts."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(log_tailer.get_stats())
+
+@app.route('/api/placement/log')
+def get_placement_log():
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'decisions': list(placement.placement_log), 'policies': list(placement.PLACEMENT_POLICIES)})
+
+@app.route('/api/wallets/<account_name>/ledger')
+def get_wallet_ledger(account_name):
+    """
+    Balance-changing events of a wallet, newest first (?limit=, ?before=<id> to page),
+    plus its snapshots. ?at=<unix ts> adds the balance as of that time.
+    """
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    wallets = local_worker.wallets
+    result = {
+        'account': account_name,
+        'balance': wallets.balance(account_name),
+        'events': wallets.ledger(account_name, limit=min(int(request.args.get('limit', 100)), 1000),
+                                 before_id=request.args.get('before', type=int)),
+        'snapshots': wallets.snapshots(account_name)
+    }
+    if request.args.get('at'):
+        result['balance_at'] = wallets.balance_at(account_name, float(request.args['at']))
+    return jsonify(result)
+
+@app.route('/api/wallets/<account_name>/topup', methods=['POST'])
+def topup_wallet(account_name):
+    """POST { "amount": 10 } adds credit; { "reset": true, "balance"?: 80 } sets it. Both are ledger events."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    data = request.get_json(silent=True) or {}
+    wallets = local_worker.wallets
+    try:
+        with wallets.transaction():
+            if data.get('reset'):
+                balance = wallets.reset(account_name, None if data.get('balance') is None else float(data['balance']))
+            else:
+                amount = float(data.get('amount', 0))
+                if amount <= 0:
+                    return jsonify({'error': 'amount must be positive'}), 400
+                balance = wallets.topup(account_name, amount)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'amount and balance must be numbers'}), 400
+    return jsonify({'status': 'success', 'account': account_name, 'balance': round(balance, 4)})
+
 @app.route('/heartbeat', methods=['POST'])
 def proxy_heartbeat():
     # Handle heartbeat directly using InternalWorker logic
@@ -671,13 +1077,15 @@ def proxy_heartbeat():
 
     # Process via Internal Worker
     resp_data, status_code = local_worker.process_heartbeat_logic(account_name, gpu_type, GPU_RATES, session_id)
+    if status_code == 200 and usage_scheduler:
+        usage_scheduler.publish(account_name)
     return jsonify(resp_data), status_code
 
 @app.route('/sync-usage', methods=['POST'])
 def sync_usage_endpoint():
     """
     Sync usage data from Modal Volume (new simplified approach).
-    POST { "account_name": "xxx", "volume_name": "xxx" }
+    POST { "account_name": "xxx", "volume_name": "xxx", "profile": "xxx" (optional) }
     """
     import flask
     if 'authenticated' not in flask.session:
@@ -685,142 +1093,18 @@ def sync_usage_endpoint():
         
     data = request.get_json(silent=True) or {}
     account_name = data.get('account_name')
-    volume_name = data.get('volume_name', 'jekverse-comfy-models')
+    volume_name = data.get('volume_name', usage_sync.DEFAULT_VOLUME)
     
     if not account_name:
         return jsonify({"error": "account_name required"}), 400
     
-    # Sync directly (synchronous version)
-    import subprocess
-    import tempfile
-    import shutil
-    
+    profile = check_profile(data.get('profile'))
     try:
-        modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-        remote_path = f"usage/{account_name}.json"
-        
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as tmp:
-            tmp_path = tmp.name
-        
-        # Download from volume (use --force to overwrite temp file if exists)
-        cmd = [modal_bin, 'volume', 'get', '--force', volume_name, remote_path, tmp_path]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            return jsonify({
-                "synced": False,
-                "message": "No usage data found (VM may not have run yet)",
-                "details": result.stderr
-            }), 200
-        
-        # Parse usage data
-        import json as json_module
-        with open(tmp_path, 'r') as f:
-            usage_data = json_module.load(f)
-        os.unlink(tmp_path)
-        
-        # Load wallet
-        wallet_file = os.path.join(os.path.dirname(__file__), 'modal-credit-tracker', f'wallet_{account_name}.json')
-        if os.path.exists(wallet_file):
-            with open(wallet_file, 'r') as f:
-                wallet = json_module.load(f)
-        else:
-            wallet = {"account": account_name, "balance": 80.0, "history": [], "synced_sessions": []}
-        
-        if 'synced_sessions' not in wallet:
-            wallet['synced_sessions'] = []
-        if 'history' not in wallet:
-            wallet['history'] = []
-        
-        # Process sessions
-        new_cost = 0
-        new_sessions = 0
-        
-        for session in usage_data.get('sessions', []):
-            session_id = session.get('session_id')
-            status = session.get('status', 'unknown')
-            cost = session.get('cost', 0)
-            
-            if status == 'completed':
-                if session_id in wallet['synced_sessions']:
-                    continue
-                
-                # BUGFIX: Remove old "running" entry if exists to prevent duplicates
-                running_idx = None
-                for i, h in enumerate(wallet.get('history', [])):
-                    if h.get('session_id') == session_id and h.get('status') == 'running':
-                        running_idx = i
-                        break
-                
-                if running_idx is not None:
-                    # Remove running entry and only count the cost difference
-                    old_cost = wallet['history'][running_idx].get('cost', 0)
-                    cost_diff = cost - old_cost
-                    new_cost += cost_diff if cost_diff > 0 else 0
-                    # Remove the old running entry
-                    wallet['history'].pop(running_idx)
-                else:
-                    # No previous running entry, count full cost
-                    new_cost += cost
-                
-                new_sessions += 1
-                wallet['history'].append({
-                    'session_id': session_id,
-                    'gpu_type': session.get('gpu_type', 'Unknown'),
-                    'start_time': session.get('start_time'),
-                    'end_time': session.get('end_time'),
-                    'duration_sec': session.get('duration_sec', 0),
-                    'cost': cost,
-                    'status': 'completed'
-                })
-                wallet['synced_sessions'].append(session_id)
-                
-            elif status == 'running':
-                # Find or create running entry
-                existing_idx = None
-                for i, h in enumerate(wallet['history']):
-                    if h.get('session_id') == session_id and h.get('status') == 'running':
-                        existing_idx = i
-                        break
-                
-                if existing_idx is not None:
-                    old_cost = wallet['history'][existing_idx].get('cost', 0)
-                    cost_diff = cost - old_cost
-                    if cost_diff > 0:
-                        new_cost += cost_diff
-                        wallet['history'][existing_idx].update({
-                            'end_time': session.get('end_time'),
-                            'duration_sec': session.get('duration_sec', 0),
-                            'cost': cost
-                        })
-                else:
-                    new_cost += cost
-                    new_sessions += 1
-                    wallet['history'].append({
-                        'session_id': session_id,
-                        'gpu_type': session.get('gpu_type', 'Unknown'),
-                        'start_time': session.get('start_time'),
-                        'end_time': session.get('end_time'),
-                        'duration_sec': session.get('duration_sec', 0),
-                        'cost': cost,
-                        'status': 'running'
-                    })
-        
-        # Update balance
-        wallet['balance'] = max(0, wallet['balance'] - new_cost)
-        
-        # Save wallet
-        os.makedirs(os.path.dirname(wallet_file), exist_ok=True)
-        with open(wallet_file, 'w') as f:
-            json_module.dump(wallet, f, indent=4)
-        
-        return jsonify({
-            "synced": True,
-            "new_sessions": new_sessions,
-            "cost_deducted": round(new_cost, 6),
-            "new_balance": round(wallet['balance'], 4),
-            "total_sessions": len(usage_data.get('sessions', []))
-        }), 200
+        result = usage_sync.sync_account(modal_gateway, local_worker.wallets, account_name, volume_name,
+                                         profile=profile)
+        if result.get('synced') and not result.get('unchanged') and usage_scheduler:
+            usage_scheduler.publish(account_name, result)
+        return jsonify(result), 200
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -849,7 +1133,21 @@ def handle_connect():
             'sessions': sessions_data # Send all sessions
         })
 
+    # Workers whose links are held by other host processes
+    for wid, meta in cluster.list_workers().items():
+        if wid in workers:
+            continue
+        emit('worker_added', {
+            'worker_id': wid,
+            'url': meta['url'],
+            'name': meta['name'],
+            'token': meta['token'],
+            'status': meta['status'],
+            'sessions': {sid: {'logs': cluster.get_logs(wid, sid)} for sid in meta['sessions']}
+        })
+
 @socketio.on('remove_worker')
+@routed_to_owner
 def handle_remove_worker(data):
     worker_id = data.get('worker_id')
     if worker_id in workers:
@@ -860,32 +1158,41 @@ def handle_remove_worker(data):
         except:
             pass
         del workers[worker_id]
+        cluster.unpublish_worker(worker_id)
+        fail_pending_jobs(worker_id, 'Worker removed')
         emit('worker_removed', {'worker_id': worker_id})
 
 # --- Modal Volume API ---
+# Every route takes an optional `profile` (query string or JSON body). It selects
+# the account per request; without it the active profile is used.
+def request_profile():
+    data = request.get_json(silent=True) if request.is_json else None
+    return check_profile((data or {}).get('profile') or request.args.get('profile'))
+
+@app.errorhandler(UnknownProfile)
+def handle_unknown_profile(e):
+    return jsonify({'error': str(e)}), 400
+
 @app.route('/api/modal/volumes')
 def get_modal_volumes():
     if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
     
+    profile = request_profile()
     try:
-        # Use full path to modal if known, or rely on PATH
-        modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-        
-        # Run: modal volume list --json
-        cmd = [modal_bin, 'volume', 'list', '--json']
-        
-        # Execute
-        result = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        volumes = json.loads(result)
-        
-        return jsonify({'volumes': volumes})
-    except subprocess.CalledProcessError as e:
-        print(f"Error fetching volumes: {e.output.decode()}")
-        return jsonify({'error': 'Failed to fetch volumes', 'details': e.output.decode()}), 500
+        volumes = volume_cache.list_volumes(profile=profile, force=request.args.get('refresh') == '1')
+        return jsonify({'volumes': [v.to_cli_json() for v in volumes]})
+    except ModalGatewayError as e:
+        print(f"Error fetching volumes: {e}")
+        return jsonify({'error': 'Failed to fetch volumes', 'details': str(e)}), 500
     except Exception as e:
-        print(f"Error executing modal command: {e}")
+        print(f"Error calling modal gateway: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/modal/volumes/cache')
+def get_volume_cache_stats():
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(volume_cache.get_stats())
+
 @app.route('/api/modal/volume/delete', methods=['POST'])
 def delete_modal_volume():
     if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
@@ -895,30 +1202,20 @@ def delete_modal_volume():
     if not vol_name:
         return jsonify({'error': 'Volume name required'}), 400
 
+    profile = request_profile()
     try:
-        modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-        
-        # Run: modal volume delete <name>
-        # We need to pipe 'y' to confirm deletion
-        cmd = [modal_bin, 'volume', 'delete', vol_name]
-        
-        process = subprocess.Popen(
-            cmd, 
-            stdin=subprocess.PIPE, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        stdout, stderr = process.communicate(input='y\n')
-        
-        if process.returncode != 0:
-            print(f"Error deleting volume: {stderr}")
-            return jsonify({'error': 'Failed to delete volume', 'details': stderr}), 500
-            
-        return jsonify({'status': 'success', 'output': stdout})
-        
+        modal_gateway.delete_volume(vol_name, profile=profile)
+        volume_cache.invalidate_volumes(profile)
+        volume_cache.invalidate_volume(vol_name, profile=profile)
+        volume_index.drop_volume(vol_name, profile)
+        return jsonify({'status': 'success', 'output': f"Deleted volume {vol_name}"})
+    except NotFound as e:
+        return jsonify({'error': 'Volume not found', 'details': str(e)}), 404
+    except ModalGatewayError as e:
+        print(f"Error deleting volume: {e}")
+        return jsonify({'error': 'Failed to delete volume', 'details': str(e)}), 500
     except Exception as e:
-        print(f"Error executing modal delete: {e}")
+        print(f"Error calling modal gateway: {e}")
         return jsonify({'error': str(e)}), 500
 
 # --- Restore Model Script Generation ---
@@ -993,28 +1290,16 @@ def create_modal_volume():
     if not re.match(r'^[a-zA-Z0-9_\-]+$', vol_name):
          return jsonify({'error': 'Invalid volume name. Use only letters, numbers, underscores, and dashes.'}), 400
 
+    profile = request_profile()
     try:
-        modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-        
-        # Run: modal volume create <name>
-        cmd = [modal_bin, 'volume', 'create', vol_name]
-        
-        process = subprocess.Popen(
-            cmd, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        stdout, stderr = process.communicate()
-        
-        if process.returncode != 0:
-            print(f"Error creating volume: {stderr}")
-            return jsonify({'error': 'Failed to create volume', 'details': stderr}), 500
-            
-        return jsonify({'status': 'success', 'output': stdout})
-        
+        modal_gateway.create_volume(vol_name, profile=profile)
+        volume_cache.invalidate_volumes(profile)
+        return jsonify({'status': 'success', 'output': f"Created volume {vol_name}"})
+    except ModalGatewayError as e:
+        print(f"Error creating volume: {e}")
+        return jsonify({'error': 'Failed to create volume', 'details': str(e)}), 500
     except Exception as e:
-        print(f"Error executing modal create: {e}")
+        print(f"Error calling modal gateway: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/modal/volume/files', methods=['POST'])
@@ -1028,22 +1313,17 @@ def get_modal_volume_files():
     if not vol_name:
         return jsonify({'error': 'Volume name required'}), 400
 
+    profile = request_profile()
     try:
-        modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-        
-        # Run: modal volume ls <name> <path> --json
-        cmd = [modal_bin, 'volume', 'ls', vol_name, path, '--json']
-        
-        # Execute
-        result = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        files = json.loads(result)
-        
-        return jsonify({'files': files, 'path': path})
-    except subprocess.CalledProcessError as e:
-        print(f"Error fetching volume files: {e.output.decode()}")
-        return jsonify({'error': 'Failed to fetch files', 'details': e.output.decode()}), 500
+        files = volume_cache.listdir(vol_name, path, profile=profile, force=bool(data.get('refresh')))
+        return jsonify({'files': [f.to_cli_json() for f in files], 'path': path})
+    except NotFound as e:
+        return jsonify({'error': 'Path not found', 'details': str(e)}), 404
+    except ModalGatewayError as e:
+        print(f"Error fetching volume files: {e}")
+        return jsonify({'error': 'Failed to fetch files', 'details': str(e)}), 500
     except Exception as e:
-        print(f"Error executing modal command: {e}")
+        print(f"Error calling modal gateway: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/modal/volume/rm', methods=['POST'])
@@ -1057,32 +1337,227 @@ def remove_modal_volume_file():
     if not vol_name or not path:
         return jsonify({'error': 'Volume name and path required'}), 400
 
+    profile = request_profile()
     try:
-        modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-        
-        # Run: modal volume rm <volume_name> <path>
-        cmd = [modal_bin, 'volume', 'rm', vol_name, path]
-        
-        process = subprocess.Popen(
-            cmd, 
-            stdin=subprocess.PIPE, 
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.PIPE,
-            text=True
+        modal_gateway.remove_file(vol_name, path, recursive=bool(data.get('recursive')), profile=profile)
+        volume_cache.invalidate_volume(vol_name, path, profile=profile)
+        volume_index.remove_path(vol_name, path, profile=profile)
+        return jsonify({'status': 'success', 'output': f"Removed {path}"})
+    except NotFound as e:
+        return jsonify({'error': 'File not found', 'details': str(e)}), 404
+    except ModalGatewayError as e:
+        print(f"Error deleting file: {e}")
+        return jsonify({'error': 'Failed to delete file', 'details': str(e)}), 500
+    except Exception as e:
+        print(f"Error calling modal gateway: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/modal/volume/batch', methods=['POST'])
+def batch_modal_volume_files():
+    """
+    Body: { volume_name, operations: [ { op: rm|mv|cp, path, dst?, recursive? }, ... ] }.
+    Streams one NDJSON line per operation as it completes, then a summary line.
+    """
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.json or {}
+    vol_name = data.get('volume_name')
+    operations = data.get('operations')
+    if not vol_name:
+        return jsonify({'error': 'Volume name required'}), 400
+    profile = request_profile()
+    try:
+        volume_batch.validate(operations)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid operations', 'details': str(e)}), 400
+
+    def generate():
+        touched = False
+        for result in volume_batches.run(vol_name, operations, profile=profile):
+            if result.get('status') == 'ok':
+                touched = True
+                # Sources of rm/mv are gone; mv/cp destinations appear
+                if result['op'] != 'cp':
+                    volume_cache.invalidate_volume(vol_name, result['path'], profile=profile)
+                    volume_index.remove_path(vol_name, result['path'], profile=profile)
+                if result.get('dst'):
+                    volume_cache.invalidate_volume(vol_name, result['dst'], profile=profile)
+            yield json.dumps(result) + '\n'
+        if touched:
+            volume_index.mark_stale(vol_name, profile)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# --- Volume File Transfers ---
+@app.route('/api/modal/volume/download')
+def download_modal_volume_file():
+    """Stream a volume file to the browser. Honours `Range: bytes=...` for resumable downloads."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+
+    vol_name = request.args.get('volume_name')
+    path = request.args.get('path')
+    if not vol_name or not path:
+        return jsonify({'error': 'Volume name and path required'}), 400
+
+    profile = request_profile()
+    try:
+        entry = modal_gateway.stat(vol_name, path, profile=profile)
+        byte_range = parse_range(request.headers.get('Range'), entry.size)
+    except NotFound as e:
+        return jsonify({'error': 'File not found', 'details': str(e)}), 404
+    except TransferError as e:
+        return jsonify({'error': str(e)}), 416, {'Content-Range': f'bytes */{entry.size}'}
+    except ModalGatewayError as e:
+        return jsonify({'error': 'Cannot download path', 'details': str(e)}), 400
+
+    start, end = byte_range or (0, entry.size - 1)
+    length = max(end - start + 1, 0)
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Length': str(length),
+        'Content-Disposition': f'attachment; filename="{os.path.basename(path)}"'
+    }
+    if byte_range:
+        headers['Content-Range'] = f'bytes {start}-{end}/{entry.size}'
+
+    transfer = transfers.begin('download', vol_name, path, total=length)
+
+    def generate():
+        status = 'failed'
+        try:
+            if length:
+                for chunk in modal_gateway.iter_file(vol_name, path, start=start, end=end, profile=profile):
+                    transfers.progress(transfer, len(chunk))
+                    yield chunk
+            status = 'done'
+        except GeneratorExit:
+            status = 'aborted' # Client went away mid-download
+            raise
+        finally:
+            transfers.finish(transfer, status=status)
+
+    return Response(stream_with_context(generate()), status=206 if byte_range else 200,
+                    headers=headers, mimetype='application/octet-stream')
+
+@app.route('/api/modal/volume/upload', methods=['POST'])
+def start_modal_volume_upload():
+    """Body: { volume_name, path, size, part_size? }. Returns { upload_id, part_size, parts }."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.json or {}
+    vol_name = data.get('volume_name')
+    path = data.get('path')
+    if not vol_name or not path or data.get('size') is None:
+        return jsonify({'error': 'Volume name, path and size required'}), 400
+
+    profile = request_profile()
+    try:
+        return jsonify(uploads.start(vol_name, path, data['size'], data.get('part_size'), profile=profile))
+    except (TransferError, TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/modal/volume/upload/<upload_id>/parts/<int:index>', methods=['PUT'])
+def upload_modal_volume_part(upload_id, index):
+    """Raw part bytes in the body. Parts may be sent in parallel and retried."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        return jsonify(uploads.write_part(upload_id, index, request.stream))
+    except TransferError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/modal/volume/upload/<upload_id>/complete', methods=['POST'])
+def complete_modal_volume_upload(upload_id):
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        upload = uploads.uploads.get(upload_id)
+        result = uploads.complete(upload_id)
+        volume_cache.invalidate_volume(upload['volume'], upload['path'], profile=upload['profile'])
+        volume_index.mark_stale(upload['volume'], upload['profile'])
+        return jsonify({'status': 'success', 'transfer': result})
+    except TransferError as e:
+        return jsonify({'error': str(e)}), 400
+    except NotFound as e:
+        return jsonify({'error': 'Volume not found', 'details': str(e)}), 404
+    except Exception as e:
+        print(f"Error uploading to volume: {e}")
+        return jsonify({'error': 'Failed to upload file', 'details': str(e)}), 500
+
+@app.route('/api/modal/volume/upload/<upload_id>', methods=['DELETE'])
+def abort_modal_volume_upload(upload_id):
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    if not uploads.abort(upload_id):
+        return jsonify({'error': f"Unknown upload '{upload_id}'"}), 404
+    return jsonify({'status': 'success'})
+
+@app.route('/api/modal/volume/transfers')
+def list_modal_volume_transfers():
+    """Active and recent uploads/downloads with bytes moved and MB/s."""
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify(transfers.list())
+
+@app.route('/api/modal/volume/usage')
+def get_modal_volume_usage():
+    """
+    Disk usage per folder (treemap payload) and duplicate files for a volume
+    (default: the model volume). Computed in the background; poll until status is 'ready'.
+    """
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+
+    vol_name = request.args.get('volume_name', DOWNLOADER_VOLUME)
+    return jsonify(volume_usage.get(vol_name, profile=request_profile(), force=request.args.get('refresh') == '1'))
+
+@app.route('/api/modal/volume/index', methods=['POST'])
+def query_modal_volume_index():
+    """
+    Paginated listing from the local volume index. Body: name, path, recursive,
+    ext ('safetensors,ckpt'), name_prefix, min_size, max_size, type ('file'/'dir'),
+    sort (name/size/mtime/path), order (asc/desc), page, page_size, refresh.
+    """
+    if 'authenticated' not in session: return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.json or {}
+    vol_name = data.get('name')
+    if not vol_name:
+        return jsonify({'error': 'Volume name required'}), 400
+
+    profile = request_profile()
+    try:
+        if data.get('refresh') and volume_index.scan_info(vol_name, profile):
+            volume_index.refresh(vol_name, profile)
+        else:
+            volume_index.ensure_fresh(vol_name, profile)
+        result = volume_index.query(
+            vol_name,
+            path=data.get('path', '/'),
+            recursive=bool(data.get('recursive')),
+            ext=data.get('ext'),
+            name_prefix=data.get('name_prefix'),
+            min_size=data.get('min_size'),
+            max_size=data.get('max_size'),
+            entry_type=data.get('type'),
+            sort=data.get('sort', 'name'),
+            order=data.get('order', 'asc'),
+            page=data.get('page', 1),
+            page_size=data.get('page_size', 100),
+            profile=profile
         )
-        stdout, stderr = process.communicate(input='y\n')
-        
-        if process.returncode != 0:
-            print(f"Error deleting file: {stderr}")
-            return jsonify({'error': 'Failed to delete file', 'details': stderr}), 500
-            
-        return jsonify({'status': 'success', 'output': stdout})
-        
+        result['indexed_at'] = volume_index.scan_info(vol_name, profile)['refreshed_at']
+        return jsonify(result)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': 'Invalid parameter', 'details': str(e)}), 400
+    except NotFound as e:
+        return jsonify({'error': 'Volume not found', 'details': str(e)}), 404
+    except ModalGatewayError as e:
+        print(f"Error indexing volume: {e}")
+        return jsonify({'error': 'Failed to index volume', 'details': str(e)}), 500
     except Exception as e:
-        print(f"Error executing modal rm: {e}")
+        print(f"Error querying volume index: {e}")
         return jsonify({'error': str(e)}), 500
 
 @socketio.on('update_worker')
+@routed_to_owner
 def handle_update_worker(data):
     worker_id = data.get('worker_id')
     name = data.get('name')
@@ -1106,6 +1581,8 @@ def handle_update_worker(data):
             worker['token'] = token
             reconnect_needed = True
             
+        publish_worker(worker_id)
+
         # Notify UI of update
         emit('worker_updated', {
             'worker_id': worker_id,
@@ -1130,6 +1607,7 @@ def handle_update_worker(data):
             socketio.start_background_task(functools.partial(connect_worker, worker_id))
 
 @socketio.on('clear_logs')
+@routed_to_owner
 def handle_clear_logs(data):
     worker_id = data.get('worker_id')
     session_id = data.get('session_id')
@@ -1137,6 +1615,7 @@ def handle_clear_logs(data):
     if worker_id in workers:
         if session_id and session_id in workers[worker_id].get('sessions', {}):
             workers[worker_id]['sessions'][session_id]['logs'] = []
+            cluster.clear_logs(worker_id, session_id)
             print(f"Logs cleared for {worker_id} session {session_id}")
 
 def connect_worker(worker_id):
@@ -1151,7 +1630,8 @@ def connect_worker(worker_id):
 
     try:
         print(f"Connecting to {url} with token: {token}")
-        client.connect(url, auth={'token': token})
+        # client_id lets the worker hand our sessions back after a reconnect
+        client.connect(url, auth={'token': token, 'client_id': worker_id, 'resume': True})
     except Exception as e:
         error_msg = str(e)
         if "Already connected" in error_msg or "Connection refused" in error_msg:
@@ -1173,17 +1653,23 @@ def connect_worker(worker_id):
             socketio.start_background_task(functools.partial(connect_worker, worker_id))
 
 @socketio.on('add_worker')
-def register_worker(url, name=None, token=None):
+def register_worker(url, name=None, token=None, worker_id=None):
     """Registers a new worker and starts connection."""
     name = name or url
     
-    # Check if URL already exists
+    # Check if URL already exists (locally or held by another host process)
     for wid, wdata in workers.items():
         if wdata['url'] == url:
             return wid
-
-    # Generate a unique ID
-    worker_id = str(uuid.uuid4())
+    if not worker_id:
+        for wid, meta in cluster.list_workers().items():
+            if meta['url'] == url:
+                return wid
+
+    # Generate a unique ID and take ownership of the link
+    worker_id = worker_id or str(uuid.uuid4())
+    if not cluster.claim(worker_id):
+        return worker_id
     print(f"Adding worker: {url} (ID: {worker_id})")
     
     # Create new SocketIO client
@@ -1203,6 +1689,8 @@ def register_worker(url, name=None, token=None):
                 workers[wid]['sessions'] = {}
             if sid not in workers[wid]['sessions']:
                 workers[wid]['sessions'][sid] = {'logs': []}
+            reset_session_seq(workers[wid]['sessions'][sid], data.get('incarnation'))
+            publish_worker(wid)
         socketio.emit('session_created', {'worker_id': wid, 'session_id': sid})
         
     def on_session_closed(wid, data):
@@ -1210,15 +1698,22 @@ def register_worker(url, name=None, token=None):
         if wid in workers and 'sessions' in workers[wid]:
             if sid in workers[wid]['sessions']:
                 del workers[wid]['sessions'][sid]
+            publish_worker(wid)
         socketio.emit('session_closed', {'worker_id': wid, 'session_id': sid})
 
     def on_exec_result(wid, data):
         data['worker_id'] = wid
+        track_exec_result(wid, data)
         socketio.emit('exec_result', data)
 
+    def on_exec_chunk(wid, data):
+        data['worker_id'] = wid
+        socketio.emit('exec_chunk', data)
+
     client.on('session_created', functools.partial(on_session_created, worker_id))
     client.on('session_closed', functools.partial(on_session_closed, worker_id))
     client.on('exec_result', functools.partial(on_exec_result, worker_id))
+    client.on('exec_chunk', functools.partial(on_exec_chunk, worker_id))
     
     workers[worker_id] = {
         'client': client,
@@ -1229,6 +1724,7 @@ def register_worker(url, name=None, token=None):
         'sessions': {},
         'closed_sessions': set()
     }
+    publish_worker(worker_id)
     
     # Connect in background
     socketio.start_background_task(functools.partial(connect_worker, worker_id))
@@ -1258,6 +1754,7 @@ def handle_add_worker(data):
         })
 
 @socketio.on('send_command')
+@routed_to_owner
 def handle_command(data):
     worker_id = data.get('worker_id')
     session_id = data.get('session_id')
@@ -1282,6 +1779,7 @@ def handle_tunnel_status():
     emit('tunnel_status', {'active': is_active})
 
 @socketio.on('term_input')
+@routed_to_owner
 def handle_term_input(data):
     worker_id = data.get('worker_id')
     session_id = data.get('session_id')
@@ -1294,20 +1792,29 @@ def handle_term_input(data):
              workers[worker_id]['client'].emit('term_input', {'input': input_data, 'session_id': session_id})
 
 @socketio.on('exec_command')
+@routed_to_owner
 def handle_exec_command(data):
     worker_id = data.get('worker_id')
     cmd = data.get('command')
     cwd = data.get('cwd')
     request_id = data.get('id')
+    profile = data.get('profile') # Optional: run under this Modal profile instead of the active one
     
     if worker_id in workers:
+         if workers[worker_id]['status'] == 'connected' and cmd:
+             track_exec_start(worker_id, request_id, cmd, cwd, profile)
          if workers[worker_id].get('type') == 'internal':
-             print(f"Internal Exec: {cmd} (CWD: {cwd})")
-             local_worker.exec_command(cmd, cwd, request_id)
+             print(f"Internal Exec: {cmd} (CWD: {cwd})" + (f" [profile {profile}]" if profile else ''))
+             local_worker.exec_command(cmd, cwd, request_id, timeout=data.get('timeout'), profile=profile)
          elif workers[worker_id]['status'] == 'connected':
              client = workers[worker_id]['client']
              try:
-                client.emit('exec_command', {'command': cmd, 'cwd': cwd, 'id': request_id})
+                payload = {'command': cmd, 'cwd': cwd, 'id': request_id}
+                if data.get('timeout') is not None:
+                    payload['timeout'] = data['timeout']
+                if profile:
+                    payload['profile'] = profile
+                client.emit('exec_command', payload)
              except Exception as e:
                 print(f"Failed to emit exec_command: {e}")
                 emit('exec_result', {'id': request_id, 'worker_id': worker_id, 'stdout': '', 'stderr': f'Emit Failed: {str(e)}', 'returncode': -1})
@@ -1316,26 +1823,83 @@ def handle_exec_command(data):
     else:
         emit('exec_result', {'id': request_id, 'worker_id': worker_id, 'stdout': '', 'stderr': 'Worker not found', 'returncode': -1})
 
+@socketio.on('watch_app')
+def handle_watch_app(data):
+    """Watch a starting app's logs host-side; app_ready is pushed once its marker shows up."""
+    app_id = data.get('app_id')
+    if not app_id:
+        return
+    info = app_watcher.watch(app_id, gpu=data.get('gpu'), started_at=data.get('started_at'), profile=data.get('profile'))
+    if info:
+        emit('app_ready', info)
+
+@socketio.on('subscribe_app_logs')
+def handle_subscribe_app_logs(data):
+    """Join an app's shared log stream; the replay buffer is sent first as app_logs_replay."""
+    app_id = data.get('app_id')
+    if not app_id:
+        return
+    profile = resolve_profile(data.get('profile'))
+    join_room(app_logs_room(app_id, profile))
+    lines = log_tailer.subscribe(app_id, request.sid, profile=profile)
+    emit('app_logs_replay', {'app_id': app_id, 'profile': profile, 'lines': lines})
+
+@socketio.on('unsubscribe_app_logs')
+def handle_unsubscribe_app_logs(data):
+    app_id = data.get('app_id')
+    if not app_id:
+        return
+    leave_room(app_logs_room(app_id, data.get('profile')))
+    log_tailer.unsubscribe(app_id, request.sid, profile=data.get('profile'))
+
+@socketio.on('subscribe_balance')
+def handle_subscribe_balance(data):
+    """Join an account's balance_updated pushes; the current wallet is sent right away. sync=true asks for a sync now."""
+    account = data.get('account')
+    if not account or not usage_scheduler:
+        return
+    join_room(balance_room(account))
+    emit('balance_updated', usage_scheduler.payload(account))
+    if data.get('sync'):
+        usage_scheduler.request_sync(account)
+
+@socketio.on('unsubscribe_balance')
+def handle_unsubscribe_balance(data):
+    account = data.get('account')
+    if account:
+        leave_room(balance_room(account))
+
+@socketio.on('disconnect')
+def handle_disconnect():
+    log_tailer.unsubscribe_all(request.sid)
+
+@socketio.on('cancel_exec')
+@routed_to_owner
+def handle_cancel_exec(data):
+    worker_id = data.get('worker_id')
+    request_id = data.get('id')
+
+    if worker_id in workers and workers[worker_id]['status'] == 'connected':
+        if workers[worker_id].get('type') == 'internal':
+            local_worker.cancel_exec(request_id)
+        else:
+            workers[worker_id]['client'].emit('cancel_exec', {'id': request_id})
+
 @socketio.on('get_balance')
 def handle_get_balance(data):
+    # Wallets live in the host's store, so any process answers whichever worker the request names
     worker_id = data.get('worker_id')
     account_name = data.get('account_name')
     request_id = data.get('id')
     
-    if worker_id in workers:
-        if workers[worker_id].get('type') == 'internal':
-             local_worker.get_balance(account_name, request_id)
-        elif workers[worker_id]['status'] == 'connected':
-             client = workers[worker_id]['client']
-             print(f"Get balance on {worker_id}: {account_name} (Connected: {client.connected})")
-             try:
-                client.emit('get_balance', {'account_name': account_name, 'id': request_id})
-             except Exception as e:
-                print(f"Failed to emit get_balance: {e}")
-                emit('exec_result', {'id': request_id, 'worker_id': worker_id, 'stdout': '', 'stderr': f'Emit Failed: {str(e)}', 'returncode': -1})
-        else:
-             print(f"Balance check blocked: Worker {worker_id} disconnected")
-             emit('exec_result', {'id': request_id, 'worker_id': worker_id, 'stdout': '', 'stderr': 'Worker not connected', 'returncode': -1})
+    if not account_name:
+        emit('exec_result', {'id': request_id, 'worker_id': worker_id, 'error': 'account_name required', 'returncode': 1})
+        return
+    try:
+        wallet_data = local_worker.load_wallet(account_name)
+        emit('exec_result', {'id': request_id, 'worker_id': worker_id, 'stdout': json.dumps(wallet_data), 'stderr': '', 'returncode': 0})
+    except Exception as e:
+        emit('exec_result', {'id': request_id, 'worker_id': worker_id, 'error': str(e), 'returncode': 1})
 
 @socketio.on('sync_usage')
 def handle_sync_usage(data):
@@ -1344,14 +1908,15 @@ def handle_sync_usage(data):
     Reads /data/usage/{account}.json from volume and updates wallet.
     """
     account_name = data.get('account_name')
-    volume_name = data.get('volume_name', 'jekverse-comfy-models')  # Default volume
+    volume_name = data.get('volume_name', usage_sync.DEFAULT_VOLUME)
     request_id = data.get('id')
     
     print(f"📊 Syncing usage for account: {account_name} from volume: {volume_name}")
-    local_worker.sync_usage_from_volume(account_name, volume_name, request_id)
+    local_worker.sync_usage_from_volume(account_name, volume_name, request_id, profile=data.get('profile'))
 
 
 @socketio.on('resize')
+@routed_to_owner
 def handle_resize(data):
     worker_id = data.get('worker_id')
     session_id = data.get('session_id')
@@ -1365,6 +1930,7 @@ def handle_resize(data):
             workers[worker_id]['client'].emit('resize', {'cols': cols, 'rows': rows, 'session_id': session_id})
 
 @socketio.on('send_signal')
+@routed_to_owner
 def handle_signal(data):
     worker_id = data.get('worker_id')
     session_id = data.get('session_id')
@@ -1378,6 +1944,24 @@ def handle_signal(data):
              workers[worker_id]['client'].emit('send_signal', {'signal': signal_type, 'session_id': session_id})
 
 @socketio.on('create_session')
+def handle_create_session_event(data):
+    """create_session without worker_id but with a placement hint picks the worker for us."""
+    hint = data.get('placement')
+    if not data.get('worker_id') and not hint:
+        emit('placement_failed', {'session_id': data.get('session_id'), 'error': 'worker_id or placement hint required'})
+        return
+    if not data.get('worker_id'):
+        candidates = [{'worker_id': wid, 'name': meta['name'], 'status': meta['status'], 'stats': meta.get('stats', {})}
+                      for wid, meta in cluster.list_workers().items()]
+        worker_id, reason = placement.place(hint, candidates, data)
+        if not worker_id:
+            emit('placement_failed', {'session_id': data.get('session_id'), 'error': reason})
+            return
+        data = dict(data, worker_id=worker_id, session_id=data.get('session_id') or f"placed-{uuid.uuid4().hex[:6]}")
+        emit('session_placed', {'worker_id': worker_id, 'session_id': data['session_id'], 'policy': hint, 'reason': reason})
+    return handle_create_session(data)
+
+@routed_to_owner
 def handle_create_session(data):
     worker_id = data.get('worker_id')
     session_id = data.get('session_id')
@@ -1394,6 +1978,7 @@ def handle_create_session(data):
              workers[worker_id]['client'].emit('create_session', {'session_id': session_id})
 
 @socketio.on('close_session')
+@routed_to_owner
 def handle_close_session(data):
     worker_id = data.get('worker_id')
     session_id = data.get('session_id')
@@ -1426,34 +2011,59 @@ if __name__ == '__main__':
         if event_name == 'term_output':
             # Use shared output handler (stores logs, broadcasts)
             on_worker_output(local_worker_id, data)
+        elif event_name == 'exec_result':
+            track_exec_result(local_worker_id, data)
+            socketio.emit(event_name, data)
         else:
              # Pass other events directly (session_created, exec_result, etc.)
             socketio.emit(event_name, data)
 
+    def adopt_worker(worker_id, meta):
+        """Take over a remote worker link left behind by a dead host process."""
+        if meta.get('type') == 'internal':
+            # Local PTYs died with their process; nothing to reconnect
+            cluster.unpublish_worker(worker_id)
+            return
+        register_worker(meta['url'], meta['name'], meta['token'], worker_id=worker_id)
+
+    cluster.start(dispatch_forwarded, adopt_worker)
+
     print("Initializing Internal Worker...")
-    local_worker = InternalWorker(handle_internal_event)
-    
-    # Add to workers dict
-    workers[local_worker_id] = {
-        'type': 'internal',
-        'status': 'connected',
-        'url': 'internal',
-        'name': 'Local Host Terminal',
-        'sessions': {},
-        'closed_sessions': set()
-    }
-    
-    # Auto-start default session
-    print("Starting default session-1...")
-    local_worker.create_session('session-1')
+    local_worker = InternalWorker(handle_internal_event, modal_gateway)
+
+    # Every process serves wallet/heartbeat logic, but only one runs the local terminal
+    if cluster.claim(local_worker_id):
+        # Add to workers dict
+        workers[local_worker_id] = {
+            'type': 'internal',
+            'status': 'connected',
+            'url': 'internal',
+            'name': 'Local Host Terminal',
+            'sessions': {},
+            'closed_sessions': set()
+        }
+        publish_worker(local_worker_id)
+        
+        # Auto-start default session
+        print("Starting default session-1...")
+        local_worker.create_session('session-1')
     
+    usage_scheduler = UsageSyncScheduler(modal_gateway, local_worker.wallets, app_registry, socketio.emit, cluster,
+                                         fast_interval=int(os.getenv('USAGE_SYNC_INTERVAL', 30)))
+
+    socketio.start_background_task(poll_worker_stats)
+    app_registry.start()
+    usage_scheduler.start()
+
     # Ensure Auth Config exists
     ConfigManager.load_config()
     
-    start_tunnel()
+    # Only one host process runs the tunnel; another takes over if it dies
+    socketio.start_background_task(tunnel_lease_loop)
 
     try:
-        socketio.run(app, host='0.0.0.0', port=5000, debug=False, allow_unsafe_werkzeug=True)
+        port = int(os.getenv('HOST_PORT', '5000'))
+        socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
     except KeyboardInterrupt:
         cleanup_worker()
         cleanup_tunnel()
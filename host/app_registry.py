@@ -0,0 +1,252 @@
+import eventlet
+from eventlet.event import Event
+from eventlet.green import subprocess
+import json
+import os
+import time
+
+from modal_profiles import configured_profiles, profile_env
+
+# Live registry of Modal apps across every profile.
+#
+# A single background poller runs `modal app list --json` for all profiles
+# concurrently (each under its own profile environment), diffs the result
+# against the previous snapshot and pushes only the changes as `apps_delta`:
+#     { 'version', 'changes': [ { 'kind', 'profile', 'app_id', 'app', 'previous_state' } ] }
+# with kind one of started / stopped / changed / added / removed. Clients keep
+# the list from GET /api/apps and apply deltas; a version gap means they
+# missed one and should re-fetch. Reads are served from memory.
+#
+# In multi-process mode one process holds the poller lease and publishes the
+# snapshot to the cluster store; the others serve reads from there, forward
+# pokes to the holder over a cluster channel and wait for the snapshot's poll
+# count to move when they need a fresh poll.
+
+POLL_INTERVAL = 10        # seconds between polls
+IDLE_INTERVAL = 60        # slower cadence while nothing is running anywhere
+LIST_TIMEOUT = 30         # per-profile `modal app list` timeout
+LEASE = 'app-registry-poller'
+SNAPSHOT_KEY = 'apps:snapshot'
+POKE_CHANNEL = 'app-registry:poke'
+WAIT_STEP = 0.5           # how often a process without the lease checks the shared snapshot
+RUNNING_STATES = ('running', 'ephemeral', 'detach')   # same test as the apps table
+
+
+def is_running(app):
+    state = (app.get('State') or '').lower()
+    return any(s in state for s in RUNNING_STATES)
+
+
+def running_apps(apps):
+    return [a for a in apps if is_running(a)]
+
+
+def fetch_apps(modal_bin, profile, timeout=LIST_TIMEOUT):
+    """Parsed `modal app list --json` for one profile."""
+    proc = subprocess.Popen(
+        [modal_bin, 'app', 'list', '--json'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+        env={**os.environ, 'TERM': 'dumb', **profile_env(profile)}
+    )
+    try:
+        with eventlet.Timeout(timeout):
+            stdout, stderr = proc.communicate()
+    except eventlet.Timeout:
+        proc.kill()
+        proc.wait()
+        raise RuntimeError(f'modal app list timed out after {timeout}s')
+    if proc.returncode != 0:
+        raise RuntimeError(stderr.decode('utf-8', errors='replace').strip() or f'exit code {proc.returncode}')
+    text = stdout.decode('utf-8', errors='replace')
+    start, end = text.find('['), text.rfind(']')
+    return json.loads(text[start:end + 1]) if start != -1 and end != -1 else []
+
+
+def diff_apps(profile, old, new):
+    """Changes between two { app_id: app } maps of one profile."""
+    changes = []
+    for app_id, app in new.items():
+        before = old.get(app_id)
+        if before is None:
+            kind = 'started' if is_running(app) else 'added'
+        elif before == app:
+            continue
+        elif is_running(before) and not is_running(app):
+            kind = 'stopped'
+        elif not is_running(before) and is_running(app):
+            kind = 'started'
+        else:
+            kind = 'changed'
+        changes.append({'kind': kind, 'profile': profile, 'app_id': app_id, 'app': app,
+                        'previous_state': before.get('State') if before else None})
+    for app_id, before in old.items():
+        if app_id not in new:
+            changes.append({'kind': 'stopped' if is_running(before) else 'removed', 'profile': profile,
+                            'app_id': app_id, 'app': None, 'previous_state': before.get('State')})
+    return changes
+
+
+class AppRegistry:
+    def __init__(self, modal_bin, emit, cluster, interval=POLL_INTERVAL, idle_interval=IDLE_INTERVAL):
+        """
+        Args:
+            modal_bin: Path of the modal CLI.
+            emit: Called as (event_name, data) to broadcast apps_delta.
+            cluster: Cluster, for the poller lease and the shared snapshot.
+        """
+        self.modal_bin = modal_bin
+        self.emit = emit
+        self.cluster = cluster
+        self.interval = interval
+        self.idle_interval = idle_interval
+        # { 'version', 'polls', 'profiles': { profile: { 'apps': { app_id: app }, 'updated_at', 'error' } } }
+        self.snapshot = {'version': 0, 'polls': 0, 'profiles': {}}
+        self.wakeup = Event()
+        self.polled = Event()
+        self.stats = {'polls': 0, 'deltas': 0, 'last_poll_sec': None}
+
+    def start(self):
+        eventlet.spawn(self._loop)
+        eventlet.spawn(self._poke_listener)
+
+    def poke(self):
+        """
+        Poll now instead of at the next interval (e.g. after a launch or stop).
+        Without the poller lease the poke goes to the holder; the local loop is
+        woken too, so it takes the lease at once if nobody holds it.
+        """
+        if LEASE not in self.cluster.owned:
+            self.cluster.publish_json(POKE_CHANNEL, {'from': self.cluster.process_id})
+        self._wake()
+
+    def _wake(self):
+        if not self.wakeup.ready():
+            self.wakeup.send()
+
+    def _poke_listener(self):
+        while True:
+            try:
+                for _ in self.cluster.listen_json(POKE_CHANNEL):
+                    if LEASE in self.cluster.owned:
+                        self._wake()
+            except Exception as e:
+                print(f"AppRegistry: Poke listener failed: {e}")
+                eventlet.sleep(self.interval)
+
+    # --- POLLING ---
+
+    def _loop(self):
+        while True:
+            if self.cluster.claim(LEASE):
+                try:
+                    self.poll()
+                except Exception as e:
+                    print(f"AppRegistry: Poll failed: {e}")
+            busy = any(is_running(a) for p in self._state()['profiles'].values() for a in p['apps'].values())
+            with eventlet.Timeout(self.interval if busy else self.idle_interval, False):
+                self.wakeup.wait()
+            self.wakeup = Event()
+
+    def poll(self):
+        started = time.time()
+        profiles = configured_profiles()
+        pool = eventlet.GreenPool(max(len(profiles), 1))
+        results = {}
+
+        def fetch(profile):
+            try:
+                results[profile] = ({a['App ID']: a for a in fetch_apps(self.modal_bin, profile) if a.get('App ID')}, None)
+            except Exception as e:
+                print(f"AppRegistry: Listing apps for {profile} failed: {e}")
+                results[profile] = (None, str(e))
+
+        for profile in profiles:
+            pool.spawn_n(fetch, profile)
+        pool.waitall()
+
+        # Continue from the shared snapshot, in case another process held the lease before us
+        snapshot = self.cluster.get_json(SNAPSHOT_KEY) or self.snapshot
+        changes = []
+        entries = {}
+        for profile in profiles:
+            previous = snapshot['profiles'].get(profile, {'apps': {}, 'updated_at': None})
+            apps, error = results[profile]
+            if apps is None:
+                # Keep the last known list; a failed poll is not a mass stop
+                entries[profile] = dict(previous, error=error)
+                continue
+            changes.extend(diff_apps(profile, previous['apps'], apps))
+            entries[profile] = {'apps': apps, 'updated_at': time.time(), 'error': None}
+
+        version = snapshot['version'] + (1 if changes else 0)
+        self.snapshot = {'version': version, 'polls': snapshot.get('polls', 0) + 1, 'profiles': entries}
+        self.cluster.set_json(SNAPSHOT_KEY, self.snapshot)
+        self.stats['polls'] += 1
+        self.stats['last_poll_sec'] = round(time.time() - started, 3)
+        if changes:
+            self.stats['deltas'] += 1
+            print(f"AppRegistry: {len(changes)} change(s) -> version {version}")
+            self.emit('apps_delta', {'version': version, 'changes': changes})
+
+        polled, self.polled = self.polled, Event()
+        polled.send()
+
+    # --- READS ---
+
+    def _state(self):
+        if LEASE in self.cluster.owned:
+            return self.snapshot
+        return self.cluster.get_json(SNAPSHOT_KEY) or self.snapshot
+
+    def list(self, profile):
+        """{ 'version', 'apps': [...], 'updated_at', 'error' } for one profile, from memory."""
+        state = self._state()
+        entry = state['profiles'].get(profile) or {'apps': {}, 'updated_at': None, 'error': None}
+        return {'version': state['version'], 'profile': profile, 'apps': list(entry['apps'].values()),
+                'updated_at': entry['updated_at'], 'error': entry.get('error')}
+
+    def wait_for_poll(self, timeout):
+        """Block until the next poll completes (or timeout). Returns False on timeout."""
+        if LEASE in self.cluster.owned:
+            polled = self.polled
+            self.poke()
+            with eventlet.Timeout(timeout, False):
+                polled.wait()
+                return True
+            return False
+
+        # Another process polls: wait for the shared snapshot's poll count to move
+        before = self._state().get('polls', 0)
+        self.poke()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            eventlet.sleep(WAIT_STEP)
+            if self._state().get('polls', 0) != before:
+                return True
+        return False
+
+    def running(self, profile, timeout=LIST_TIMEOUT):
+        """Running apps of a profile; waits for a first poll if the profile was never listed."""
+        if profile not in self._state()['profiles']:
+            self.wait_for_poll(timeout)
+        entry = self._state()['profiles'].get(profile)
+        if not entry:
+            raise RuntimeError(f"Apps of '{profile}' not listed yet")
+        if entry.get('error') and entry['updated_at'] is None:
+            raise RuntimeError(entry['error'])
+        return running_apps(entry['apps'].values())
+
+    def is_busy(self, profile):
+        """Whether the last known list of a profile has a running app (never waits for a poll)."""
+        entry = self._state()['profiles'].get(profile)
+        return bool(entry) and any(is_running(a) for a in entry['apps'].values())
+
+    def get_stats(self):
+        state = self._state()
+        return dict(self.stats, version=state['version'], poller=LEASE in self.cluster.owned,
+                    profiles={p: {'apps': len(e['apps']), 'running': len(running_apps(e['apps'].values())),
+                                  'updated_at': e['updated_at'], 'error': e.get('error')}
+                              for p, e in state['profiles'].items()})
@@ -0,0 +1,150 @@
+import eventlet
+import bisect
+import collections
+import time
+
+from log_tailer import resolve_profile, stream_key
+
+# Host-side readiness watcher for launched Modal apps.
+#
+# Instead of the browser polling `modal app logs <id> | grep ...` every few
+# seconds, the host subscribes to the app's shared log stream (LogTailer),
+# matches readiness markers as lines arrive and pushes `app_ready` (with
+# time-to-ready) to every client. The subscription is dropped on the first
+# match, when the app stops, or after WATCH_TIMEOUT. Watches are keyed by
+# (profile, app_id) like the streams. In multi-process mode one process holds a
+# lease per watched app so streams are not duplicated.
+
+READY_MARKERS = ["SERVER MODAL TELAH AKTIF!"]    # printed by modal-app-manager/images/app.py
+WATCH_TIMEOUT = 1800
+READY_TTL = 24 * 3600                            # how long ready records are remembered
+HISTOGRAM_BUCKETS = [15, 30, 60, 120, 180, 300, 600, 1200]
+SAMPLES_PER_GPU = 200
+SUBSCRIBER_KEY = 'readiness-watcher'
+
+
+class AppReadinessWatcher:
+    def __init__(self, emit, tailer, cluster, markers=None, timeout=WATCH_TIMEOUT):
+        """
+        Args:
+            emit: Called as (event_name, data) to broadcast to browsers.
+            tailer: LogTailer providing the shared `modal app logs` streams.
+            cluster: Cluster, for per-app leases and shared ready records.
+        """
+        self.emit = emit
+        self.tailer = tailer
+        self.cluster = cluster
+        self.markers = markers or READY_MARKERS
+        self.timeout = timeout
+        self.watches = {} # { stream_key: { 'app_id', 'profile', 'gpu', 'started_at', 'timer' } }
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=SAMPLES_PER_GPU)) # { gpu: [sec, ...] }
+
+    def _lease(self, stream):
+        return f'app-watch:{stream}'
+
+    def ready_info(self, app_id, profile=None):
+        return self.cluster.get_json(f'app-ready:{stream_key(app_id, profile)}')
+
+    def watch(self, app_id, gpu=None, started_at=None, profile=None):
+        """
+        Start watching an app unless it is already ready or watched (here or by
+        another host process). Returns the ready record if the app is already up.
+
+        Args:
+            gpu: GPU type the app was launched with (for time-to-ready histograms).
+            started_at: Epoch seconds the app was launched; defaults to now.
+            profile: Modal profile owning the app (for `modal app logs`).
+        """
+        profile = resolve_profile(profile)
+        stream = stream_key(app_id, profile)
+        info = self.ready_info(app_id, profile)
+        if info:
+            return info
+        if stream in self.watches or not self.cluster.claim(self._lease(stream)):
+            return None
+
+        watch = {
+            'app_id': app_id,
+            'profile': profile,
+            'gpu': gpu or 'unknown',
+            'started_at': started_at or time.time(),
+            'timer': eventlet.spawn_after(self.timeout, self._finish, stream, 'timeout')
+        }
+        self.watches[stream] = watch
+
+        def on_entry(entry):
+            if entry is None:
+                self._finish(stream, 'stopped')
+            elif any(marker in entry['line'] for marker in self.markers):
+                self._mark_ready(stream, watch, entry['ts'])
+                self._finish(stream, 'ready')
+
+        # Lines already in the replay buffer count too (another viewer started the stream)
+        for entry in self.tailer.subscribe(app_id, SUBSCRIBER_KEY, on_entry, profile=profile):
+            if stream in self.watches:
+                on_entry(entry)
+        return None
+
+    def unwatch(self, app_id, profile=None):
+        """Stop watching (e.g. the app was stopped from the UI)."""
+        self._finish(stream_key(app_id, profile), 'stopped')
+
+    def _finish(self, stream, reason):
+        watch = self.watches.pop(stream, None)
+        if not watch:
+            return
+        watch['timer'].cancel()
+        self.tailer.unsubscribe(watch['app_id'], SUBSCRIBER_KEY, profile=watch['profile'])
+        self.cluster.release(self._lease(stream))
+        if reason != 'ready':
+            print(f"AppWatcher: Stopped watching {stream} ({reason})")
+            self.emit('app_watch_ended', {'app_id': watch['app_id'], 'profile': watch['profile'], 'reason': reason})
+
+    def _mark_ready(self, stream, watch, ready_at):
+        app_id = watch['app_id']
+        info = {
+            'app_id': app_id,
+            'profile': watch['profile'],
+            'gpu': watch['gpu'],
+            'ready_at': ready_at,
+            'time_to_ready_sec': round(max(ready_at - watch['started_at'], 0), 1)
+        }
+        self.cluster.set_json(f'app-ready:{stream}', info, ttl=READY_TTL)
+        self.samples[watch['gpu']].append(info['time_to_ready_sec'])
+        print(f"AppWatcher: {app_id} ready after {info['time_to_ready_sec']}s (gpu={watch['gpu']})")
+        self.emit('app_ready', info)
+
+    def report_ready(self, app_id, gpu, started_at, ready_at, profile=None):
+        """Record readiness observed elsewhere (the launcher reads the marker from `modal run` output)."""
+        profile = resolve_profile(profile)
+        stream = stream_key(app_id, profile)
+        watch = self.watches.get(stream) or {'app_id': app_id, 'profile': profile, 'gpu': gpu or 'unknown'}
+        watch['gpu'] = gpu or watch['gpu']
+        watch['started_at'] = started_at
+        self._mark_ready(stream, watch, ready_at)
+        self._finish(stream, 'ready')
+
+    def forget(self, app_id, profile=None):
+        """Drop the ready record of a stopped app so a relaunch is watched again."""
+        self.cluster.delete_json(f'app-ready:{stream_key(app_id, profile)}')
+
+    # --- STATS ---
+
+    def get_stats(self):
+        """Time-to-ready histogram per GPU type, plus currently watched apps."""
+        gpus = {}
+        for gpu, samples in self.samples.items():
+            ordered = sorted(samples)
+            counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+            for value in ordered:
+                counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+            gpus[gpu] = {
+                'count': len(ordered),
+                'p50': ordered[len(ordered) // 2] if ordered else None,
+                'max': ordered[-1] if ordered else None,
+                'histogram': [{'le': le, 'count': c} for le, c in zip(HISTOGRAM_BUCKETS + ['+Inf'], counts)]
+            }
+        watching = [{'app_id': w['app_id'], 'profile': w['profile'], 'gpu': w['gpu'],
+                     'waiting_sec': round(time.time() - w['started_at'], 1)}
+                    for w in self.watches.values()]
+        return {'gpus': gpus, 'watching': watching}
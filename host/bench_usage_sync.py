@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Benchmark usage reconciliation on a large wallet.
+
+Builds a wallet with --history synced sessions, then times one sync of a usage
+file that repeats all of them plus --new completed and --running running sessions
+(the steady state of a long-lived account: almost everything already charged).
+With --legacy it also times the old JSON wallet loop (list membership plus a
+history scan per session) on the same data, which is O(history x file).
+
+    python bench_usage_sync.py --history 100000 --legacy
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from wallet_store import WalletStore
+import usage_sync
+
+
+def make_sessions(count, status, prefix, cost=0.5):
+    return [{'session_id': f'{prefix}{i}', 'status': status, 'gpu_type': 'Nvidia T4', 'start_time': '2026-01-01T00:00:00',
+             'end_time': '2026-01-01T00:10:00', 'duration_sec': 600, 'cost': cost} for i in range(count)]
+
+
+def seed(wallets, account, sessions):
+    with wallets.transaction():
+        wallets.account(account)
+        for s in sessions:
+            wallets.add_history(account, 'volume_sync', session_id=s['session_id'], status='completed',
+                                gpu_type=s['gpu_type'], duration_sec=s['duration_sec'], cost=s['cost'])
+            wallets.mark_synced(account, s['session_id'])
+
+
+def legacy_sync(wallet, sessions):
+    """The pre-usage_sync loop over a JSON wallet, kept here for comparison."""
+    new_cost = 0
+    for session in sessions:
+        session_id, status, cost = session.get('session_id'), session.get('status'), session.get('cost', 0)
+        if status == 'completed':
+            if session_id in wallet['synced_sessions']:
+                continue
+            running_idx = None
+            for i, h in enumerate(wallet['history']):
+                if h.get('session_id') == session_id and h.get('status') == 'running':
+                    running_idx = i
+                    break
+            new_cost += cost - wallet['history'].pop(running_idx)['cost'] if running_idx is not None else cost
+            wallet['history'].append(dict(session, status='completed'))
+            wallet['synced_sessions'].append(session_id)
+        elif status == 'running':
+            existing_idx = None
+            for i, h in enumerate(wallet['history']):
+                if h.get('session_id') == session_id and h.get('status') == 'running':
+                    existing_idx = i
+                    break
+            if existing_idx is None:
+                new_cost += cost
+                wallet['history'].append(dict(session))
+    wallet['balance'] -= new_cost
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark usage reconciliation")
+    parser.add_argument("--history", type=int, default=100000, help="Sessions already synced")
+    parser.add_argument("--new", type=int, default=50, help="New completed sessions in the file")
+    parser.add_argument("--running", type=int, default=5, help="Running sessions in the file")
+    parser.add_argument("--legacy", action="store_true", help="Also time the old JSON loop")
+    args = parser.parse_args()
+
+    old = make_sessions(args.history, 'completed', 'old-')
+    sessions = old + make_sessions(args.new, 'completed', 'new-') + make_sessions(args.running, 'running', 'run-')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        wallets = WalletStore(os.path.join(tmp, 'wallets.db'))
+        print(f"Seeding {args.history} synced sessions...")
+        print(f"  {timed(lambda: seed(wallets, 'bench', old)):.2f}s")
+
+        print(f"Syncing a file of {len(sessions)} sessions ({args.new} new, {args.running} running):")
+        result = {}
+        first = timed(lambda: result.update(usage_sync.reconcile(wallets, 'bench', sessions)))
+        print(f"  usage_sync, first sync:  {first * 1000:.1f} ms  {result}")
+        again = timed(lambda: result.update(usage_sync.reconcile(wallets, 'bench', sessions)))
+        print(f"  usage_sync, no changes:  {again * 1000:.1f} ms  {result}")
+
+    if args.legacy:
+        wallet = {'balance': 80.0, 'synced_sessions': [s['session_id'] for s in old],
+                  'history': [dict(s) for s in old]}
+        print(f"  legacy JSON loop:        {timed(lambda: legacy_sync(wallet, sessions)) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,24 @@
 #!/usr/bin/env python3
 """
 Cleanup Usage Tracker Logs
-Clears usage history while preserving account and balance information.
+Compacts old wallet ledger events and usage history into snapshot rows,
+preserving account, balance and per-period totals.
 """
 
-import os
-import json
+import time
 import argparse
 from pathlib import Path
 
-def cleanup_local_logs(tracker_dir: str = "modal-credit-tracker", reset_balance: bool = False):
+from wallet_store import WalletStore
+
+def cleanup_local_logs(tracker_dir: str = "modal-credit-tracker", reset_balance: bool = False, keep_days: float = 7):
     """
-    Clean up local usage tracker logs.
+    Compact local usage tracker logs.
     
     Args:
-        tracker_dir: Directory containing wallet files
-        reset_balance: If True, also reset balance to 80.0
+        tracker_dir: Directory containing the wallet store (wallets.db)
+        reset_balance: If True, also reset balance to 80.0 (recorded as a ledger event)
+        keep_days: Ledger events and history newer than this are kept as-is
     """
     tracker_path = Path(__file__).parent / tracker_dir
     
@@ -23,45 +26,38 @@ def cleanup_local_logs(tracker_dir: str = "modal-credit-tracker", reset_balance:
         print(f"❌ Tracker directory not found: {tracker_path}")
         return
     
-    wallet_files = list(tracker_path.glob("wallet_*.json"))
+    store = WalletStore(str(tracker_path / "wallets.db"))
+    store.import_json(str(tracker_path))
+    accounts = store.accounts()
     
-    if not wallet_files:
-        print(f"✅ No wallet files found in {tracker_path}")
+    if not accounts:
+        print(f"✅ No wallets found in {tracker_path}")
         return
     
-    print(f"🧹 Cleaning up {len(wallet_files)} local wallet file(s)...\n")
+    print(f"🧹 Compacting {len(accounts)} local wallet(s) (keeping the last {keep_days:g} day(s))...\n")
+    cutoff = time.time() - keep_days * 86400
     
-    for wallet_file in wallet_files:
+    for account in accounts:
         try:
-            with open(wallet_file, 'r') as f:
-                data = json.load(f)
-            
-            account = data.get("account", "unknown")
-            old_balance = data.get("balance", 0)
-            old_history_count = len(data.get("history", []))
-            old_synced_count = len(data.get("synced_sessions", []))
-            
-            # Clear history and synced sessions
-            data["history"] = []
-            data["synced_sessions"] = []
-            
-            # Optionally reset balance
-            if reset_balance:
-                data["balance"] = 80.0
-            
-            # Save cleaned data
-            with open(wallet_file, 'w') as f:
-                json.dump(data, f, indent=4)
+            with store.transaction():
+                old_balance = store.balance(account)
+                snapshot = store.compact(account, cutoff)
+                
+                # Optionally reset balance
+                new_balance = store.reset(account) if reset_balance else old_balance
             
-            print(f"✅ {wallet_file.name}")
-            print(f"   Account: {account}")
-            print(f"   Balance: ${old_balance:.2f} → ${data['balance']:.2f}")
-            print(f"   History: {old_history_count} entries → 0")
-            print(f"   Synced: {old_synced_count} sessions → 0")
+            print(f"✅ {account}")
+            print(f"   Balance: ${old_balance:.2f} → ${new_balance:.2f}")
+            if snapshot:
+                print(f"   Ledger: {snapshot['events']} event(s) → 1 snapshot "
+                      f"(debited ${snapshot['debited']:.2f}, credited ${snapshot['credited']:.2f})")
+                print(f"   History: {snapshot['history_entries']} entries compacted")
+            else:
+                print(f"   Nothing older than {keep_days:g} day(s)")
             print()
             
         except Exception as e:
-            print(f"❌ Error processing {wallet_file.name}: {e}\n")
+            print(f"❌ Error processing {account}: {e}\n")
 
 def cleanup_volume_logs(volume_name: str = "jekverse-comfy-models", account_name: str = None):
     """
@@ -78,6 +74,7 @@ def cleanup_volume_logs(volume_name: str = "jekverse-comfy-models", account_name
 import modal
 import json
 import os
+import time
 
 app = modal.App("cleanup-usage-logs")
 volume = modal.Volume.from_name("{volume_name}")
@@ -91,7 +88,7 @@ def cleanup_usage_logs():
         print("✅ No usage directory found in volume.")
         return
     
-    files = os.listdir(usage_dir)
+    files = [f for f in os.listdir(usage_dir) if not f.endswith(".meta.json")]
     
     if not files:
         print("✅ No usage files found.")
@@ -110,12 +107,16 @@ def cleanup_usage_logs():
             account = data.get("account", "unknown")
             session_count = len(data.get("sessions", []))
             
-            # Clear sessions
+            # Clear sessions, moving the revision forward so host sync cursors see the change
             data["sessions"] = []
+            data["revision"] = max(int(data.get("revision") or 0) + 1, int(time.time() * 1000))
             
-            # Save cleaned data
+            # Save cleaned data, then its meta sidecar
             with open(filepath, 'w') as f:
                 json.dump(data, f, indent=2)
+            with open(filepath[:-len(".json")] + ".meta.json", 'w') as f:
+                json.dump({{"account": account, "epoch": data.get("epoch"), "revision": data["revision"],
+                           "sessions": 0, "updated_at": time.time()}}, f)
             
             print(f"✅ Cleaned {{filename}}")
             print(f"   Account: {{account}}")
@@ -141,7 +142,8 @@ def cleanup_usage_logs():
 
 def main():
     parser = argparse.ArgumentParser(description="Cleanup usage tracker logs")
-    parser.add_argument("--local", action="store_true", help="Clean local logs")
+    parser.add_argument("--local", action="store_true", help="Compact local wallet logs")
+    parser.add_argument("--keep-days", type=float, default=7, help="Keep local ledger/history newer than this")
     parser.add_argument("--volume", action="store_true", help="Generate volume cleanup script")
     parser.add_argument("--reset-balance", action="store_true", help="Reset balance to 80.0")
     parser.add_argument("--volume-name", default="jekverse-comfy-models", help="Modal volume name")
@@ -154,7 +156,7 @@ def main():
         args.all = True
     
     if args.all or args.local:
-        cleanup_local_logs(reset_balance=args.reset_balance)
+        cleanup_local_logs(reset_balance=args.reset_balance, keep_days=args.keep_days)
     
     if args.all or args.volume:
         cleanup_volume_logs(volume_name=args.volume_name)
@@ -0,0 +1,308 @@
+import eventlet
+import json
+import time
+import uuid
+
+# Cluster coordination for running several host processes side by side.
+#
+# Every host process shares Socket.IO traffic through Flask-SocketIO's
+# `message_queue`, and shares the small amount of state that must be global
+# (worker registry, session logs, login rate limits, worker ownership leases)
+# through a Redis-compatible store. `memory://` selects an in-process stand-in
+# so the same code paths run without a Redis server (single process only).
+
+KEY_PREFIX = 'mwebui'
+LEASE_TTL = 15          # seconds a worker lease survives without renewal
+LOG_CAP = 2000          # max log chunks kept per session in the shared store
+
+# Lease check-and-act as one atomic step: only the holder may drop or extend it
+RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+RENEW_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] then "
+                "return redis.call('expire', KEYS[1], ARGV[2]) else return 0 end")
+
+
+class LocalPubSub:
+    def __init__(self, store):
+        self.store = store
+        self.queue = eventlet.queue.Queue()
+        self.channels = set()
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        self.store._subscribers.setdefault(channel, []).append(self.queue)
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
+
+    def close(self):
+        for channel in self.channels:
+            queues = self.store._subscribers.get(channel, [])
+            if self.queue in queues:
+                queues.remove(self.queue)
+        self.channels.clear()
+
+
+class LocalStore:
+    """
+    In-process stand-in implementing the subset of the Redis API the cluster uses.
+    Lets cluster mode run (and be exercised) without a Redis server.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expiry = {}
+        self._subscribers = {}
+
+    def _alive(self, key):
+        exp = self._expiry.get(key)
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+        return key in self._data
+
+    def get(self, key):
+        return self._data.get(key) if self._alive(key) else None
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and self._alive(key):
+            return None
+        self._data[key] = value
+        if ex:
+            self._expiry[key] = time.time() + ex
+        else:
+            self._expiry.pop(key, None)
+        return True
+
+    def expire(self, key, seconds):
+        if not self._alive(key):
+            return False
+        self._expiry[key] = time.time() + seconds
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self._data.pop(key, None)
+            self._expiry.pop(key, None)
+
+    # Counterparts of RELEASE_SCRIPT / RENEW_SCRIPT; atomic since nothing here yields
+
+    def delete_if(self, key, value):
+        if self.get(key) != value:
+            return 0
+        self.delete(key)
+        return 1
+
+    def expire_if(self, key, value, seconds):
+        if self.get(key) != value:
+            return 0
+        return 1 if self.expire(key, seconds) else 0
+
+    def hset(self, name, key, value):
+        self._data.setdefault(name, {})[key] = value
+
+    def hgetall(self, name):
+        return dict(self._data.get(name, {}))
+
+    def hdel(self, name, key):
+        self._data.get(name, {}).pop(key, None)
+
+    def rpush(self, key, value):
+        self._data.setdefault(key, []).append(value)
+
+    def ltrim(self, key, start, end):
+        items = self._data.get(key, [])
+        self._data[key] = items[start:] if end == -1 else items[start:end + 1]
+
+    def lrange(self, key, start, end):
+        items = self._data.get(key, []) if self._alive(key) else []
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def publish(self, channel, message):
+        for q in self._subscribers.get(channel, []):
+            q.put({'type': 'message', 'channel': channel, 'data': message})
+
+    def pubsub(self):
+        return LocalPubSub(self)
+
+
+class Cluster:
+    def __init__(self, url=None):
+        """
+        Args:
+            url: Redis URL shared by all host processes, or `memory://` / None
+                 for a single process using the in-process stand-in.
+        """
+        self.url = url
+        self.process_id = uuid.uuid4().hex[:12]
+        self.shared = bool(url) and not url.startswith('memory://')
+        self.owned = set()
+        self.handlers = {}
+
+        if self.shared:
+            import redis
+            self.store = redis.Redis.from_url(url, decode_responses=True)
+            release, renew = self.store.register_script(RELEASE_SCRIPT), self.store.register_script(RENEW_SCRIPT)
+            self._delete_if = lambda key, value: release(keys=[key], args=[value])
+            self._expire_if = lambda key, value, seconds: renew(keys=[key], args=[value, seconds])
+        else:
+            self.store = LocalStore()
+            self._delete_if = self.store.delete_if
+            self._expire_if = self.store.expire_if
+
+    @property
+    def message_queue(self):
+        """Value for SocketIO(message_queue=...); None when running single-process."""
+        return self.url if self.shared else None
+
+    def _key(self, *parts):
+        return ':'.join((KEY_PREFIX,) + parts)
+
+    # --- WORKER OWNERSHIP ---
+
+    def claim(self, worker_id):
+        """
+        Take (or extend) the lease on a worker link or a named role. Returns True
+        if this process now owns it.
+        """
+        key = self._key('owner', worker_id)
+        if (self.store.set(key, self.process_id, nx=True, ex=LEASE_TTL)
+                or self._expire_if(key, self.process_id, LEASE_TTL)):
+            self.owned.add(worker_id)
+            return True
+        self.owned.discard(worker_id)
+        return False
+
+    def release(self, worker_id):
+        self._delete_if(self._key('owner', worker_id), self.process_id)
+        self.owned.discard(worker_id)
+
+    def owner_of(self, worker_id):
+        return self.store.get(self._key('owner', worker_id))
+
+    def _renew_loop(self):
+        while True:
+            eventlet.sleep(LEASE_TTL / 3)
+            for worker_id in list(self.owned):
+                if not self._expire_if(self._key('owner', worker_id), self.process_id, LEASE_TTL):
+                    print(f"Cluster: Lost lease on worker {worker_id}")
+                    self.owned.discard(worker_id)
+
+    # --- SHARED WORKER REGISTRY ---
+
+    def publish_worker(self, worker_id, meta):
+        self.store.hset(self._key('workers'), worker_id, json.dumps(meta))
+
+    def unpublish_worker(self, worker_id):
+        self.store.hdel(self._key('workers'), worker_id)
+        self.release(worker_id)
+
+    def list_workers(self):
+        return {wid: json.loads(meta) for wid, meta in self.store.hgetall(self._key('workers')).items()}
+
+    def append_log(self, worker_id, session_id, output):
+        if not self.shared:
+            return
+        key = self._key('logs', worker_id, session_id)
+        self.store.rpush(key, output)
+        self.store.ltrim(key, -LOG_CAP, -1)
+
+    def get_logs(self, worker_id, session_id):
+        return "".join(self.store.lrange(self._key('logs', worker_id, session_id), 0, -1))
+
+    def clear_logs(self, worker_id, session_id):
+        self.store.delete(self._key('logs', worker_id, session_id))
+
+    # --- SHARED KEY/VALUE ---
+
+    def get_json(self, name):
+        value = self.store.get(self._key('kv', name))
+        return json.loads(value) if value else None
+
+    def set_json(self, name, value, ttl=None):
+        self.store.set(self._key('kv', name), json.dumps(value), ex=ttl)
+
+    def delete_json(self, name):
+        self.store.delete(self._key('kv', name))
+
+    # --- SHARED CHANNELS ---
+
+    def publish_json(self, name, value):
+        self.store.publish(self._key('chan', name), json.dumps(value))
+
+    def listen_json(self, name):
+        """Yield values published on `name` (from any process) until the generator is closed."""
+        pubsub = self.store.pubsub()
+        pubsub.subscribe(self._key('chan', name))
+        try:
+            for message in pubsub.listen():
+                if message.get('type') == 'message':
+                    yield json.loads(message['data'])
+        finally:
+            pubsub.close()
+
+    def mark_interest(self, name):
+        """Note that this process wants `name` kept alive; lapses after LEASE_TTL unless refreshed."""
+        self.store.hset(self._key('interest', name), self.process_id, str(time.time()))
+
+    def drop_interest(self, name):
+        self.store.hdel(self._key('interest', name), self.process_id)
+
+    def has_interest(self, name):
+        """True if another process marked interest in `name` within LEASE_TTL."""
+        cutoff = time.time() - LEASE_TTL
+        return any(pid != self.process_id and float(ts) > cutoff
+                   for pid, ts in self.store.hgetall(self._key('interest', name)).items())
+
+    # --- EVENT FORWARDING ---
+
+    def forward(self, worker_id, event, data, sid):
+        """
+        Send a worker-targeted event to the process owning that worker.
+        Returns False if no other live process owns it (caller handles locally).
+        """
+        owner = self.owner_of(worker_id)
+        if not owner or owner == self.process_id:
+            return False
+        envelope = {'event': event, 'data': data, 'sid': sid}
+        self.store.publish(self._key('proc', owner), json.dumps(envelope))
+        return True
+
+    def _listen_loop(self, dispatch):
+        pubsub = self.store.pubsub()
+        pubsub.subscribe(self._key('proc', self.process_id))
+        for message in pubsub.listen():
+            if message.get('type') != 'message':
+                continue
+            try:
+                envelope = json.loads(message['data'])
+                dispatch(envelope['event'], envelope['data'], envelope.get('sid'))
+            except Exception as e:
+                print(f"Cluster: Failed to dispatch forwarded event: {e}")
+
+    def _adopt_loop(self, on_adopt):
+        """
+        Claim registered workers whose owning process has died. Role leases
+        (e.g. 'tunnel', pollers) are not registered workers; their loops re-claim
+        them on their own.
+        """
+        while True:
+            eventlet.sleep(LEASE_TTL)
+            for worker_id, meta in self.list_workers().items():
+                if worker_id in self.owned or self.owner_of(worker_id):
+                    continue
+                if self.claim(worker_id):
+                    print(f"Cluster: Adopting orphaned worker {worker_id}")
+                    on_adopt(worker_id, meta)
+
+    def start(self, dispatch, on_adopt):
+        """
+        Args:
+            dispatch: Called as (event_name, data, sid) for events forwarded to us.
+            on_adopt: Called as (worker_id, meta) when we take over an orphaned worker.
+        """
+        eventlet.spawn(self._renew_loop)
+        eventlet.spawn(self._listen_loop, dispatch)
+        if self.shared:
+            eventlet.spawn(self._adopt_loop, on_adopt)
+        print(f"Cluster: Process {self.process_id} started (shared={self.shared})")
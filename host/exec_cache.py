@@ -0,0 +1,105 @@
+import re
+import time
+
+from modal_profiles import active_profile
+
+# Result cache for read-only CLI commands the dashboard fires repeatedly.
+#
+# Only allowlisted commands are cached, keyed on (command, cwd, active profile).
+# Concurrent identical requests are coalesced into one process (single-flight).
+# Mutating commands invalidate the families they affect, both when they start
+# and when they finish, and bump a generation counter so a read that was in
+# flight across the mutation is not stored.
+
+# family: (pattern, ttl seconds)
+CACHE_RULES = {
+    'app-list': (re.compile(r'(^|/|\s)modal\s+app\s+list\b'), 5),
+    'profile-current': (re.compile(r'(^|/|\s)modal\s+profile\s+current\b'), 30),
+    'profile-list': (re.compile(r'(^|/|\s)modal\s+profile\s+list\b'), 60),
+}
+
+# pattern: families it invalidates
+INVALIDATION_RULES = [
+    (re.compile(r'(^|/|\s)modal\s+profile\s+activate\b'), ['app-list', 'profile-current', 'profile-list']),
+    (re.compile(r'(^|/|\s)modal\s+app\s+stop\b'), ['app-list']),
+    (re.compile(r'(^|/|\s)modal\s+(run|deploy|serve)\b'), ['app-list']),
+]
+
+
+class ExecCache:
+    def __init__(self):
+        self.entries = {}     # { key: { 'result': dict, 'expires': float } }
+        self.inflight = {}    # { key: [(request_id, deliver), ...] }
+        self.generation = {family: 0 for family in CACHE_RULES}
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'invalidations': 0}
+
+    def _family(self, command):
+        for family, (pattern, ttl) in CACHE_RULES.items():
+            if pattern.search(command):
+                return family, ttl
+        return None, None
+
+    def invalidate(self, families):
+        for family in families:
+            self.generation[family] += 1
+            for key in [k for k in self.entries if k[0] == family]:
+                del self.entries[key]
+        self.stats['invalidations'] += 1
+
+    def _invalidations_for(self, command):
+        families = []
+        for pattern, targets in INVALIDATION_RULES:
+            if pattern.search(command):
+                families.extend(targets)
+        return families
+
+    def run(self, command, cwd, request_id, execute, deliver, profile=None):
+        """
+        Serve a command from cache, join an identical in-flight run, or execute it.
+
+        Args:
+            execute: Called as execute(on_result) to actually run the command.
+            deliver: Called with the exec_result dict for this request.
+            profile: Explicit Modal profile; defaults to the active one.
+        """
+        mutates = self._invalidations_for(command)
+        if mutates:
+            self.invalidate(mutates)
+
+            def on_mutation_done(result):
+                self.invalidate(mutates)
+                deliver(result)
+            execute(on_mutation_done)
+            return
+
+        family, ttl = self._family(command)
+        if not family:
+            execute(deliver)
+            return
+
+        key = (family, command, cwd, profile or active_profile())
+        entry = self.entries.get(key)
+        if entry and entry['expires'] > time.time():
+            self.stats['hits'] += 1
+            deliver(dict(entry['result'], id=request_id, cached=True))
+            return
+
+        if key in self.inflight:
+            self.stats['coalesced'] += 1
+            self.inflight[key].append((request_id, deliver))
+            return
+
+        self.stats['misses'] += 1
+        self.inflight[key] = [(request_id, deliver)]
+        generation = self.generation[family]
+
+        def on_result(result):
+            if result.get('returncode') == 0 and self.generation[family] == generation:
+                self.entries[key] = {'result': result, 'expires': time.time() + ttl}
+            for waiter_id, waiter in self.inflight.pop(key, []):
+                waiter(dict(result, id=waiter_id))
+        execute(on_result)
+
+    def get_stats(self):
+        now = time.time()
+        return dict(self.stats, entries=sum(1 for e in self.entries.values() if e['expires'] > now))
@@ -0,0 +1,172 @@
+import eventlet
+import codecs
+import os
+import select
+import signal
+import subprocess
+import time
+
+
+class ExecEngine:
+    """
+    Runs non-interactive commands for InternalWorker.
+
+    Jobs run in green threads limited by a bounded pool, stream their output
+    incrementally as `exec_chunk` events and finish with one `exec_result`.
+    Each job has a deadline and can be cancelled by request id. Reads go
+    through eventlet's green select, so long commands never stall PTY streaming.
+    """
+
+    def __init__(self, event_callback, pool_size=4, default_timeout=600, max_output=None):
+        """
+        Args:
+            event_callback: Same callback as InternalWorker: (event_name, data_dict).
+            pool_size: Max jobs running at once; the rest wait in line.
+            default_timeout: Seconds before a job is killed (0/None = no deadline).
+            max_output: Max chars retained per stream for exec_result (None = unlimited).
+                        Streamed chunks are never truncated.
+        """
+        self.callback = event_callback
+        self.default_timeout = default_timeout
+        self.max_output = max_output
+        self.slots = eventlet.semaphore.Semaphore(pool_size)
+        self.jobs = {} # { request_id: [job, ...] } (the UI reuses ids like 'list-apps')
+
+    def submit(self, command, cwd, request_id, timeout=None, max_output=None, env=None, on_result=None):
+        """
+        Queue a command. Returns immediately.
+
+        Args:
+            timeout: Overrides default_timeout for this job.
+            max_output: Overrides max_output for this job.
+            env: Extra environment variables for the command.
+            on_result: Called with the exec_result dict instead of emitting it.
+        """
+        job = {
+            'id': request_id,
+            'command': command,
+            'cwd': cwd,
+            'timeout': self.default_timeout if timeout is None else timeout,
+            'max_output': self.max_output if max_output is None else max_output,
+            'env': env or {},
+            'process': None,
+            'cancelled': False,
+            'queued_at': time.time(),
+            'on_result': on_result
+        }
+        self.jobs.setdefault(request_id, []).append(job)
+        eventlet.spawn_n(self._run, job)
+        return job
+
+    def cancel(self, request_id):
+        """Cancel every queued or running job with this id. Returns True if any were found."""
+        jobs = self.jobs.get(request_id, [])
+        for job in jobs:
+            job['cancelled'] = True
+        return bool(jobs)
+
+    def active_jobs(self):
+        return [{'id': j['id'], 'command': j['command'], 'running': j['process'] is not None}
+                for jobs in self.jobs.values() for j in jobs]
+
+    def _release(self, job):
+        jobs = self.jobs.get(job['id'], [])
+        if job in jobs:
+            jobs.remove(job)
+        if not jobs:
+            self.jobs.pop(job['id'], None)
+
+    def _kill(self, proc):
+        """Terminate the job's whole process group (shell=True spawns children)."""
+        if proc.poll() is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait(timeout=2)
+        except Exception:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except Exception:
+                pass
+
+    def _run(self, job):
+        result = {'id': job['id'], 'stdout': '', 'stderr': '', 'returncode': -1}
+
+        with self.slots:
+            try:
+                if job['cancelled']:
+                    result.update({'stderr': 'Cancelled', 'cancelled': True})
+                else:
+                    self._execute(job, result)
+            except Exception as e:
+                result.update({'error': str(e), 'returncode': -1})
+            finally:
+                self._release(job)
+                result['duration_sec'] = round(time.time() - job.get('started_at', job['queued_at']), 3)
+
+        if job['on_result']:
+            job['on_result'](result)
+        else:
+            self.callback('exec_result', result)
+
+    def _execute(self, job, result):
+        job['started_at'] = time.time()
+        cwd = os.path.expanduser(job['cwd'] if job['cwd'] else os.getcwd())
+        proc = subprocess.Popen(
+            job['command'],
+            shell=True,
+            cwd=cwd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+            env={**os.environ, 'TERM': 'xterm', **job['env']}
+        )
+        job['process'] = proc
+        try:
+            self._stream(job, proc, result)
+        finally:
+            proc.stdout.close()
+            proc.stderr.close()
+
+        proc.wait()
+        if result.get('timed_out'):
+            result['returncode'] = 124 # Same code as coreutils `timeout`
+        elif result.get('cancelled'):
+            result['returncode'] = 130
+        else:
+            result['returncode'] = proc.returncode
+
+    def _stream(self, job, proc, result):
+        streams = {proc.stdout.fileno(): 'stdout', proc.stderr.fileno(): 'stderr'}
+        decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace') for name in streams.values()}
+        deadline = job['started_at'] + job['timeout'] if job['timeout'] else None
+        cap = job['max_output']
+
+        while streams:
+            if job['cancelled']:
+                self._kill(proc)
+                result['cancelled'] = True
+                return
+            if deadline and time.time() > deadline:
+                self._kill(proc)
+                result['timed_out'] = True
+                return
+
+            r, w, e = select.select(list(streams), [], [], 0.1)
+            for fd in r:
+                name = streams[fd]
+                data = os.read(fd, 4096)
+                if not data:
+                    del streams[fd]
+                    continue
+                text = decoders[name].decode(data)
+                self.callback('exec_chunk', {'id': job['id'], 'stream': name, 'data': text})
+
+                if cap is None:
+                    result[name] += text
+                else:
+                    room = cap - len(result[name])
+                    if len(text) > room:
+                        result['truncated'] = True
+                    result[name] += text[:max(room, 0)]
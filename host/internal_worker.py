@@ -8,25 +8,48 @@ import fcntl
 import termios
 import json
 import time
-import shutil
+from exec_engine import ExecEngine
+from exec_cache import ExecCache
+from modal_profiles import UnknownProfile, profile_env
+from wallet_store import WalletStore
+import usage_sync
 
 # Enable eventlet patching if not already done
 # eventlet.monkey_patch() 
 
 class InternalWorker:
-    def __init__(self, event_callback):
+    def __init__(self, event_callback, modal_gateway=None, wallet_store=None):
         """
         Args:
             event_callback: Function to call for emitting events back to the host.
                             Signature: (event_name, data_dict)
+            modal_gateway: ModalGateway used to read usage files from volumes.
+            wallet_store: WalletStore holding balances; defaults to WALLET_DB_PATH or
+                          wallets.db in TRACKER_DIR.
         """
         self.callback = event_callback
+        self.modal_gateway = modal_gateway
         self.sessions = {} # { session_id: { 'process': proc, 'master_fd': fd, 'cwd': cwd } }
         
         # --- Credit Tracker Config ---
         self.TRACKER_DIR = os.path.join(os.path.dirname(__file__), 'modal-credit-tracker')
         if not os.path.exists(self.TRACKER_DIR):
             os.makedirs(self.TRACKER_DIR)
+        self.wallets = wallet_store or WalletStore(
+            os.getenv('WALLET_DB_PATH', os.path.join(self.TRACKER_DIR, 'wallets.db')))
+        self.wallets.import_json(self.TRACKER_DIR)
+
+        # Last CPU sample for get_stats (cumulative ticks, wall time)
+        self._last_cpu_sample = (0, None)
+
+        # Non-interactive commands (exec_command)
+        self.exec_engine = ExecEngine(
+            event_callback,
+            pool_size=int(os.getenv('EXEC_POOL_SIZE', '4')),
+            default_timeout=float(os.getenv('EXEC_DEFAULT_TIMEOUT', '600')),
+            max_output=int(os.getenv('EXEC_MAX_OUTPUT', '0')) or None
+        )
+        self.exec_cache = ExecCache()
 
     # --- TERMINAL SESSION MANAGEMENT ---
 
@@ -180,56 +203,85 @@ class InternalWorker:
             del self.sessions[session_id]
             self.callback('session_closed', {'session_id': session_id})
 
+    # --- LOAD STATS ---
+
+    def _sample_session_usage(self):
+        """Total CPU ticks and RSS bytes of every process in our PTY sessions."""
+        session_ids = {s['process'].pid for s in self.sessions.values()}
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        ticks = rss = 0
+        try:
+            pids = [p for p in os.listdir('/proc') if p.isdigit()]
+        except OSError:
+            return 0, 0
+        for pid in pids:
+            try:
+                with open(f'/proc/{pid}/stat', 'r') as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            # fields[3] = session id, [11]/[12] = utime/stime, [21] = rss pages
+            if int(fields[3]) in session_ids:
+                ticks += int(fields[11]) + int(fields[12])
+                rss += int(fields[21]) * page_size
+        return ticks, rss
+
+    def get_stats(self):
+        """Same shape as the remote worker's get_stats; CPU is measured since the previous call."""
+        ticks, rss = self._sample_session_usage()
+        now = time.time()
+        last_ticks, last_time = self._last_cpu_sample
+        cpu_percent = 0.0
+        if last_time is not None and now > last_time:
+            used = (ticks - last_ticks) / os.sysconf('SC_CLK_TCK')
+            cpu_percent = round(max(used, 0) / (now - last_time) * 100, 1)
+        self._last_cpu_sample = (ticks, now)
+
+        return {
+            'sessions': len(self.sessions),
+            'cpu_percent': cpu_percent,
+            'rss_mb': round(rss / (1024 * 1024), 1),
+            'cpu_count': os.cpu_count() or 1,
+            'load_avg': os.getloadavg()[0]
+        }
+
     # --- EXEC COMMANDS ---
 
-    def exec_command(self, command, cwd, request_id):
+    def exec_command(self, command, cwd, request_id, timeout=None, profile=None):
+        """
+        Queues the command; output arrives as exec_chunk events, then exec_result.
+        Allowlisted read-only commands may be answered from cache or coalesced
+        with an identical in-flight run (those get exec_result only).
+        An explicit profile is applied through the command's own environment
+        (MODAL_PROFILE + tokens), so the active profile is never consulted or changed.
+        """
         try:
-            cwd = os.path.expanduser(cwd if cwd else os.getcwd())
-            
-            result = subprocess.run(
-                command, 
-                shell=True, 
-                cwd=cwd, 
-                capture_output=True, 
-                text=True,
-                env={**os.environ, 'TERM': 'xterm'} 
-            )
-            
-            self.callback('exec_result', {
-                'id': request_id,
-                'stdout': result.stdout,
-                'stderr': result.stderr,
-                'returncode': result.returncode
-            })
-        except Exception as e:
-            self.callback('exec_result', {
-                'id': request_id,
-                'error': str(e),
-                'returncode': -1
-            })
+            env = profile_env(profile)
+        except UnknownProfile as e:
+            self.callback('exec_result', {'id': request_id, 'stdout': '', 'stderr': str(e), 'returncode': 1})
+            return
+        self.exec_cache.run(
+            command, cwd, request_id,
+            execute=lambda on_result: self.exec_engine.submit(command, cwd, request_id, timeout=timeout, env=env, on_result=on_result),
+            deliver=lambda result: self.callback('exec_result', result),
+            profile=profile
+        )
 
-    # --- WALLET / BALANCE ---
+    def cancel_exec(self, request_id):
+        return self.exec_engine.cancel(request_id)
 
-    def _get_account_file(self, account_name):
-        return os.path.join(self.TRACKER_DIR, f"wallet_{account_name}.json")
+    # --- WALLET / BALANCE ---
 
-    def _load_wallet_data(self, account_name):
-        filename = self._get_account_file(account_name)
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                return json.load(f)
-        return {"account": account_name, "balance": 80.0, "last_signal_time": None, "history": []}
-    
-    def _save_wallet_data(self, account_name, data):
-        with open(self._get_account_file(account_name), 'w') as f:
-            json.dump(data, f, indent=4)
+    def load_wallet(self, account_name):
+        """Wallet in the legacy JSON shape (balance, sessions, recent history)."""
+        return self.wallets.load(account_name)
 
     def get_balance(self, account_name, request_id):
         if not account_name:
             return
             
         try:
-            wallet_data = self._load_wallet_data(account_name)
+            wallet_data = self.load_wallet(account_name)
             self.callback('exec_result', {
                 'id': request_id,
                 'stdout': json.dumps(wallet_data),
@@ -252,12 +304,12 @@ class InternalWorker:
         "Nvidia T4": 1.09, "CPU": 0.1
     }
     
-    def sync_usage_from_volume(self, account_name, volume_name, request_id):
+    def sync_usage_from_volume(self, account_name, volume_name, request_id, profile=None):
         """
         Sync usage data from Modal Volume.
         
         This reads /data/usage/{account}.json from the volume and
-        updates local wallet balance based on recorded sessions.
+        updates local wallet balance based on recorded sessions (see usage_sync.py).
         """
         if not account_name or not volume_name:
             self.callback('exec_result', {
@@ -269,147 +321,11 @@ class InternalWorker:
             return
             
         try:
-            import tempfile
-            
-            # Use modal CLI to get the file from volume
-            modal_bin = shutil.which('modal') or os.path.expanduser('~/.local/bin/modal')
-            remote_path = f"usage/{account_name}.json"
-            
-            # Create temp file for the download
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as tmp:
-                tmp_path = tmp.name
-            
-            # Download usage file from volume
-            # modal volume get <volume_name> <remote_path> <local_path>
-            cmd = [modal_bin, 'volume', 'get', volume_name, remote_path, tmp_path]
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            
-            if result.returncode != 0:
-                # File might not exist yet (no sessions recorded)
-                self.callback('exec_result', {
-                    'id': request_id,
-                    'stdout': json.dumps({
-                        'synced': False,
-                        'message': 'No usage data found (VM may not have run yet)',
-                        'details': result.stderr
-                    }),
-                    'stderr': '',
-                    'returncode': 0
-                })
-                return
-            
-            # Parse usage data from volume
-            with open(tmp_path, 'r') as f:
-                usage_data = json.load(f)
-            
-            # Clean up temp file
-            os.unlink(tmp_path)
-            
-            # Load existing wallet
-            wallet = self._load_wallet_data(account_name)
-            
-            # Track which sessions we've already processed
-            if 'synced_sessions' not in wallet:
-                wallet['synced_sessions'] = []
-            
-            # Process each session from usage data
-            new_cost = 0
-            new_sessions = 0
-            
-            for session in usage_data.get('sessions', []):
-                session_id = session.get('session_id')
-                status = session.get('status', 'unknown')
-                cost = session.get('cost', 0)
-                
-                # For completed sessions: only process if not already synced
-                if status == 'completed':
-                    if session_id in wallet['synced_sessions']:
-                        continue
-                    
-                    # BUGFIX: Remove old "running" entry if exists to prevent duplicates
-                    running_idx = None
-                    for i, h in enumerate(wallet.get('history', [])):
-                        if h.get('session_id') == session_id and h.get('status') == 'running':
-                            running_idx = i
-                            break
-                    
-                    if running_idx is not None:
-                        # Remove running entry and only count the cost difference
-                        old_cost = wallet['history'][running_idx].get('cost', 0)
-                        cost_diff = cost - old_cost
-                        new_cost += cost_diff if cost_diff > 0 else 0
-                        # Remove the old running entry
-                        wallet['history'].pop(running_idx)
-                    else:
-                        # No previous running entry, count full cost
-                        new_cost += cost
-                    
-                    new_sessions += 1
-                    
-                    # Add completed entry to history
-                    wallet['history'].append({
-                        'session_id': session_id,
-                        'gpu_type': session.get('gpu_type', 'Unknown'),
-                        'start_time': session.get('start_time'),
-                        'end_time': session.get('end_time'),
-                        'duration_sec': session.get('duration_sec', 0),
-                        'cost': cost,
-                        'source': 'volume_sync',
-                        'status': 'completed'
-                    })
-                    
-                    # Mark as synced
-                    wallet['synced_sessions'].append(session_id)
-                    
-                # For running sessions: update or create tracking entry
-                elif status == 'running':
-                    # Find existing running entry to update
-                    existing_idx = None
-                    for i, h in enumerate(wallet.get('history', [])):
-                        if h.get('session_id') == session_id and h.get('status') == 'running':
-                            existing_idx = i
-                            break
-                    
-                    if existing_idx is not None:
-                        # Update existing running entry
-                        old_cost = wallet['history'][existing_idx].get('cost', 0)
-                        cost_diff = cost - old_cost
-                        if cost_diff > 0:
-                            new_cost += cost_diff
-                            wallet['history'][existing_idx].update({
-                                'end_time': session.get('end_time'),
-                                'duration_sec': session.get('duration_sec', 0),
-                                'cost': cost
-                            })
-                    else:
-                        # New running session
-                        new_cost += cost
-                        new_sessions += 1
-                        wallet['history'].append({
-                            'session_id': session_id,
-                            'gpu_type': session.get('gpu_type', 'Unknown'),
-                            'start_time': session.get('start_time'),
-                            'end_time': session.get('end_time'),
-                            'duration_sec': session.get('duration_sec', 0),
-                            'cost': cost,
-                            'source': 'volume_sync',
-                            'status': 'running'
-                        })
-            
-            # Deduct total cost from balance
-            wallet['balance'] = max(0, wallet['balance'] - new_cost)
-            
-            # Save updated wallet
-            self._save_wallet_data(account_name, wallet)
-            
+            result = usage_sync.sync_account(self.modal_gateway, self.wallets, account_name, volume_name,
+                                             profile=profile)
             self.callback('exec_result', {
                 'id': request_id,
-                'stdout': json.dumps({
-                    'synced': True,
-                    'new_sessions': new_sessions,
-                    'cost_deducted': round(new_cost, 6),
-                    'new_balance': round(wallet['balance'], 4)
-                }),
+                'stdout': json.dumps(result),
                 'stderr': '',
                 'returncode': 0
             })
@@ -432,94 +348,62 @@ class InternalWorker:
              return ({"detail": "Tipe GPU tidak terdaftar"}, 400)
              
         current_time = time.time()
-        acc_data = self._load_wallet_data(account_name)
-        
-        # Initialize 'sessions' if not exists (migration)
-        if "sessions" not in acc_data:
-            acc_data["sessions"] = {}
-            # Migrate legacy global last_signal_time to a default session if it exists and is recent
-            if acc_data.get("last_signal_time"):
-                 # Use a dummy session ID for legacy carryover or just ignore to start fresh
-                 pass
+        wallets = self.wallets
 
-        if acc_data["balance"] <= 0:
-             return ({"status": "depleted", "message": "Saldo Habis! Ganti ke akun baru."}, 200)
-             
-        rate_per_hour = gpu_rates[gpu_type]
-        rate_per_sec = rate_per_hour / 3600
-        
-        # Use session_id or 'default'
-        sid = session_id or "default"
-        
-        last_signal = acc_data["sessions"].get(sid)
-        
-        if last_signal is not None:
-            elapsed = current_time - last_signal
-            if elapsed <= 60:
-                cost = elapsed * rate_per_sec
-                acc_data["balance"] = max(0, acc_data["balance"] - cost)
-                
-                # Update history (Session-aware)
-                # We need to find the last entry *for this session* to update it, 
-                # instead of just taking the last element of the list.
-                target_entry = None
-                
-                # Search backwards for the last entry of this session
-                if acc_data.get("history"):
-                    for i in range(len(acc_data["history"]) - 1, -1, -1):
-                        entry = acc_data["history"][i]
-                        # Check matching session ID
-                        # Legacy entries won't have session_id, so they get ignored (treated as finished)
-                        if entry.get("session_id") == sid:
-                            target_entry = entry
-                            break
-                            
-                # If we found a recent entry (e.g. updated less than 5 mins ago), update it.
-                # Otherwise, start a new entry.
-                should_update = False
-                if target_entry:
-                     # Check if it's "active" (last update was recent)
-                     # We don't store timestamp in entry, only "end_time" string.
-                     # But we know we are calling this every ~20s.
-                     # If the wallet file hasn't been touched in ages, we shouldn't update.
-                     # Simpler check: If target_entry exists, we assume it's the current running session block.
-                     # But if the user stopped and restarted the script, session_id changes, so we get a new entry anyway.
-                     # If the network dropped for 1 hour, session_id is SAME.
-                     # So we should check if 'total_duration' + 'start' roughly matches current time?
-                     # Let's just update perfectly.
-                     should_update = True
+        with wallets.transaction():
+            acc_data = wallets.account(account_name)
+
+            if acc_data["balance"] <= 0:
+                 return ({"status": "depleted", "message": "Saldo Habis! Ganti ke akun baru."}, 200)
+
+            rate_per_hour = gpu_rates[gpu_type]
+            rate_per_sec = rate_per_hour / 3600
 
-                if should_update and target_entry:
-                    target_entry["end_time"] = time.strftime('%H:%M:%S')
-                    target_entry["total_duration_sec"] = round(target_entry.get("total_duration_sec", 0) + elapsed, 2)
-                    target_entry["total_cost"] = round(target_entry.get("total_cost", 0) + cost, 6)
-                    target_entry["final_balance"] = round(acc_data["balance"], 4)
+            # Use session_id or 'default'
+            sid = session_id or "default"
+
+            last_signal = wallets.last_signal(account_name, sid)
+
+            if last_signal is not None:
+                elapsed = current_time - last_signal
+                if elapsed <= 60:
+                    cost = elapsed * rate_per_sec
+                    balance_after = max(0, acc_data["balance"] - cost)
+
+                    # Update the last entry *for this session* (indexed lookup), so
+                    # several VMs on one account each extend their own block.
+                    # Legacy entries without session_id are never matched (treated as finished).
+                    target_entry = wallets.last_entry(account_name, sid)
+
+                    if target_entry:
+                        wallets.update_history(
+                            target_entry["id"],
+                            end_time=time.strftime('%H:%M:%S'),
+                            duration_sec=round(target_entry["duration_sec"] + elapsed, 2),
+                            cost=round(target_entry["cost"] + cost, 6),
+                            final_balance=round(balance_after, 4)
+                        )
+                        entry_id = target_entry["id"]
+                    else:
+                        # Append new entry
+                        entry_id = wallets.add_history(
+                            account_name, 'heartbeat',
+                            session_id=sid, # Track ownership
+                            start_time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                            end_time=time.strftime('%H:%M:%S'),
+                            gpu_type=gpu_type,
+                            duration_sec=round(elapsed, 2),
+                            cost=round(cost, 6),
+                            final_balance=round(balance_after, 4)
+                        )
+                    acc_data["balance"] = wallets.debit(account_name, 'heartbeat_debit', cost,
+                                                        session_id=sid, history_id=entry_id)
                 else:
-                    # Append new entry
-                    acc_data["history"].append({
-                        "session_id": sid, # Track ownership
-                        "start_time": time.strftime('%Y-%m-%d %H:%M:%S'),
-                        "end_time": time.strftime('%H:%M:%S'),
-                        "gpu_type": gpu_type,
-                        "total_duration_sec": round(elapsed, 2),
-                        "total_cost": round(cost, 6),
-                        "final_balance": round(acc_data["balance"], 4)
-                    })
-            else:
-                # New session after timeout -> No deduction, just reset timer
-                pass
-        
-        # Update session timestamp
-        acc_data["sessions"][sid] = current_time
-        
-        # Cleanup old sessions (optional, e.g. > 1 hour inactive)
-        active_sessions = {}
-        for s, t in acc_data["sessions"].items():
-            if current_time - t < 3600: # Keep 1 hour history of sessions
-                active_sessions[s] = t
-        acc_data["sessions"] = active_sessions
+                    # New session after timeout -> No deduction, just reset timer
+                    pass
 
-        self._save_wallet_data(account_name, acc_data)
+            # Update session timestamp (sessions idle > 1 hour are dropped)
+            wallets.touch_signal(account_name, sid, current_time)
         
         rem_hours = acc_data["balance"] / rate_per_hour if rate_per_hour > 0 else 0
         time_left = f"{int(rem_hours)}j {int((rem_hours % 1) * 60)}m"
@@ -0,0 +1,127 @@
+import math
+import os
+import re
+import sqlite3
+import time
+
+# Persistent history of exec_command jobs (host and remote workers).
+# One SQLite file in WAL mode, so several host processes can append at once.
+
+EXCERPT_CHARS = 2000  # tail of stdout+stderr kept per job
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    request_id TEXT,
+    worker_id TEXT,
+    command TEXT NOT NULL,
+    family TEXT NOT NULL,
+    cwd TEXT,
+    started_at REAL NOT NULL,
+    ended_at REAL NOT NULL,
+    duration_sec REAL NOT NULL,
+    returncode INTEGER,
+    cached INTEGER NOT NULL DEFAULT 0,
+    output_excerpt TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_family_started ON jobs (family, started_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_started ON jobs (started_at);
+"""
+
+_MODAL_BIN = re.compile(r'^(\S*/)?modal$')
+
+
+def command_family(command):
+    """
+    Group commands for latency stats: `modal <group> <action>` for the modal CLI
+    ('modal app list', 'modal volume get'), else the program name.
+    """
+    tokens = [t for t in re.split(r'\s+', command.strip()) if t]
+    # Skip wrappers such as `timeout 5s` and env assignments
+    while tokens and (tokens[0] == 'timeout' or '=' in tokens[0]):
+        tokens = tokens[2:] if tokens[0] == 'timeout' else tokens[1:]
+    if not tokens:
+        return 'unknown'
+    if _MODAL_BIN.match(tokens[0]):
+        words = []
+        for t in tokens[1:3]:
+            if not re.match(r'^[a-z][a-z-]*$', t):
+                break
+            words.append(t)
+        return ' '.join(['modal'] + words)
+    return os.path.basename(tokens[0])
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+
+class JobStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+
+    def record(self, command, worker_id, request_id, started_at, result, cwd=None):
+        """Store one finished job from its exec_result payload."""
+        ended_at = time.time()
+        output = (result.get('stdout') or '') + (result.get('stderr') or '') + (result.get('error') or '')
+        self.conn.execute(
+            'INSERT INTO jobs (request_id, worker_id, command, family, cwd, started_at, ended_at, '
+            'duration_sec, returncode, cached, output_excerpt) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (request_id, worker_id, command, command_family(command), cwd, started_at, ended_at,
+             round(ended_at - started_at, 3), result.get('returncode'), int(bool(result.get('cached'))),
+             output[-EXCERPT_CHARS:])
+        )
+
+    def recent(self, limit=50, family=None, worker_id=None):
+        query = 'SELECT * FROM jobs'
+        clauses, params = [], []
+        if family:
+            clauses.append('family = ?')
+            params.append(family)
+        if worker_id:
+            clauses.append('worker_id = ?')
+            params.append(worker_id)
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY started_at DESC LIMIT ?'
+        params.append(limit)
+        return [dict(row) for row in self.conn.execute(query, params)]
+
+    def latency_stats(self, since=None, include_cached=False):
+        """
+        Per command family: count, failures and duration percentiles (seconds).
+        Cache hits are excluded by default since they say nothing about the CLI.
+        """
+        query = 'SELECT family, duration_sec, returncode FROM jobs WHERE started_at >= ?'
+        if not include_cached:
+            query += ' AND cached = 0'
+        query += ' ORDER BY family, duration_sec'
+
+        families = {}
+        for row in self.conn.execute(query, (since or 0,)):
+            entry = families.setdefault(row['family'], {'durations': [], 'failures': 0})
+            entry['durations'].append(row['duration_sec'])
+            if row['returncode'] != 0:
+                entry['failures'] += 1
+
+        stats = {}
+        for family, entry in families.items():
+            durations = entry['durations']
+            stats[family] = {
+                'count': len(durations),
+                'failures': entry['failures'],
+                'p50': percentile(durations, 50),
+                'p90': percentile(durations, 90),
+                'p99': percentile(durations, 99),
+                'max': durations[-1],
+                'mean': round(sum(durations) / len(durations), 3)
+            }
+        return stats
@@ -0,0 +1,288 @@
+import eventlet
+from eventlet.green import subprocess
+import collections
+import os
+import re
+import signal
+import time
+import uuid
+
+from app_watcher import READY_MARKERS
+from modal_profiles import UnknownProfile, profile_env
+
+# Queue of `modal run --detach` launches with bounded parallelism.
+#
+# A launch spec names an image file under modal-app-manager/images plus the
+# settings images/app.py reads from the environment (MODAL_APP_NAME,
+# MODAL_GPU, MODAL_TIMEOUT, MODAL_REGION, MODAL_DISK). Each launch moves
+# through
+#     queued -> building -> running -> ready -> stopped
+# (or failed / cancelled), and records when it entered each state so phase
+# durations (queue wait, build, boot, uptime) can be reported.
+#
+# The CLI output drives the transitions: the app id appears once the app is
+# initialized, "Created objects" marks the end of the image build, and the
+# readiness marker means the server is up. The CLI is detached at that
+# point; the app keeps running on Modal until stopped.
+#
+# A spec may name a Modal profile; it is applied through the CLI's own
+# environment, so launches on different accounts run side by side.
+
+LAUNCH_PARALLELISM = 2
+READY_TIMEOUT = 1800             # seconds from start before we stop waiting for the readiness marker
+HISTORY = 100
+STATES = ('queued', 'building', 'running', 'ready', 'stopped', 'failed', 'cancelled')
+FINAL_STATES = ('stopped', 'failed', 'cancelled')
+APP_ID = re.compile(r'\b(ap-[A-Za-z0-9]+)\b')
+BUILD_DONE = ('Created objects', 'App deployed')
+OUTPUT_LINES = 200               # CLI output lines kept per launch
+
+
+class LaunchError(Exception):
+    pass
+
+
+def spec_env(spec):
+    """Environment variables images/app.py reads, built the same way the UI used to."""
+    env = {}
+    if spec.get('app_name'):
+        env['MODAL_APP_NAME'] = str(spec['app_name'])
+    if spec.get('timeout'):
+        env['MODAL_TIMEOUT'] = str(int(spec['timeout']))
+    if spec.get('gpu') and spec['gpu'] != 'CPU':
+        env['MODAL_GPU'] = str(spec['gpu'])
+    if spec.get('disk'):
+        env['MODAL_DISK'] = str(int(spec['disk']))
+    if spec.get('region'):
+        env['MODAL_REGION'] = str(spec['region'])
+    return env
+
+
+class Launcher:
+    def __init__(self, work_dir, modal_bin, emit, parallelism=LAUNCH_PARALLELISM, on_ready=None, on_finish=None):
+        """
+        Args:
+            work_dir: modal-app-manager/images; spec files are resolved inside it.
+            emit: Called as (event_name, data) to broadcast launch_update events.
+            on_ready: Called as (launch) when a launch reaches ready.
+            on_finish: Called as (launch) when a launch reaches a final state.
+        """
+        self.work_dir = os.path.realpath(work_dir)
+        self.modal_bin = modal_bin
+        self.emit = emit
+        self.on_ready = on_ready
+        self.on_finish = on_finish
+        self.slots = eventlet.semaphore.Semaphore(parallelism)
+        self.parallelism = parallelism
+        self.launches = collections.OrderedDict() # { launch_id: launch }, oldest first
+
+    # --- SPECS ---
+
+    def _validate(self, spec):
+        file = (spec.get('file') or '').strip()
+        path = os.path.realpath(os.path.join(self.work_dir, file))
+        if not file.endswith('.py') or not path.startswith(self.work_dir + os.sep):
+            raise LaunchError('file must be a .py file inside the images directory')
+        if not os.path.isfile(path):
+            raise LaunchError(f"No such image file '{file}'")
+        try:
+            profile_env(spec.get('profile'))
+        except UnknownProfile as e:
+            raise LaunchError(str(e))
+        try:
+            env = spec_env(spec)
+        except (TypeError, ValueError) as e:
+            raise LaunchError(f'Invalid launch spec: {e}')
+        return file, env
+
+    # --- QUEUE ---
+
+    def submit(self, spec):
+        """Validate and queue a launch. Returns its public description."""
+        file, env = self._validate(spec)
+        launch = {
+            'id': uuid.uuid4().hex[:12],
+            'file': file,
+            'gpu': spec.get('gpu') or 'CPU',
+            'profile': spec.get('profile') or None,
+            'env': env,
+            'state': None,
+            'app_id': None,
+            'phases': {},
+            'error': None,
+            'output': collections.deque(maxlen=OUTPUT_LINES),
+            'process': None,
+            'cancelled': False
+        }
+        self.launches[launch['id']] = launch
+        while len(self.launches) > HISTORY:
+            oldest = next(iter(self.launches.values()))
+            if oldest['state'] not in FINAL_STATES:
+                break
+            self.launches.popitem(last=False)
+        self._set_state(launch, 'queued')
+        eventlet.spawn_n(self._run, launch)
+        return self.describe(launch)
+
+    def _set_state(self, launch, state, error=None):
+        if launch['state'] == state:
+            return
+        launch['state'] = state
+        launch['phases'][state] = time.time()
+        if error:
+            launch['error'] = error
+        print(f"Launcher: {launch['id']} ({launch['file']}, {launch['gpu']}) -> {state}"
+              + (f" [{launch['app_id']}]" if launch['app_id'] else '') + (f": {error}" if error else ''))
+        self.emit('launch_update', self.describe(launch))
+        if state == 'ready' and self.on_ready:
+            self.on_ready(launch)
+        if state in FINAL_STATES and self.on_finish:
+            self.on_finish(launch)
+
+    def _run(self, launch):
+        with self.slots:
+            if launch['cancelled']:
+                self._set_state(launch, 'cancelled')
+                return
+            self._set_state(launch, 'building')
+            try:
+                self._execute(launch)
+            except Exception as e:
+                self._set_state(launch, 'failed', error=str(e))
+
+    def _execute(self, launch):
+        proc = subprocess.Popen(
+            [self.modal_bin, 'run', '--detach', launch['file']],
+            cwd=self.work_dir,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+            env={**os.environ, 'TERM': 'dumb', **profile_env(launch['profile']), **launch['env']}
+        )
+        launch['process'] = proc
+        deadline = time.time() + READY_TIMEOUT
+        detached = False
+
+        with eventlet.Timeout(READY_TIMEOUT, False):
+            for raw in iter(proc.stdout.readline, b''):
+                line = raw.decode('utf-8', errors='replace').rstrip()
+                launch['output'].append(line)
+                if not launch['app_id']:
+                    match = APP_ID.search(line)
+                    if match:
+                        launch['app_id'] = match.group(1)
+                        self.emit('launch_update', self.describe(launch))
+                if launch['state'] == 'building' and any(marker in line for marker in BUILD_DONE):
+                    self._set_state(launch, 'running')
+                if any(marker in line for marker in READY_MARKERS):
+                    if launch['state'] == 'building':
+                        self._set_state(launch, 'running')
+                    self._set_state(launch, 'ready')
+                    detached = True
+                    break
+
+        if not detached and time.time() >= deadline:
+            launch['error'] = f'No readiness marker after {READY_TIMEOUT}s'
+            detached = True # The app may still come up; leave it running on Modal
+
+        # `--detach` keeps the app alive once our CLI goes away
+        self._kill(proc)
+        proc.stdout.close()
+        proc.wait()
+        launch['process'] = None
+
+        if launch['cancelled']:
+            if launch['app_id']:
+                # SIGINT only detached the CLI; the half-started app would keep running
+                subprocess.call([self.modal_bin, 'app', 'stop', launch['app_id']], cwd=self.work_dir,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                env={**os.environ, **profile_env(launch['profile'])})
+            self._set_state(launch, 'cancelled')
+        elif not detached:
+            if proc.returncode == 0:
+                if launch['state'] == 'building':
+                    self._set_state(launch, 'running')
+                self._set_state(launch, 'stopped') # The app ran to completion (e.g. restore downloaders)
+            else:
+                self._set_state(launch, 'failed', error=f"modal run exited with code {proc.returncode}: "
+                                                        + ' / '.join(list(launch['output'])[-3:]))
+
+    def _kill(self, proc):
+        if proc.poll() is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGINT) # Like Ctrl+C: the CLI detaches cleanly
+            proc.wait(timeout=5)
+        except Exception:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except Exception:
+                pass
+
+    # --- CONTROL ---
+
+    def cancel(self, launch_id):
+        """
+        Cancel a queued or building launch. Running/ready launches need the app
+        stopped instead (see app_stopped). Returns False if not cancellable.
+        """
+        launch = self.launches.get(launch_id)
+        if not launch or launch['state'] not in ('queued', 'building'):
+            return False
+        launch['cancelled'] = True
+        if launch['state'] == 'queued':
+            self._set_state(launch, 'cancelled') # _run skips it once a slot frees up
+        elif launch['process']:
+            self._kill(launch['process'])
+        return True
+
+    def app_stopped(self, app_id):
+        """Mark launches of an app stopped (e.g. after `modal app stop`)."""
+        for launch in self.launches.values():
+            if launch['app_id'] == app_id and launch['state'] in ('running', 'ready'):
+                self._set_state(launch, 'stopped')
+
+    # --- REPORTING ---
+
+    def describe(self, launch, output=False):
+        phases = launch['phases']
+        now = time.time()
+
+        def span(start, end):
+            if start not in phases:
+                return None
+            stop = next((phases[s] for s in end if s in phases), None)
+            return round((stop or now) - phases[start], 1)
+
+        info = {
+            'id': launch['id'],
+            'file': launch['file'],
+            'gpu': launch['gpu'],
+            'profile': launch['profile'],
+            'env': launch['env'],
+            'state': launch['state'],
+            'app_id': launch['app_id'],
+            'error': launch['error'],
+            'phases': phases,
+            'timings': {
+                'queue_sec': span('queued', ('building', 'cancelled')),
+                'build_sec': span('building', ('running', 'failed', 'cancelled')),
+                'boot_sec': span('running', ('ready', 'stopped', 'failed')),
+                'uptime_sec': span('ready', ('stopped',))
+            }
+        }
+        if output:
+            info['output'] = list(launch['output'])
+        return info
+
+    def list(self):
+        return [self.describe(l) for l in reversed(self.launches.values())]
+
+    def get(self, launch_id):
+        launch = self.launches.get(launch_id)
+        return self.describe(launch, output=True) if launch else None
+
+    def get_stats(self):
+        counts = collections.Counter(l['state'] for l in self.launches.values())
+        return {'parallelism': self.parallelism, 'states': {s: counts.get(s, 0) for s in STATES}}
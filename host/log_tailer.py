@@ -0,0 +1,234 @@
+import eventlet
+from eventlet.green import subprocess
+import collections
+import os
+import signal
+import time
+
+from modal_profiles import active_profile, profile_env
+
+# Shared `modal app logs` streams.
+#
+# One upstream process per app, fanned out to any number of subscribers:
+# browsers (through on_line, which emits once to the app's Socket.IO room) and
+# in-process consumers such as the readiness watcher (per-subscriber
+# callbacks). Late joiners get a bounded replay buffer. When the last
+# subscriber leaves, the upstream lingers briefly (page reloads) and is then
+# stopped. Streams are keyed by (profile, app_id) and run under that profile,
+# applied through the subprocess environment, so viewers of different
+# accounts never share one.
+#
+# With several host processes, the upstream of an app is leased through the
+# cluster: only the lease holder runs `modal app logs` and calls on_line /
+# on_end (which reach the shared Socket.IO room once). Other processes with
+# subscribers follow it: they relay its lines to their in-process callbacks
+# and replay buffer, keep it alive by marking interest, and take the lease
+# over if the holder disappears.
+
+REPLAY_LINES = 500
+LINGER = 10               # seconds an upstream survives without subscribers
+FOLLOW_CHECK = 3          # seconds between a follower's checks on the lease holder
+
+
+def resolve_profile(profile):
+    """Profile a stream runs under; None means the active one ('' if none is configured)."""
+    return profile or active_profile() or ''
+
+
+def stream_key(app_id, profile):
+    """Identifies one app's stream in one account: tails, leases and Socket.IO rooms are keyed by it."""
+    return f'{resolve_profile(profile)}:{app_id}'
+
+
+class LogTailer:
+    def __init__(self, modal_bin, on_line=None, on_end=None, cluster=None, replay_lines=REPLAY_LINES, linger=LINGER):
+        """
+        Args:
+            modal_bin: Path of the modal CLI.
+            on_line: Called as (app_id, profile, entry) for every line, once per line
+                     regardless of subscriber count. entry = { 'seq', 'line', 'ts' }.
+            on_end: Called as (app_id, profile, reason) when an upstream stops.
+            cluster: Cluster the upstreams are leased through; None runs every upstream locally.
+        """
+        self.modal_bin = modal_bin
+        self.on_line = on_line
+        self.on_end = on_end
+        self.cluster = cluster
+        self.replay_lines = replay_lines
+        self.linger = linger
+        self.tails = {} # { stream_key: { 'app_id', 'profile', 'subscribers': { key: callback|None }, 'buffer', 'seq', 'process', 'role', 'cancelled', 'started_at', 'stop_timer' } }
+
+    def _lease(self, stream):
+        return f'app-logs:{stream}'
+
+    def subscribe(self, app_id, key, callback=None, profile=None):
+        """
+        Add a subscriber; starts the upstream (under profile) if this is the first one.
+        callback, if given, is called as (entry) for each new line and (None) when the stream ends.
+        Returns the replay buffer (list of entries) for the late joiner.
+        """
+        stream = stream_key(app_id, profile)
+        tail = self.tails.get(stream)
+        if not tail or tail['cancelled']:
+            tail = {
+                'app_id': app_id,
+                'profile': resolve_profile(profile),
+                'subscribers': {},
+                'buffer': collections.deque(maxlen=self.replay_lines),
+                'seq': 0,
+                'process': None,
+                'role': None, # 'upstream' or 'follower'
+                'cancelled': False,
+                'started_at': time.time(),
+                'stop_timer': None
+            }
+            self.tails[stream] = tail
+            eventlet.spawn_n(self._run, stream, tail)
+        if tail['stop_timer']:
+            tail['stop_timer'].cancel()
+            tail['stop_timer'] = None
+        tail['subscribers'][key] = callback
+        return list(tail['buffer'])
+
+    def unsubscribe(self, app_id, key, profile=None):
+        self._unsubscribe(stream_key(app_id, profile), key)
+
+    def _unsubscribe(self, stream, key):
+        tail = self.tails.get(stream)
+        if not tail or key not in tail['subscribers']:
+            return
+        del tail['subscribers'][key]
+        if not tail['subscribers'] and not tail['stop_timer']:
+            tail['stop_timer'] = eventlet.spawn_after(self.linger, self._stop_if_idle, stream, tail)
+
+    def unsubscribe_all(self, key):
+        """Drop a subscriber (e.g. a disconnected browser) from every app."""
+        for stream in list(self.tails):
+            self._unsubscribe(stream, key)
+
+    def _stop_if_idle(self, stream, tail):
+        tail['stop_timer'] = None
+        if tail['subscribers']:
+            return
+        if tail['role'] == 'upstream' and self.cluster and self.cluster.has_interest(self._lease(stream)):
+            # Followers in other processes still relay this stream
+            tail['stop_timer'] = eventlet.spawn_after(self.linger, self._stop_if_idle, stream, tail)
+            return
+        # An upstream still starting has no process yet; _upstream kills it once it has
+        tail['cancelled'] = True
+        if tail['process']:
+            self._kill(tail['process'])
+
+    def _kill(self, proc):
+        if proc.poll() is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except Exception:
+            pass
+
+    def _run(self, stream, tail):
+        while not tail['cancelled']:
+            if not self.cluster or self.cluster.claim(self._lease(stream)):
+                tail['role'] = 'upstream'
+                return self._upstream(stream, tail)
+            tail['role'] = 'follower'
+            reason = self._follow(stream, tail)
+            if reason:
+                return self._finish(stream, tail, reason)
+            # The holder vanished without ending the stream; try to take over
+        self._finish(stream, tail, 'idle')
+
+    def _follow(self, stream, tail):
+        """
+        Relay the lease holder's lines until its stream ends (returns the reason),
+        this tail is cancelled ('idle') or the holder disappears (None).
+        """
+        lease = self._lease(stream)
+        relay = eventlet.spawn(self._relay, stream, tail)
+        try:
+            while True:
+                self.cluster.mark_interest(lease)
+                if relay.dead:
+                    return relay.wait()
+                if tail['cancelled']:
+                    return 'idle'
+                if not self.cluster.owner_of(lease):
+                    return None
+                eventlet.sleep(FOLLOW_CHECK)
+        finally:
+            relay.kill()
+            self.cluster.drop_interest(lease)
+
+    def _relay(self, stream, tail):
+        try:
+            for message in self.cluster.listen_json(self._lease(stream)):
+                if 'end' in message:
+                    return message['end']
+                tail['seq'] = message['seq']
+                tail['buffer'].append(message)
+                for callback in list(tail['subscribers'].values()):
+                    if callback:
+                        callback(message)
+        except Exception as e:
+            print(f"LogTailer: Relay for {stream} failed: {e}")
+        return 'error'
+
+    def _upstream(self, stream, tail):
+        app_id, profile = tail['app_id'], tail['profile']
+        reason = 'ended'
+        relay = self.cluster is not None and self.cluster.shared
+        print(f"LogTailer: Starting upstream for {stream}")
+        try:
+            proc = subprocess.Popen(
+                [self.modal_bin, 'app', 'logs', app_id],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+                env={**os.environ, 'TERM': 'dumb', **profile_env(profile)}
+            )
+            tail['process'] = proc
+            if tail['cancelled']:
+                self._kill(proc) # Went idle while starting
+            for raw in iter(proc.stdout.readline, b''):
+                tail['seq'] += 1
+                entry = {'seq': tail['seq'], 'line': raw.decode('utf-8', errors='replace'), 'ts': time.time()}
+                tail['buffer'].append(entry)
+                if self.on_line:
+                    self.on_line(app_id, profile, entry)
+                if relay:
+                    self.cluster.publish_json(self._lease(stream), entry)
+                for callback in list(tail['subscribers'].values()):
+                    if callback:
+                        callback(entry)
+            self._kill(proc)
+            proc.stdout.close()
+            proc.wait()
+            if tail['cancelled']:
+                reason = 'idle'
+        except Exception as e:
+            reason = 'error'
+            print(f"LogTailer: Upstream for {stream} failed: {e}")
+        finally:
+            if self.cluster:
+                if relay:
+                    self.cluster.publish_json(self._lease(stream), {'end': reason})
+                self.cluster.release(self._lease(stream))
+
+        print(f"LogTailer: Upstream for {stream} stopped ({reason}, {tail['seq']} lines)")
+        self._finish(stream, tail, reason)
+        if self.on_end:
+            self.on_end(app_id, profile, reason)
+
+    def _finish(self, stream, tail, reason):
+        if self.tails.get(stream) is tail:
+            del self.tails[stream]
+        for callback in list(tail['subscribers'].values()):
+            if callback:
+                callback(None)
+
+    def get_stats(self):
+        return {stream: {'app_id': t['app_id'], 'profile': t['profile'], 'subscribers': len(t['subscribers']),
+                         'lines': t['seq'], 'role': t['role'], 'uptime_sec': round(time.time() - t['started_at'], 1)}
+                for stream, t in self.tails.items()}
@@ -51,6 +51,18 @@ GPU_ALIASES = {
 
 USAGE_DIR = "/data/usage"
 
+# Sync cursor: every write bumps the file's "revision" (milliseconds since the
+# epoch, forced monotonic, so VMs sharing a file still move it forward) and
+# stamps it on the sessions it changed. A small sidecar <account>.meta.json
+# carries the revision alone, so the host can skip downloading the usage file
+# when nothing moved and apply only sessions newer than its cursor otherwise.
+# "epoch" identifies one incarnation of the file; it changes if the file is
+# recreated, telling the host to start over.
+
+
+def next_revision(current: int = 0) -> int:
+    return max(int(current or 0) + 1, int(time.time() * 1000))
+
 
 class UsageTracker:
     """
@@ -64,6 +76,7 @@ class UsageTracker:
         self.session_id = str(uuid.uuid4())[:8]
         self.start_time = None
         self.usage_file = os.path.join(USAGE_DIR, f"{account_name}.json")
+        self.meta_file = os.path.join(USAGE_DIR, f"{account_name}.meta.json")
         self._running = False
         self._update_thread = None
         
@@ -85,16 +98,26 @@ class UsageTracker:
                 pass
         return {
             "account": self.account_name,
+            "epoch": uuid.uuid4().hex[:8],
+            "revision": 0,
             "sessions": []
         }
     
     def _save_usage_data(self, data: dict):
-        """Save usage data to volume."""
+        """Save usage data to volume, then its meta sidecar (so the meta never runs ahead of the file)."""
         try:
             self._ensure_dir()
             print(f"📝 Writing to {self.usage_file}...")
             with open(self.usage_file, 'w') as f:
                 json.dump(data, f, indent=2)
+            with open(self.meta_file, 'w') as f:
+                json.dump({
+                    "account": self.account_name,
+                    "epoch": data.get("epoch"),
+                    "revision": data.get("revision", 0),
+                    "sessions": len(data.get("sessions", [])),
+                    "updated_at": time.time()
+                }, f)
             print(f"✅ Successfully wrote {len(data.get('sessions', []))} session(s)")
         except Exception as e:
             print(f"❌ ERROR saving usage data to {self.usage_file}: {e}")
@@ -154,6 +177,8 @@ class UsageTracker:
             print(f"🔄 Updating session {self.session_id[:8]}... (final={final})")
             
             data = self._load_usage_data()
+            data.setdefault("epoch", uuid.uuid4().hex[:8]) # Files written before revisions existed
+            data["revision"] = next_revision(data.get("revision"))
             
             # Find existing session or create new
             session_entry = None
@@ -178,6 +203,7 @@ class UsageTracker:
             session_entry["duration_sec"] = round(duration_sec, 2)
             session_entry["cost"] = self._calculate_cost(duration_sec)
             session_entry["status"] = "completed" if final else "running"
+            session_entry["revision"] = data["revision"]
             
             print(f"  Duration: {duration_sec:.0f}s, Cost: ${session_entry['cost']:.4f}")
             
@@ -0,0 +1,387 @@
+from eventlet import tpool
+import datetime
+import posixpath
+import time
+from dataclasses import dataclass
+from typing import Iterator, List, Optional
+
+from modal_profiles import active_profile, profile_credentials
+
+# In-process access to Modal, replacing per-request `modal ...` CLI subprocesses.
+#
+# ModalGateway exposes a small typed API (volumes and volume files) over a
+# pluggable backend:
+#   - SdkBackend: the `modal` Python SDK with one long-lived client per profile,
+#     built from that profile's tokens so calls for different accounts can run
+#     side by side without touching the active profile. SDK calls block their
+#     OS thread, so the gateway runs them in eventlet's thread pool and the hub
+#     keeps serving terminals meanwhile.
+#   - FakeBackend: in-memory volumes for offline testing/dev.
+# Select with MODAL_GATEWAY_BACKEND=sdk|fake (default sdk).
+
+READ_CHUNK = 1024 * 1024
+
+
+class ModalGatewayError(Exception):
+    pass
+
+
+class NotFound(ModalGatewayError):
+    pass
+
+
+@dataclass
+class VolumeInfo:
+    name: str
+    created_at: Optional[float] = None
+    created_by: Optional[str] = None
+
+    def to_cli_json(self):
+        """Same keys as `modal volume list --json`, which the UI renders."""
+        return {
+            'Name': self.name,
+            'Created at': _format_time(self.created_at),
+            'Created by': self.created_by or 'Unknown'
+        }
+
+
+@dataclass
+class FileEntry:
+    path: str
+    type: str          # 'file' or 'dir'
+    mtime: float = 0.0
+    size: int = 0
+
+    def to_cli_json(self):
+        """Same keys as `modal volume ls --json`, plus raw size/mtime."""
+        return {
+            'Filename': self.path,
+            'Type': self.type,
+            'Created/Modified': _format_time(self.mtime),
+            'Size': _format_size(self.size) if self.type == 'file' else '-',
+            'size_bytes': self.size,
+            'mtime': self.mtime
+        }
+
+
+def _format_time(ts):
+    if not ts:
+        return 'Unknown'
+    return datetime.datetime.fromtimestamp(ts).astimezone().strftime('%Y-%m-%d %H:%M %Z')
+
+
+def _format_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB', 'TiB'):
+        if size < 1024 or unit == 'TiB':
+            return f"{size} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def _slice_chunks(chunks, start=0, end=None):
+    """Bytes [start, end] (inclusive, end=None means EOF) of a chunk stream."""
+    offset = 0
+    for chunk in chunks:
+        chunk_start, offset = offset, offset + len(chunk)
+        if offset <= start:
+            continue
+        if end is not None and chunk_start > end:
+            return
+        lo = max(start - chunk_start, 0)
+        hi = len(chunk) if end is None else min(end + 1 - chunk_start, len(chunk))
+        yield chunk[lo:hi]
+
+
+def _normalize(path):
+    """Volume paths relative to the root, without leading/trailing slashes."""
+    path = posixpath.normpath('/' + (path or '')).lstrip('/')
+    return '' if path == '.' else path
+
+
+# --- BACKENDS ---
+
+class FakeBackend:
+    """In-memory volumes: { volume_name: { 'created_at': ts, 'files': { path: (bytes, mtime) } } }."""
+
+    blocking = False
+
+    def __init__(self, volumes=None):
+        self.volumes = {}
+        for name, files in (volumes or {}).items():
+            self.create_volume(name)
+            for path, data in files.items():
+                self.put_file(name, path, data)
+
+    def _volume(self, name):
+        if name not in self.volumes:
+            raise NotFound(f"Volume '{name}' not found")
+        return self.volumes[name]
+
+    def list_volumes(self, profile=None):
+        return [VolumeInfo(name, v['created_at'], 'fake') for name, v in sorted(self.volumes.items())]
+
+    def create_volume(self, name, profile=None):
+        if name in self.volumes:
+            raise ModalGatewayError(f"Volume '{name}' already exists")
+        self.volumes[name] = {'created_at': time.time(), 'files': {}}
+
+    def delete_volume(self, name, profile=None):
+        self._volume(name)
+        del self.volumes[name]
+
+    def listdir(self, volume, path, recursive=False, profile=None):
+        files = self._volume(volume)['files']
+        prefix = _normalize(path)
+        if prefix in files:
+            data, mtime = files[prefix]
+            return [FileEntry(prefix, 'file', mtime, len(data))]
+
+        base = prefix + '/' if prefix else ''
+        entries = {}
+        for file_path, (data, mtime) in files.items():
+            if not file_path.startswith(base):
+                continue
+            parts = file_path[len(base):].split('/')
+            # Implicit parent directories
+            for depth in range(1, len(parts) if recursive else min(len(parts), 2)):
+                dir_path = base + '/'.join(parts[:depth])
+                entry = entries.setdefault(dir_path, FileEntry(dir_path, 'dir', mtime, 0))
+                entry.mtime = max(entry.mtime, mtime)
+            if recursive or len(parts) == 1:
+                entries[file_path] = FileEntry(file_path, 'file', mtime, len(data))
+        if not entries and prefix:
+            raise NotFound(f"No such path '{path}' in volume '{volume}'")
+        return sorted(entries.values(), key=lambda e: e.path)
+
+    def read_file(self, volume, path, start=0, end=None, profile=None):
+        files = self._volume(volume)['files']
+        key = _normalize(path)
+        if key not in files:
+            raise NotFound(f"No such file '{path}' in volume '{volume}'")
+        data = files[key][0][start:None if end is None else end + 1]
+        for i in range(0, len(data), READ_CHUNK):
+            yield data[i:i + READ_CHUNK]
+
+    def remove_file(self, volume, path, recursive=False, profile=None):
+        files = self._volume(volume)['files']
+        key = _normalize(path)
+        if key in files:
+            del files[key]
+            return
+        children = [p for p in files if p.startswith(key + '/')]
+        if not children:
+            raise NotFound(f"No such path '{path}' in volume '{volume}'")
+        if not recursive:
+            raise ModalGatewayError(f"'{path}' is a directory; use recursive=True")
+        for p in children:
+            del files[p]
+
+    def put_file(self, volume, path, data, profile=None):
+        self._volume(volume)['files'][_normalize(path)] = (data, time.time())
+
+    def put_local_file(self, volume, local_path, path, profile=None):
+        with open(local_path, 'rb') as f:
+            self.put_file(volume, path, f.read())
+
+    def copy_files(self, volume, src_paths, dst_path, recursive=False, profile=None):
+        files = self._volume(volume)['files']
+        dst = _normalize(dst_path)
+        # Like `cp`: into dst when it is a directory or there are several sources, else onto dst
+        into = dst_path.endswith('/') or len(src_paths) > 1 or any(p.startswith(dst + '/') for p in files)
+        copies = {}
+        for src_path in src_paths:
+            src = _normalize(src_path)
+            target = posixpath.join(dst, posixpath.basename(src)) if into else dst
+            if src in files:
+                copies[target] = files[src]
+                continue
+            children = [p for p in files if p.startswith(src + '/')]
+            if not children:
+                raise NotFound(f"No such path '{src_path}' in volume '{volume}'")
+            if not recursive:
+                raise ModalGatewayError(f"'{src_path}' is a directory; use recursive=True")
+            for p in children:
+                copies[target + p[len(src):]] = files[p]
+        now = time.time()
+        for path, (data, _) in copies.items():
+            files[path] = (data, now)
+
+
+class SdkBackend:
+    """Modal Python SDK with one long-lived client per profile."""
+
+    blocking = True
+
+    def __init__(self):
+        import modal
+        self.modal = modal
+        self.clients = {} # { profile or None: modal.Client }
+
+    def client(self, profile=None):
+        """Client for a profile; profile=None means the currently active one."""
+        profile = profile or active_profile()
+        if profile not in self.clients:
+            if profile:
+                token_id, token_secret, _ = profile_credentials(profile)
+                self.clients[profile] = self.modal.Client.from_credentials(token_id, token_secret)
+            else:
+                self.clients[profile] = self.modal.Client.from_env()
+        return self.clients[profile]
+
+    def _environment(self, profile):
+        profile = profile or active_profile()
+        return profile_credentials(profile)[2] if profile else None
+
+    def _volume(self, name, profile=None):
+        try:
+            vol = self.modal.Volume.from_name(name, environment_name=self._environment(profile))
+            vol.hydrate(client=self.client(profile))
+            return vol
+        except self.modal.exception.NotFoundError as e:
+            raise NotFound(str(e))
+
+    def list_volumes(self, profile=None):
+        client = self.client(profile)
+        if not hasattr(self.modal.Volume, 'objects'):
+            raise ModalGatewayError('Installed modal SDK cannot list volumes; upgrade to modal>=1.1')
+        volumes = []
+        for vol in self.modal.Volume.objects.list(environment_name=self._environment(profile), client=client):
+            info = vol.info()
+            created_at = info.created_at.timestamp() if info.created_at else None
+            volumes.append(VolumeInfo(info.name or vol.name, created_at, info.created_by))
+        return volumes
+
+    def create_volume(self, name, profile=None):
+        client = self.client(profile)
+        if hasattr(self.modal.Volume, 'objects'):
+            self.modal.Volume.objects.create(name, environment_name=self._environment(profile), client=client)
+        else:
+            self.modal.Volume.create_deployed(name, environment_name=self._environment(profile), client=client)
+
+    def delete_volume(self, name, profile=None):
+        client = self.client(profile)
+        try:
+            if hasattr(self.modal.Volume, 'objects'):
+                self.modal.Volume.objects.delete(name, environment_name=self._environment(profile), client=client)
+            else:
+                self.modal.Volume.delete(name, environment_name=self._environment(profile), client=client)
+        except self.modal.exception.NotFoundError as e:
+            raise NotFound(str(e))
+
+    def listdir(self, volume, path, recursive=False, profile=None):
+        vol = self._volume(volume, profile)
+        try:
+            entries = vol.listdir(path or '/', recursive=recursive)
+        except (self.modal.exception.NotFoundError, FileNotFoundError) as e:
+            raise NotFound(str(e))
+        return [FileEntry(e.path, 'dir' if e.type == self.modal.volume.FileEntryType.DIRECTORY else 'file',
+                          e.mtime, e.size) for e in entries]
+
+    def read_file(self, volume, path, start=0, end=None, profile=None):
+        vol = self._volume(volume, profile)
+        try:
+            # The SDK streams from offset 0; skip up to start without buffering
+            yield from _slice_chunks(vol.read_file(path), start, end)
+        except (self.modal.exception.NotFoundError, FileNotFoundError) as e:
+            raise NotFound(str(e))
+
+    def remove_file(self, volume, path, recursive=False, profile=None):
+        vol = self._volume(volume, profile)
+        try:
+            vol.remove_file(path, recursive=recursive)
+        except (self.modal.exception.NotFoundError, FileNotFoundError) as e:
+            raise NotFound(str(e))
+
+    def copy_files(self, volume, src_paths, dst_path, recursive=False, profile=None):
+        vol = self._volume(volume, profile)
+        try:
+            vol.copy_files(list(src_paths), dst_path, recursive=recursive)
+        except (self.modal.exception.NotFoundError, FileNotFoundError) as e:
+            raise NotFound(str(e))
+
+    def put_file(self, volume, path, data, profile=None):
+        import io
+        vol = self._volume(volume, profile)
+        with vol.batch_upload(force=True) as batch:
+            batch.put_file(io.BytesIO(data), '/' + _normalize(path))
+
+    def put_local_file(self, volume, local_path, path, profile=None):
+        vol = self._volume(volume, profile)
+        with vol.batch_upload(force=True) as batch:
+            batch.put_file(local_path, '/' + _normalize(path)) # Streamed from disk by the SDK
+
+
+BACKENDS = {
+    'sdk': SdkBackend,
+    'fake': FakeBackend,
+}
+
+
+class ModalGateway:
+    def __init__(self, backend):
+        self.backend = backend
+
+    @classmethod
+    def from_env(cls, name=None):
+        import os
+        name = name or os.getenv('MODAL_GATEWAY_BACKEND', 'sdk')
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown modal gateway backend '{name}'")
+        return cls(BACKENDS[name]())
+
+    def _call(self, fn, *args, **kwargs):
+        if self.backend.blocking:
+            return tpool.execute(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    # --- VOLUMES ---
+
+    def list_volumes(self, profile=None) -> List[VolumeInfo]:
+        return self._call(self.backend.list_volumes, profile=profile)
+
+    def create_volume(self, name, profile=None):
+        return self._call(self.backend.create_volume, name, profile=profile)
+
+    def delete_volume(self, name, profile=None):
+        return self._call(self.backend.delete_volume, name, profile=profile)
+
+    # --- VOLUME FILES ---
+
+    def listdir(self, volume, path='/', recursive=False, profile=None) -> List[FileEntry]:
+        return self._call(self.backend.listdir, volume, path, recursive=recursive, profile=profile)
+
+    def stat(self, volume, path, profile=None) -> FileEntry:
+        """Entry for a single file; NotFound if missing, ModalGatewayError if it is a directory."""
+        key = _normalize(path)
+        entries = self.listdir(volume, path, profile=profile)
+        if len(entries) == 1 and entries[0].type == 'file' and _normalize(entries[0].path) == key:
+            return entries[0]
+        raise ModalGatewayError(f"'{path}' is a directory")
+
+    def iter_file(self, volume, path, start=0, end=None, profile=None) -> Iterator[bytes]:
+        """
+        Stream a file's bytes chunk by chunk without holding it all in memory.
+        start/end select an inclusive byte range (end=None reads to EOF).
+        """
+        chunks = self.backend.read_file(volume, path, start=start, end=end, profile=profile)
+        while True:
+            chunk = self._call(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def read_file(self, volume, path, profile=None) -> bytes:
+        return b''.join(self.iter_file(volume, path, profile=profile))
+
+    def remove_file(self, volume, path, recursive=False, profile=None):
+        return self._call(self.backend.remove_file, volume, path, recursive=recursive, profile=profile)
+
+    def copy_files(self, volume, src_paths, dst_path, recursive=False, profile=None):
+        """Copy several paths in one call; a dst_path ending in '/' copies into that directory."""
+        return self._call(self.backend.copy_files, volume, src_paths, dst_path, recursive=recursive, profile=profile)
+
+    def put_file(self, volume, path, data, profile=None):
+        return self._call(self.backend.put_file, volume, path, data, profile=profile)
+
+    def put_local_file(self, volume, local_path, path, profile=None):
+        """Upload a file from local disk without reading it into memory first."""
+        return self._call(self.backend.put_local_file, volume, local_path, path, profile=profile)
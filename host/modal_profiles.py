@@ -0,0 +1,98 @@
+import os
+
+# Helpers for reading Modal profiles from ~/.modal.toml.
+#
+# Operations on a specific account never touch the file's `active = true` flag
+# (that is what `modal profile activate` flips, for everyone at once). Instead
+# the profile is applied per call: subprocesses get it through their own
+# environment (profile_env) and SDK calls through a per-profile client built
+# from its tokens (profile_credentials).
+
+MODAL_CONFIG_PATH = os.path.expanduser('~/.modal.toml')
+
+_profiles_cache = {'mtime': None, 'profiles': {}}
+
+
+class UnknownProfile(ValueError):
+    pass
+
+
+def _unquote(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+
+def read_profiles():
+    """{ name: { key: value } } for every section, re-read only when the file changes."""
+    try:
+        mtime = os.path.getmtime(MODAL_CONFIG_PATH)
+    except OSError:
+        return {}
+    if mtime == _profiles_cache['mtime']:
+        return _profiles_cache['profiles']
+
+    profiles = {}
+    current_section = None
+    with open(MODAL_CONFIG_PATH, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('[') and line.endswith(']'):
+                current_section = _unquote(line[1:-1])
+                profiles.setdefault(current_section, {})
+            elif current_section and '=' in line and not line.startswith('#'):
+                key, value = line.split('=', 1)
+                profiles[current_section][key.strip()] = _unquote(value)
+
+    _profiles_cache.update({'mtime': mtime, 'profiles': profiles})
+    return profiles
+
+
+def active_profile():
+    """Name of the profile marked `active = true`."""
+    for name, settings in read_profiles().items():
+        if settings.get('active') == 'true':
+            return name
+    return None
+
+
+def configured_profiles():
+    """Names of the profiles that have tokens; sections without them (e.g. a commented-out account) are skipped."""
+    profiles = []
+    for name in read_profiles():
+        try:
+            profile_credentials(name)
+            profiles.append(name)
+        except UnknownProfile:
+            pass
+    return profiles
+
+
+def profile_credentials(profile):
+    """(token_id, token_secret, environment) of a profile; UnknownProfile if it is not configured."""
+    settings = read_profiles().get(profile)
+    if not settings or not settings.get('token_id') or not settings.get('token_secret'):
+        raise UnknownProfile(f"Unknown Modal profile '{profile}'")
+    return settings['token_id'], settings['token_secret'], settings.get('environment')
+
+
+def profile_env(profile):
+    """
+    Environment that pins a `modal` subprocess to a profile regardless of the
+    active one. Empty for profile=None (the CLI then uses the active profile).
+    """
+    if not profile:
+        return {}
+    token_id, token_secret, environment = profile_credentials(profile)
+    env = {'MODAL_PROFILE': profile, 'MODAL_TOKEN_ID': token_id, 'MODAL_TOKEN_SECRET': token_secret}
+    if environment:
+        env['MODAL_ENVIRONMENT'] = environment
+    return env
+
+
+def check_profile(profile):
+    """Validate an explicit profile from a request. Returns it (None stays None)."""
+    if profile:
+        profile_credentials(profile)
+    return profile or None
@@ -0,0 +1,84 @@
+import collections
+import itertools
+import time
+
+# Session placement across workers.
+#
+# A policy receives the connected candidate workers (with their latest load
+# stats) plus the original request, and returns (worker_id, reason). New rules
+# (e.g. GPU-aware) only need a function registered with @register_policy.
+
+PLACEMENT_POLICIES = {}
+
+# Recent decisions, newest last (served by /api/placement/log)
+placement_log = collections.deque(maxlen=200)
+
+# Weights for the least-loaded score: one session ~ 25% CPU ~ 500 MB RSS ~ 100 ms RTT
+LOAD_WEIGHTS = {'sessions': 1.0, 'cpu_percent': 0.04, 'rss_mb': 0.002, 'rtt_ms': 0.01}
+
+
+def register_policy(name):
+    def decorator(f):
+        PLACEMENT_POLICIES[name] = f
+        return f
+    return decorator
+
+
+def load_score(candidate):
+    """Lower is better. CPU is normalised per core so big workers absorb more."""
+    stats = candidate.get('stats') or {}
+    cpu = stats.get('cpu_percent', 0) / max(stats.get('cpu_count', 1), 1)
+    return (LOAD_WEIGHTS['sessions'] * stats.get('sessions', 0) +
+            LOAD_WEIGHTS['cpu_percent'] * cpu +
+            LOAD_WEIGHTS['rss_mb'] * stats.get('rss_mb', 0) +
+            LOAD_WEIGHTS['rtt_ms'] * stats.get('rtt_ms', 0))
+
+
+_round_robin = itertools.count()
+
+@register_policy('any')
+def place_any(candidates, request):
+    """Round-robin over connected workers, ignoring load."""
+    chosen = candidates[next(_round_robin) % len(candidates)]
+    return chosen['worker_id'], 'round-robin'
+
+
+@register_policy('least-loaded')
+def place_least_loaded(candidates, request):
+    scored = sorted(candidates, key=load_score)
+    chosen = scored[0]
+    stats = chosen.get('stats') or {}
+    reason = (f"score={load_score(chosen):.2f} sessions={stats.get('sessions', 0)} "
+              f"cpu={stats.get('cpu_percent', 0)}% rss={stats.get('rss_mb', 0)}MB rtt={stats.get('rtt_ms', 0)}ms")
+    return chosen['worker_id'], reason
+
+
+def place(hint, candidates, request=None):
+    """
+    Pick a worker for a new session.
+
+    Args:
+        hint: Policy name ('any', 'least-loaded', ...).
+        candidates: [{ 'worker_id', 'name', 'status', 'stats': {...} }, ...]
+        request: The original create_session payload, for policies that need it.
+    Returns:
+        (worker_id, reason), or (None, reason) if nothing can be placed.
+    """
+    policy = PLACEMENT_POLICIES.get(hint)
+    if not policy:
+        return None, f"unknown placement policy '{hint}'"
+
+    connected = [c for c in candidates if c.get('status') == 'connected']
+    if not connected:
+        return None, 'no connected workers'
+
+    worker_id, reason = policy(connected, request or {})
+    placement_log.append({
+        'time': time.time(),
+        'policy': hint,
+        'worker_id': worker_id,
+        'reason': reason,
+        'candidates': {c['worker_id']: round(load_score(c), 3) for c in connected}
+    })
+    print(f"Placement [{hint}]: {worker_id} ({reason})")
+    return worker_id, reason
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Host modules are flat top-level modules (run from host/), so tests import them the same way
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
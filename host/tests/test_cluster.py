@@ -0,0 +1,77 @@
+import time
+
+import cluster as cluster_module
+from cluster import Cluster, LocalStore
+
+
+def make_pair():
+    """Two single-host Cluster instances sharing one LocalStore, like two processes on one Redis."""
+    a, b = Cluster(), Cluster()
+    b.store = a.store
+    b._delete_if, b._expire_if = a.store.delete_if, a.store.expire_if
+    return a, b
+
+
+def test_claim_is_exclusive():
+    a, b = make_pair()
+    assert a.claim('worker-1')
+    assert not b.claim('worker-1')
+    assert a.owner_of('worker-1') == a.process_id
+    assert 'worker-1' in a.owned and 'worker-1' not in b.owned
+
+
+def test_claim_again_extends_own_lease():
+    a, _ = make_pair()
+    assert a.claim('worker-1')
+    assert a.claim('worker-1')
+
+
+def test_release_frees_lease():
+    a, b = make_pair()
+    a.claim('worker-1')
+    a.release('worker-1')
+    assert a.owner_of('worker-1') is None
+    assert 'worker-1' not in a.owned
+    assert b.claim('worker-1')
+
+
+def test_release_does_not_drop_another_holders_lease():
+    a, b = make_pair()
+    a.claim('worker-1')
+    a.store.delete(a._key('owner', 'worker-1')) # a's lease expired ...
+    assert b.claim('worker-1')                  # ... and b took over
+    a.release('worker-1')
+    assert a.owner_of('worker-1') == b.process_id
+
+
+def test_expired_lease_can_be_claimed(monkeypatch):
+    a, b = make_pair()
+    monkeypatch.setattr(cluster_module, 'LEASE_TTL', 0.05)
+    a.claim('worker-1')
+    time.sleep(0.1)
+    assert b.claim('worker-1')
+    assert not a.claim('worker-1')
+    assert 'worker-1' not in a.owned
+
+
+def test_conditional_store_ops_check_holder():
+    store = LocalStore()
+    store.set('k', 'p1', ex=10)
+    assert store.expire_if('k', 'p2', 10) == 0
+    assert store.delete_if('k', 'p2') == 0
+    assert store.get('k') == 'p1'
+    assert store.expire_if('k', 'p1', 10) == 1
+    assert store.delete_if('k', 'p1') == 1
+    assert store.get('k') is None
+
+
+def test_interest_lapses_and_ignores_own_process(monkeypatch):
+    a, b = make_pair()
+    b.mark_interest('app-logs:x')
+    assert a.has_interest('app-logs:x')
+    assert not b.has_interest('app-logs:x')
+    b.drop_interest('app-logs:x')
+    assert not a.has_interest('app-logs:x')
+    b.mark_interest('app-logs:x')
+    monkeypatch.setattr(cluster_module, 'LEASE_TTL', 0)
+    assert not a.has_interest('app-logs:x')
@@ -0,0 +1,74 @@
+import pytest
+
+from modal_gateway import FakeBackend, ModalGateway, ModalGatewayError, NotFound
+
+
+@pytest.fixture
+def gateway():
+    return ModalGateway(FakeBackend({'models': {
+        'loras/a.safetensors': b'aaaa',
+        'loras/style/b.safetensors': b'bb',
+        'vae/v.pt': b'v',
+    }}))
+
+
+def paths(entries):
+    return [(e.path, e.type) for e in entries]
+
+
+def test_listdir_top_level(gateway):
+    assert paths(gateway.listdir('models', '/')) == [('loras', 'dir'), ('vae', 'dir')]
+
+
+def test_listdir_recursive(gateway):
+    assert paths(gateway.listdir('models', 'loras', recursive=True)) == [
+        ('loras/a.safetensors', 'file'), ('loras/style', 'dir'), ('loras/style/b.safetensors', 'file')]
+
+
+def test_listdir_missing_path(gateway):
+    with pytest.raises(NotFound):
+        gateway.listdir('models', 'nope')
+    with pytest.raises(NotFound):
+        gateway.listdir('missing-volume', '/')
+
+
+def test_stat_and_read(gateway):
+    entry = gateway.stat('models', '/loras/a.safetensors')
+    assert (entry.type, entry.size) == ('file', 4)
+    assert gateway.read_file('models', 'loras/a.safetensors') == b'aaaa'
+    assert b''.join(gateway.iter_file('models', 'loras/a.safetensors', start=1, end=2)) == b'aa'
+    with pytest.raises(ModalGatewayError):
+        gateway.stat('models', 'loras')
+
+
+def test_put_and_copy(gateway):
+    gateway.put_file('models', 'vae/new.pt', b'new')
+    gateway.copy_files('models', ['vae/new.pt', 'vae/v.pt'], 'backup/')
+    assert paths(gateway.listdir('models', 'backup')) == [('backup/new.pt', 'file'), ('backup/v.pt', 'file')]
+    gateway.copy_files('models', ['loras'], 'loras-copy', recursive=True)
+    assert gateway.read_file('models', 'loras-copy/style/b.safetensors') == b'bb'
+
+
+def test_copy_directory_needs_recursive(gateway):
+    with pytest.raises(ModalGatewayError):
+        gateway.copy_files('models', ['loras'], 'elsewhere')
+
+
+def test_remove(gateway):
+    gateway.remove_file('models', 'vae/v.pt')
+    with pytest.raises(NotFound):
+        gateway.read_file('models', 'vae/v.pt')
+    with pytest.raises(ModalGatewayError):
+        gateway.remove_file('models', 'loras')
+    gateway.remove_file('models', 'loras', recursive=True)
+    assert gateway.listdir('models', '/') == []
+
+
+def test_volume_lifecycle(gateway):
+    gateway.create_volume('scratch')
+    with pytest.raises(ModalGatewayError):
+        gateway.create_volume('scratch')
+    assert [v.name for v in gateway.list_volumes()] == ['models', 'scratch']
+    gateway.delete_volume('scratch')
+    with pytest.raises(NotFound):
+        gateway.delete_volume('scratch')
@@ -0,0 +1,49 @@
+import pytest
+
+import usage_sync
+from modal_gateway import FakeBackend, ModalGateway
+from wallet_store import WalletStore
+
+VOLUME = 'usage-volume'
+
+
+@pytest.fixture
+def wallets(tmp_path):
+    return WalletStore(str(tmp_path / 'wallets.db'), default_balance=10.0)
+
+
+@pytest.fixture
+def gateway():
+    return ModalGateway(FakeBackend({VOLUME: {}}))
+
+
+def session(session_id, status, cost):
+    return {'session_id': session_id, 'status': status, 'cost': cost, 'gpu_type': 'H100', 'duration_sec': 60}
+
+
+def test_reconcile_is_idempotent(wallets):
+    sessions = [session('s1', 'completed', 1.5), session('s2', 'running', 0.5)]
+    first = usage_sync.reconcile(wallets, 'acct', sessions)
+    assert first['new_sessions'] == 2
+    assert first['cost_deducted'] == 2.0
+    assert first['new_balance'] == 8.0
+
+    again = usage_sync.reconcile(wallets, 'acct', sessions)
+    assert again['new_sessions'] == 0
+    assert again['cost_deducted'] == 0
+    assert wallets.balance('acct') == 8.0
+    assert len(wallets.ledger('acct')) == 2
+
+
+def test_reconcile_charges_running_growth_once(wallets):
+    usage_sync.reconcile(wallets, 'acct', [session('s1', 'running', 0.5)])
+    usage_sync.reconcile(wallets, 'acct', [session('s1', 'running', 1.25)])
+    result = usage_sync.reconcile(wallets, 'acct', [session('s1', 'completed', 2.0)])
+    assert result['cost_deducted'] == 0.75
+    assert wallets.balance('acct') == 8.0
+    history = wallets.load('acct')['history']
+    assert [(h['session_id'], h['status']) for h in history] == [('s1', 'completed')]
+
+
+def test_sync_without_usage_file(gateway, wallets):
+    assert usage_sync.sync_account(gateway, wallets, 'acct', VOLUME)['synced'] is False
@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+import usage_sync
+from modal_gateway import FakeBackend, ModalGateway
+from wallet_store import WalletStore
+
+VOLUME = 'usage-volume'
+
+
+@pytest.fixture
+def wallets(tmp_path):
+    return WalletStore(str(tmp_path / 'wallets.db'), default_balance=10.0)
+
+
+@pytest.fixture
+def gateway():
+    return ModalGateway(FakeBackend({VOLUME: {}}))
+
+
+def session(session_id, status, cost, revision=None):
+    s = {'session_id': session_id, 'status': status, 'cost': cost, 'gpu_type': 'H100', 'duration_sec': 60}
+    if revision is not None:
+        s['revision'] = revision
+    return s
+
+
+def write_usage(gateway, account, sessions, epoch='e1', revision=None):
+    usage = {'sessions': sessions}
+    if revision is not None:
+        usage.update(epoch=epoch, revision=revision)
+        gateway.put_file(VOLUME, usage_sync.meta_path(account),
+                         json.dumps({'epoch': epoch, 'revision': revision}).encode())
+    gateway.put_file(VOLUME, usage_sync.usage_path(account), json.dumps(usage).encode())
+
+
+def test_sync_skips_download_when_revision_unchanged(gateway, wallets):
+    write_usage(gateway, 'acct', [session('s1', 'completed', 1.0, revision=1)], revision=1)
+    assert usage_sync.sync_account(gateway, wallets, 'acct', VOLUME)['cost_deducted'] == 1.0
+    assert wallets.cursor('acct', VOLUME) == ('e1', 1)
+
+    result = usage_sync.sync_account(gateway, wallets, 'acct', VOLUME)
+    assert result['unchanged'] is True
+    assert wallets.balance('acct') == 9.0
+
+
+def test_sync_applies_only_sessions_after_cursor(gateway, wallets):
+    write_usage(gateway, 'acct', [session('s1', 'completed', 1.0, revision=1)], revision=1)
+    usage_sync.sync_account(gateway, wallets, 'acct', VOLUME)
+
+    write_usage(gateway, 'acct', [session('s1', 'completed', 1.0, revision=1),
+                                  session('s2', 'completed', 2.0, revision=2)], revision=2)
+    result = usage_sync.sync_account(gateway, wallets, 'acct', VOLUME)
+    assert result['applied_sessions'] == 1
+    assert result['cost_deducted'] == 2.0
+    assert wallets.cursor('acct', VOLUME) == ('e1', 2)
+
+
+def test_sync_replays_whole_file_on_new_epoch(gateway, wallets):
+    write_usage(gateway, 'acct', [session('s1', 'completed', 1.0, revision=5)], revision=5)
+    usage_sync.sync_account(gateway, wallets, 'acct', VOLUME)
+
+    # Recreated file: revisions start over, already charged sessions stay charged
+    write_usage(gateway, 'acct', [session('s1', 'completed', 1.0, revision=1),
+                                  session('s3', 'completed', 0.5, revision=2)], epoch='e2', revision=2)
+    result = usage_sync.sync_account(gateway, wallets, 'acct', VOLUME)
+    assert result['applied_sessions'] == 2
+    assert result['cost_deducted'] == 0.5
+    assert wallets.balance('acct') == 8.5
+    assert wallets.cursor('acct', VOLUME) == ('e2', 2)
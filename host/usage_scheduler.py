@@ -0,0 +1,138 @@
+import eventlet
+from eventlet.event import Event
+import time
+
+from modal_profiles import configured_profiles
+import usage_sync
+
+# Host-side usage sync for every Modal account.
+#
+# Browsers used to POST /sync-usage every 30 seconds each, so N open
+# dashboards meant N usage-file downloads per account. Now one scheduler (the
+# holder of the cluster lease) syncs each account (= Modal profile name) on
+# its own cadence. Accounts with a running app in the AppRegistry sync every
+# FAST_INTERVAL; idle ones every IDLE_INTERVAL, plus one sync right after
+# their last app stops, to charge the completed sessions. Results are pushed
+# as `balance_updated` to the `balance:<account>` room, which browsers join
+# with `subscribe_balance`.
+
+FAST_INTERVAL = 30         # seconds between syncs while an app of the account runs
+IDLE_INTERVAL = 600        # seconds between syncs otherwise
+TICK = 5                   # how often due accounts are checked
+PARALLELISM = 4            # concurrent syncs (each reads from a Modal volume)
+LEASE = 'usage-sync-scheduler'
+
+
+def balance_room(account):
+    return f'balance:{account}'
+
+
+class UsageSyncScheduler:
+    def __init__(self, modal_gateway, wallets, app_registry, emit, cluster,
+                 volume_name=usage_sync.DEFAULT_VOLUME, fast_interval=FAST_INTERVAL, idle_interval=IDLE_INTERVAL):
+        """
+        Args:
+            modal_gateway: ModalGateway the usage files are read through.
+            wallets: WalletStore the usage is charged to.
+            app_registry: AppRegistry, to tell busy accounts from idle ones.
+            emit: Called as (event_name, data, room) to push balance_updated.
+            cluster: Cluster, for the scheduler lease.
+        """
+        self.modal_gateway = modal_gateway
+        self.wallets = wallets
+        self.app_registry = app_registry
+        self.emit = emit
+        self.cluster = cluster
+        self.volume_name = volume_name
+        self.fast_interval = fast_interval
+        self.idle_interval = idle_interval
+        self.accounts = {}   # { account: { 'last_sync', 'busy', 'result', 'error' } }
+        self.requested = set()
+        self.pool = eventlet.GreenPool(PARALLELISM)
+        self.wakeup = Event()
+        self.stats = {'syncs': 0, 'unchanged': 0, 'errors': 0, 'pushes': 0}
+
+    def start(self):
+        eventlet.spawn(self._loop)
+
+    def request_sync(self, account):
+        """
+        Sync an account now instead of at its interval (e.g. a manual refresh).
+        Processes without the lease sync it themselves; syncs are transactional
+        and idempotent, so one overlapping the scheduler's is harmless.
+        """
+        if LEASE not in self.cluster.owned:
+            self.pool.spawn_n(self.sync, account)
+            return
+        self.requested.add(account)
+        if not self.wakeup.ready():
+            self.wakeup.send()
+
+    # --- SCHEDULING ---
+
+    def _due(self, now):
+        due = []
+        for account in configured_profiles():
+            state = self.accounts.setdefault(account, {'last_sync': None, 'busy': False, 'result': None, 'error': None})
+            busy = self.app_registry.is_busy(account)
+            stopped = state['busy'] and not busy
+            state['busy'] = busy
+            interval = self.fast_interval if busy else self.idle_interval
+            if (account in self.requested or stopped or state['last_sync'] is None
+                    or now - state['last_sync'] >= interval):
+                due.append(account)
+        self.requested.clear()
+        return due
+
+    def _loop(self):
+        while True:
+            if self.cluster.claim(LEASE):
+                try:
+                    for account in self._due(time.time()):
+                        self.pool.spawn_n(self.sync, account)
+                    self.pool.waitall()
+                except Exception as e:
+                    print(f"UsageSyncScheduler: Tick failed: {e}")
+            with eventlet.Timeout(TICK, False):
+                self.wakeup.wait()
+            self.wakeup = Event()
+
+    def sync(self, account):
+        state = self.accounts.setdefault(account, {'last_sync': None, 'busy': False, 'result': None, 'error': None})
+        try:
+            result = usage_sync.sync_account(self.modal_gateway, self.wallets, account, self.volume_name,
+                                             profile=account)
+            state.update(last_sync=time.time(), result=result, error=None)
+            self.stats['syncs'] += 1
+            if result.get('unchanged'):
+                self.stats['unchanged'] += 1
+            elif result.get('synced'):
+                self.publish(account, result)
+        except Exception as e:
+            # Retry at the account's normal interval
+            print(f"UsageSyncScheduler: Sync of {account} failed: {e}")
+            state.update(last_sync=time.time(), error=str(e))
+            self.stats['errors'] += 1
+
+    # --- PUSH ---
+
+    def publish(self, account, sync_result=None):
+        """Push the account's current wallet to its subscribers."""
+        self.emit('balance_updated', self.payload(account, sync_result), room=balance_room(account))
+        self.stats['pushes'] += 1
+
+    def payload(self, account, sync_result=None):
+        wallet = self.wallets.load(account)
+        return {
+            'account': account,
+            'balance': wallet['balance'],
+            'last_synced_at': wallet['last_synced_at'],
+            'sync': sync_result,
+            'wallet': wallet
+        }
+
+    def get_stats(self):
+        return dict(self.stats, scheduler=LEASE in self.cluster.owned,
+                    accounts={a: {'last_sync': s['last_sync'], 'busy': s['busy'], 'error': s['error'],
+                                  'interval': self.fast_interval if s['busy'] else self.idle_interval}
+                              for a, s in self.accounts.items()})
@@ -0,0 +1,177 @@
+import json
+import time
+
+from modal_gateway import NotFound
+
+# Reconciles a VM usage file (usage/<account>.json on the volume, written by
+# modal-app-manager/images/usage_tracker.py) with the account's wallet.
+#
+# Shared by POST /sync-usage and the sync_usage socket handler. Per sync the
+# lookups are loaded once, keyed by session id, and only for the sessions the
+# file mentions: a set of those already charged and a dict of the open
+# `running` entries. Each session is then one hash lookup instead of a scan of
+# the whole history, so a sync costs O(sessions in the file) however long the
+# wallet history grows.
+#
+# Syncs are incremental. The tracker bumps a revision on every write and
+# mirrors it in usage/<account>.meta.json; the host keeps the last applied
+# (epoch, revision) per account and volume. A sync reads the small meta file
+# first and stops there when the revision has not moved. Otherwise it reads
+# the usage file and applies only sessions stamped after the cursor. A new
+# epoch or a revision behind the cursor (file recreated or cleaned) replays
+# the whole file, which is safe because reconcile() is idempotent. Usage files
+# without revisions (older trackers) are always applied in full.
+
+DEFAULT_VOLUME = 'jekverse-comfy-models'
+
+
+def usage_path(account_name):
+    return f"usage/{account_name}.json"
+
+
+def meta_path(account_name):
+    return f"usage/{account_name}.meta.json"
+
+
+def reconcile(wallets, account_name, sessions, cursor=None):
+    """
+    Charge new usage of `sessions` to the wallet in one transaction, one
+    volume_sync_debit ledger event per charged session. cursor=(volume, epoch,
+    revision) is stored in the same transaction.
+
+    Completed sessions are charged once (minus what their running entry already
+    charged); running ones are charged by how much their cost grew since the last sync.
+    Returns { 'new_sessions', 'cost_deducted', 'new_balance' }.
+    """
+    new_cost = 0
+    new_sessions = 0
+
+    with wallets.transaction():
+        balance = wallets.balance(account_name)
+        synced = wallets.synced_among(account_name, [s.get('session_id') for s in sessions])
+        running = wallets.running_entries(account_name)
+
+        for session in sessions:
+            session_id = session.get('session_id')
+            status = session.get('status', 'unknown')
+            cost = session.get('cost', 0)
+            charge = 0
+            entry_id = None
+
+            if status == 'completed':
+                if session_id in synced:
+                    continue
+
+                # Replace the running entry (if any) so the session is listed once,
+                # charging only what it had not charged yet
+                entry = running.pop(session_id, None)
+                if entry:
+                    charge = max(0, cost - entry['cost'])
+                    wallets.delete_history(entry['id'])
+                else:
+                    charge = cost
+                new_sessions += 1
+
+                entry_id = wallets.add_history(
+                    account_name, 'volume_sync',
+                    session_id=session_id,
+                    status='completed',
+                    gpu_type=session.get('gpu_type', 'Unknown'),
+                    start_time=session.get('start_time'),
+                    end_time=session.get('end_time'),
+                    duration_sec=session.get('duration_sec', 0),
+                    cost=cost
+                )
+                wallets.mark_synced(account_name, session_id)
+                synced.add(session_id)
+
+            elif status == 'running':
+                entry = running.get(session_id)
+                if entry:
+                    if cost > entry['cost']:
+                        charge = cost - entry['cost']
+                        entry_id = entry['id']
+                        wallets.update_history(entry_id,
+                                               end_time=session.get('end_time'),
+                                               duration_sec=session.get('duration_sec', 0),
+                                               cost=cost)
+                        entry['cost'] = cost
+                else:
+                    charge = cost
+                    new_sessions += 1
+                    entry_id = wallets.add_history(
+                        account_name, 'volume_sync',
+                        session_id=session_id,
+                        status='running',
+                        gpu_type=session.get('gpu_type', 'Unknown'),
+                        start_time=session.get('start_time'),
+                        end_time=session.get('end_time'),
+                        duration_sec=session.get('duration_sec', 0),
+                        cost=cost
+                    )
+                    running[session_id] = {'id': entry_id, 'cost': cost}
+
+            if charge > 0:
+                new_cost += charge
+                balance = wallets.debit(account_name, 'volume_sync_debit', charge,
+                                        session_id=session_id, history_id=entry_id)
+
+        wallets.update_account(account_name, last_synced_at=time.time())
+        if cursor:
+            wallets.set_cursor(account_name, *cursor)
+
+    return {
+        'new_sessions': new_sessions,
+        'cost_deducted': round(new_cost, 6),
+        'new_balance': round(balance, 4)
+    }
+
+
+def _read_json(modal_gateway, volume_name, path, profile):
+    return json.loads(modal_gateway.read_file(volume_name, path, profile=profile))
+
+
+def sync_account(modal_gateway, wallets, account_name, volume_name=DEFAULT_VOLUME, profile=None):
+    """
+    Apply what changed in the account's usage file since the last sync.
+    { 'synced': False, 'message', 'details' } if the VM has not written one yet;
+    'unchanged': True when the meta revision showed nothing new (file not downloaded).
+    """
+    epoch, revision = wallets.cursor(account_name, volume_name)
+
+    try:
+        meta = _read_json(modal_gateway, volume_name, meta_path(account_name), profile)
+    except NotFound:
+        meta = None # Tracker without revisions, or no usage yet
+    if meta and revision is not None and meta.get('epoch') == epoch and meta.get('revision') == revision:
+        return {
+            'synced': True,
+            'unchanged': True,
+            'new_sessions': 0,
+            'cost_deducted': 0,
+            'new_balance': round(wallets.balance(account_name), 4),
+            'revision': revision
+        }
+
+    try:
+        usage_data = _read_json(modal_gateway, volume_name, usage_path(account_name), profile)
+    except NotFound as e:
+        # File might not exist yet (no sessions recorded)
+        return {
+            'synced': False,
+            'message': 'No usage data found (VM may not have run yet)',
+            'details': str(e)
+        }
+
+    sessions = usage_data.get('sessions', [])
+    file_epoch, file_revision = usage_data.get('epoch'), usage_data.get('revision')
+    cursor = None
+    if file_revision is not None:
+        if file_epoch == epoch and revision is not None and file_revision >= revision:
+            # Only sessions written after the cursor (unstamped ones predate revisions; keep them)
+            sessions = [s for s in sessions if s.get('revision') is None or s['revision'] > revision]
+        cursor = (volume_name, file_epoch, file_revision)
+
+    result = reconcile(wallets, account_name, sessions, cursor=cursor)
+    return dict(result, synced=True, unchanged=False, total_sessions=len(usage_data.get('sessions', [])),
+                applied_sessions=len(sessions), revision=file_revision)
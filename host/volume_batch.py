@@ -0,0 +1,176 @@
+import eventlet
+import posixpath
+import time
+
+from modal_gateway import ModalGatewayError
+
+# Batch rm/mv/cp on one volume.
+#
+# Operations are planned into as few gateway calls as possible:
+#   - cp/mv items sharing a destination directory become one copy_files call
+#   - rm of a path whose ancestor is also removed recursively rides on that call
+#   - duplicate rm paths collapse into one call
+# Calls run on a bounded green pool in two phases: copies first (cp and the
+# copy half of mv), then removals (rm and the sources of mv that copied OK).
+# run() yields one result per input item as soon as it is known.
+
+BATCH_CONCURRENCY = 8
+MAX_BATCH_ITEMS = 1000
+OPS = ('rm', 'mv', 'cp')
+
+
+def _clean(path):
+    path = posixpath.normpath('/' + (path or '').lstrip('/')).rstrip('/')
+    return path or '/'
+
+
+def validate(items):
+    """Raise ValueError if items is not a list of well-formed operations."""
+    if not isinstance(items, list) or not items:
+        raise ValueError('operations must be a non-empty list')
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ValueError(f'at most {MAX_BATCH_ITEMS} operations per batch')
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or item.get('op') not in OPS:
+            raise ValueError(f"operation {i}: op must be one of {', '.join(OPS)}")
+        if not item.get('path') or _clean(item['path']) == '/':
+            raise ValueError(f'operation {i}: path required (and cannot be the volume root)')
+        if item['op'] != 'rm' and not item.get('dst'):
+            raise ValueError(f"operation {i}: dst required for {item['op']}")
+
+
+def plan(items):
+    """
+    Group items into calls. Returns (copies, removals, covered):
+        copies:   [ { 'dst', 'recursive', 'indexes': [...] } ]
+        removals: [ { 'path', 'recursive', 'indexes': [...] } ]  (rm items only; mv sources are added later)
+        covered:  { index: ancestor } for rm items folded into a recursive ancestor's removal
+    """
+    copy_groups = {}
+    copies = []
+    for i, item in enumerate(items):
+        if item['op'] == 'rm':
+            continue
+        recursive = bool(item.get('recursive'))
+        if item['dst'].endswith('/'):
+            key = (_clean(item['dst']), recursive)
+            if key not in copy_groups:
+                copy_groups[key] = {'dst': key[0] + '/', 'recursive': recursive, 'indexes': []}
+                copies.append(copy_groups[key])
+            copy_groups[key]['indexes'].append(i)
+        else:
+            # Copy onto an explicit name: can only be batched with itself
+            copies.append({'dst': _clean(item['dst']), 'recursive': recursive, 'indexes': [i]})
+
+    rm_groups = {}
+    for i, item in enumerate(items):
+        if item['op'] == 'rm':
+            path = _clean(item['path'])
+            group = rm_groups.setdefault(path, {'path': path, 'recursive': False, 'indexes': []})
+            group['recursive'] = group['recursive'] or bool(item.get('recursive'))
+            group['indexes'].append(i)
+
+    recursive_roots = {p for p, g in rm_groups.items() if g['recursive']}
+    removals, covered = [], {}
+    for path, group in sorted(rm_groups.items()):
+        # Sorted order visits ancestors first, so the outermost root is already in removals
+        ancestor = next((a for a in sorted(recursive_roots) if path.startswith(a + '/')), None)
+        if ancestor:
+            rm_groups[ancestor]['indexes'].extend(group['indexes'])
+            covered.update((i, ancestor) for i in group['indexes'])
+        else:
+            removals.append(group)
+    return copies, removals, covered
+
+
+class VolumeBatch:
+    def __init__(self, gateway, concurrency=BATCH_CONCURRENCY):
+        self.gateway = gateway
+        self.concurrency = concurrency
+
+    def run(self, volume, items, profile=None):
+        """
+        Generator of per-item results in completion order:
+            { 'index', 'op', 'path', 'dst'?, 'status': 'ok'|'error', 'error'?, 'covered_by'? }
+        followed by one summary { 'done': True, 'ok', 'failed', 'calls', 'duration_sec' }.
+        """
+        validate(items)
+        started = time.time()
+        copies, removals, covered = plan(items)
+        results = eventlet.queue.Queue()
+        calls = {'count': 0}
+        copied = set()
+
+        def report(index, status, **extra):
+            item = items[index]
+            result = {'index': index, 'op': item['op'], 'path': item['path'], 'status': status}
+            if item.get('dst'):
+                result['dst'] = item['dst']
+            if index in covered:
+                result['covered_by'] = covered[index]
+            result.update(extra)
+            results.put(result)
+
+        def call(fn, *args, **kwargs):
+            calls['count'] += 1
+            try:
+                fn(volume, *args, profile=profile, **kwargs)
+                return None
+            except ModalGatewayError as e:
+                return str(e)
+            except Exception as e:
+                print(f"VolumeBatch: {fn.__name__} on {volume} failed: {e}")
+                return str(e)
+
+        def run_copy(group):
+            srcs = [items[i]['path'] for i in group['indexes']]
+            error = call(self.gateway.copy_files, srcs, group['dst'], recursive=group['recursive'])
+            for i in group['indexes']:
+                if error:
+                    report(i, 'error', error=error)
+                elif items[i]['op'] == 'mv':
+                    copied.add(i) # Reported once the source is removed
+                else:
+                    report(i, 'ok')
+
+        def run_remove(path, recursive, indexes):
+            error = call(self.gateway.remove_file, path, recursive=recursive)
+            for i in indexes:
+                if error and items[i]['op'] == 'mv':
+                    report(i, 'error', error=f"copied, but removing source failed: {error}")
+                elif error:
+                    report(i, 'error', error=error)
+                else:
+                    report(i, 'ok')
+
+        def drive():
+            pool = eventlet.GreenPool(self.concurrency)
+            try:
+                for group in copies:
+                    pool.spawn_n(run_copy, group)
+                pool.waitall()
+
+                for group in removals:
+                    pool.spawn_n(run_remove, group['path'], group['recursive'], group['indexes'])
+                for i in sorted(copied):
+                    pool.spawn_n(run_remove, items[i]['path'], bool(items[i].get('recursive')), [i])
+                pool.waitall()
+            finally:
+                results.put(None)
+
+        eventlet.spawn_n(drive)
+
+        ok = failed = 0
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            if result['status'] == 'ok':
+                ok += 1
+            else:
+                failed += 1
+            yield result
+
+        print(f"VolumeBatch: {len(items)} operations on {volume} in {calls['count']} calls ({failed} failed)")
+        yield {'done': True, 'ok': ok, 'failed': failed, 'calls': calls['count'],
+               'duration_sec': round(time.time() - started, 3)}
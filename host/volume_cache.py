@@ -0,0 +1,107 @@
+import eventlet
+import posixpath
+import time
+
+from modal_profiles import active_profile
+
+# Per-profile cache of volume metadata and directory listings served by the
+# volume browser. Entries are refreshed in the background shortly before they
+# expire (and served stale while a refresh runs), and dropped explicitly when
+# our own endpoints or downloader runs mutate a volume.
+
+VOLUMES_TTL = 60       # seconds for the volume list
+LISTING_TTL = 30       # seconds for a directory listing
+REFRESH_AHEAD = 0.8    # refresh in background once an entry is this far into its TTL
+MAX_STALE = 5          # serve stale entries up to MAX_STALE * ttl while refreshing
+
+
+def _dir(path):
+    return posixpath.normpath('/' + (path or '').lstrip('/')).rstrip('/') or '/'
+
+
+class VolumeCache:
+    def __init__(self, gateway, volumes_ttl=VOLUMES_TTL, listing_ttl=LISTING_TTL):
+        self.gateway = gateway
+        self.volumes_ttl = volumes_ttl
+        self.listing_ttl = listing_ttl
+        self.entries = {} # { key: { 'value', 'fetched_at', 'ttl', 'refreshing' } }
+        self.stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'invalidations': 0, 'errors': 0}
+
+    def _get(self, key, fetch, ttl, force=False):
+        entry = self.entries.get(key)
+        age = time.time() - entry['fetched_at'] if entry else None
+
+        if entry and not force:
+            if age < ttl:
+                self.stats['hits'] += 1
+                if age > ttl * REFRESH_AHEAD:
+                    self._refresh_async(key, fetch)
+                return entry['value']
+            if age < ttl * MAX_STALE:
+                self.stats['stale_hits'] += 1
+                self._refresh_async(key, fetch)
+                return entry['value']
+
+        self.stats['misses'] += 1
+        value = fetch()
+        self.entries[key] = {'value': value, 'fetched_at': time.time(), 'ttl': ttl, 'refreshing': False}
+        return value
+
+    def _refresh_async(self, key, fetch):
+        entry = self.entries[key]
+        if entry['refreshing']:
+            return
+        entry['refreshing'] = True
+
+        def refresh():
+            try:
+                value = fetch()
+                # Skip if invalidated while we were fetching
+                if self.entries.get(key) is entry:
+                    self.entries[key] = {'value': value, 'fetched_at': time.time(), 'ttl': entry['ttl'], 'refreshing': False}
+                    self.stats['refreshes'] += 1
+            except Exception as e:
+                self.stats['errors'] += 1
+                entry['refreshing'] = False
+                print(f"VolumeCache: Background refresh of {key} failed: {e}")
+        eventlet.spawn_n(refresh)
+
+    # --- READS ---
+
+    def list_volumes(self, profile=None, force=False):
+        profile = profile or active_profile()
+        return self._get((profile, 'volumes'), lambda: self.gateway.list_volumes(profile=profile), self.volumes_ttl, force)
+
+    def listdir(self, volume, path='/', profile=None, force=False):
+        profile = profile or active_profile()
+        key = (profile, 'ls', volume, _dir(path))
+        return self._get(key, lambda: self.gateway.listdir(volume, path, profile=profile), self.listing_ttl, force)
+
+    # --- INVALIDATION ---
+
+    def invalidate_volumes(self, profile=None):
+        profile = profile or active_profile()
+        self.entries.pop((profile, 'volumes'), None)
+        self.stats['invalidations'] += 1
+
+    def invalidate_volume(self, volume, path=None, profile=None):
+        """
+        Drop cached listings of a volume. With a path, only listings that can
+        show it (its ancestors and anything below it) are dropped.
+        """
+        profile = profile or active_profile()
+        target = _dir(path) if path else None
+        for key in list(self.entries):
+            if key[0] != profile or key[1] != 'ls' or key[2] != volume:
+                continue
+            listed = key[3]
+            if target is None or target == listed or target.startswith(listed.rstrip('/') + '/') \
+                    or listed.startswith(target.rstrip('/') + '/'):
+                del self.entries[key]
+        self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        lookups = self.stats['hits'] + self.stats['stale_hits'] + self.stats['misses']
+        return dict(self.stats,
+                    entries=len(self.entries),
+                    hit_ratio=round((self.stats['hits'] + self.stats['stale_hits']) / lookups, 3) if lookups else None)
@@ -0,0 +1,289 @@
+import eventlet
+import posixpath
+import sqlite3
+import time
+
+from modal_profiles import active_profile
+
+# Local index of a volume's full file tree, for browsing large model stores.
+#
+# The first request scans the volume recursively once and persists every entry
+# to SQLite. Later refreshes list the top INCREMENTAL_DEPTH levels of the tree
+# non-recursively, and below that descend only into directories whose mtime or
+# child list changed, comparing them level by level. A change deep below a
+# directory whose own mtime and children stayed the same is therefore missed
+# until the next full rescan (every FULL_RESCAN_INTERVAL, or on the next query
+# after mark_stale). Listings are served from the index: paginated, sorted and
+# filtered by extension, size or name prefix.
+
+REFRESH_INTERVAL = 300        # seconds before an index is refreshed in the background
+FULL_RESCAN_INTERVAL = 6 * 3600
+INCREMENTAL_DEPTH = 2         # e.g. /models/loras is compared, its contents rescanned on change
+MAX_PAGE_SIZE = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    profile TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    ext TEXT NOT NULL,
+    PRIMARY KEY (profile, volume, path)
+);
+CREATE INDEX IF NOT EXISTS idx_entries_parent ON entries (profile, volume, parent);
+CREATE INDEX IF NOT EXISTS idx_entries_ext ON entries (profile, volume, ext);
+CREATE TABLE IF NOT EXISTS scans (
+    profile TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    refreshed_at REAL NOT NULL,
+    full_scan_at REAL NOT NULL,
+    PRIMARY KEY (profile, volume)
+);
+"""
+
+SORT_COLUMNS = {'name': 'name', 'size': 'size', 'mtime': 'mtime', 'path': 'path'}
+
+
+def _clean(path):
+    """Index paths have no leading/trailing slash; '' is the volume root."""
+    path = posixpath.normpath('/' + (path or '')).strip('/')
+    return '' if path == '.' else path
+
+
+def resolve_profile(profile):
+    """Profile an index row is keyed by; '' when no profile is configured (environment credentials)."""
+    return profile or active_profile() or ''
+
+
+def _row(profile, volume, entry):
+    path = _clean(entry.path)
+    name = posixpath.basename(path)
+    ext = posixpath.splitext(name)[1].lower().lstrip('.') if entry.type == 'file' else ''
+    return (profile, volume, path, posixpath.dirname(path), name, entry.type, entry.size or 0, entry.mtime or 0, ext)
+
+
+class VolumeIndex:
+    def __init__(self, gateway, db_path):
+        self.gateway = gateway
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        self.refreshing = set() # { (profile, volume) }
+
+    # --- SCANNING ---
+
+    def _replace_subtree(self, profile, volume, prefix, entries):
+        """Swap every indexed entry under prefix ('' = whole volume) for entries, atomically."""
+        rows = [_row(profile, volume, e) for e in entries]
+        self.conn.execute('BEGIN')
+        try:
+            if prefix:
+                self.conn.execute(
+                    'DELETE FROM entries WHERE profile = ? AND volume = ? AND (path = ? OR path LIKE ? ESCAPE \'\\\')',
+                    (profile, volume, prefix, _like_prefix(prefix)))
+            else:
+                self.conn.execute('DELETE FROM entries WHERE profile = ? AND volume = ?', (profile, volume))
+            self.conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def _mark_scanned(self, profile, volume, full):
+        now = time.time()
+        self.conn.execute(
+            'INSERT INTO scans (profile, volume, refreshed_at, full_scan_at) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (profile, volume) DO UPDATE SET refreshed_at = excluded.refreshed_at'
+            + (', full_scan_at = excluded.full_scan_at' if full else ''),
+            (profile, volume, now, now))
+
+    def full_scan(self, volume, profile=None):
+        profile = resolve_profile(profile)
+        started = time.time()
+        entries = self.gateway.listdir(volume, '/', recursive=True, profile=profile)
+        self._replace_subtree(profile, volume, '', entries)
+        self._mark_scanned(profile, volume, full=True)
+        print(f"VolumeIndex: Full scan of {volume} ({len(entries)} entries) in {time.time() - started:.1f}s")
+        return len(entries)
+
+    def refresh(self, volume, profile=None):
+        """Incremental refresh: descend only into directories that changed."""
+        profile = resolve_profile(profile)
+        started = time.time()
+        rescanned = []
+
+        def walk(path, depth, listed=None):
+            if listed is None:
+                listed = self.gateway.listdir(volume, path or '/', profile=profile)
+            known = {row['path']: row for row in self.conn.execute(
+                'SELECT path, type, size, mtime FROM entries WHERE profile = ? AND volume = ? AND parent = ?',
+                (profile, volume, path))}
+            current = {_clean(e.path): e for e in listed}
+
+            # Entries that disappeared at this level (with everything below them)
+            for gone in set(known) - set(current):
+                self._replace_subtree(profile, volume, gone, [])
+
+            for p, entry in current.items():
+                old = known.get(p)
+                if entry.type == 'file':
+                    if not old or old['size'] != entry.size or old['mtime'] != entry.mtime:
+                        self._replace_subtree(profile, volume, p, [entry])
+                elif not old:
+                    subtree = self.gateway.listdir(volume, p, recursive=True, profile=profile)
+                    self._replace_subtree(profile, volume, p, [entry] + subtree)
+                    rescanned.append(p)
+                elif depth < INCREMENTAL_DEPTH:
+                    self._upsert(profile, volume, entry)
+                    walk(p, depth + 1)
+                else:
+                    children = self.gateway.listdir(volume, p, profile=profile)
+                    if old['mtime'] != entry.mtime or \
+                            self._child_names(profile, volume, p) != {_clean(e.path) for e in children}:
+                        self._upsert(profile, volume, entry)
+                        walk(p, depth + 1, children)
+                        rescanned.append(p)
+
+        walk('', 1)
+        self._mark_scanned(profile, volume, full=False)
+        print(f"VolumeIndex: Refreshed {volume} in {time.time() - started:.1f}s (rescanned: {rescanned or 'none'})")
+        return rescanned
+
+    def _upsert(self, profile, volume, entry):
+        self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', _row(profile, volume, entry))
+
+    def _child_names(self, profile, volume, path):
+        return {row['path'] for row in self.conn.execute(
+            'SELECT path FROM entries WHERE profile = ? AND volume = ? AND parent = ?', (profile, volume, path))}
+
+    def scan_info(self, volume, profile=None):
+        row = self.conn.execute('SELECT * FROM scans WHERE profile = ? AND volume = ?',
+                                (resolve_profile(profile), volume)).fetchone()
+        return dict(row) if row else None
+
+    def ensure_fresh(self, volume, profile=None):
+        """
+        Full scan synchronously if the volume was never indexed; otherwise start a
+        background refresh (incremental, or full once FULL_RESCAN_INTERVAL passed) when due.
+        """
+        profile = resolve_profile(profile)
+        info = self.scan_info(volume, profile)
+        if not info:
+            self.full_scan(volume, profile)
+            return
+
+        now = time.time()
+        key = (profile, volume)
+        if now - info['refreshed_at'] < REFRESH_INTERVAL or key in self.refreshing:
+            return
+
+        full = now - info['full_scan_at'] > FULL_RESCAN_INTERVAL
+        self.refreshing.add(key)
+
+        def run():
+            try:
+                if full:
+                    self.full_scan(volume, profile)
+                else:
+                    self.refresh(volume, profile)
+            except Exception as e:
+                print(f"VolumeIndex: Background refresh of {volume} failed: {e}")
+            finally:
+                self.refreshing.discard(key)
+        eventlet.spawn_n(run)
+
+    # --- MUTATIONS FROM OUR OWN ENDPOINTS ---
+
+    def mark_stale(self, volume, profile=None):
+        """
+        Rescan fully on the next query, e.g. after a downloader run wrote to the
+        volume (possibly below the depth an incremental refresh compares).
+        """
+        self.conn.execute('UPDATE scans SET refreshed_at = 0, full_scan_at = 0 WHERE profile = ? AND volume = ?',
+                          (resolve_profile(profile), volume))
+
+    def remove_path(self, volume, path, profile=None):
+        self._replace_subtree(resolve_profile(profile), volume, _clean(path), [])
+
+    def drop_volume(self, volume, profile=None):
+        profile = resolve_profile(profile)
+        self._replace_subtree(profile, volume, '', [])
+        self.conn.execute('DELETE FROM scans WHERE profile = ? AND volume = ?', (profile, volume))
+
+    # --- QUERIES ---
+
+    def query(self, volume, path='/', recursive=False, ext=None, name_prefix=None, min_size=None, max_size=None,
+              entry_type=None, sort='name', order='asc', page=1, page_size=100, profile=None):
+        """
+        Returns { 'entries': [...], 'total', 'page', 'page_size' } for one page of
+        a directory (or, with recursive, of everything below it).
+        """
+        profile = resolve_profile(profile)
+        base = _clean(path)
+        clauses = ['profile = ?', 'volume = ?']
+        params = [profile, volume]
+
+        if recursive:
+            if base:
+                clauses.append("path LIKE ? ESCAPE '\\'")
+                params.append(_like_prefix(base))
+        else:
+            clauses.append('parent = ?')
+            params.append(base)
+        if ext:
+            exts = [e.lower().lstrip('.') for e in (ext if isinstance(ext, list) else ext.split(','))]
+            clauses.append(f"ext IN ({','.join('?' * len(exts))})")
+            params.extend(exts)
+        if name_prefix:
+            clauses.append("name LIKE ? ESCAPE '\\'")
+            params.append(_escape_like(name_prefix) + '%')
+        if min_size is not None:
+            clauses.append('size >= ?')
+            params.append(int(min_size))
+        if max_size is not None:
+            clauses.append('size <= ?')
+            params.append(int(max_size))
+        if entry_type:
+            clauses.append('type = ?')
+            params.append(entry_type)
+
+        where = ' AND '.join(clauses)
+        column = SORT_COLUMNS.get(sort, 'name')
+        direction = 'DESC' if order == 'desc' else 'ASC'
+        page = max(int(page), 1)
+        page_size = min(max(int(page_size), 1), MAX_PAGE_SIZE)
+
+        total = self.conn.execute(f'SELECT COUNT(*) FROM entries WHERE {where}', params).fetchone()[0]
+        rows = self.conn.execute(
+            # Directories first, like the volume browser
+            f"SELECT path, name, type, size, mtime, ext FROM entries WHERE {where} "
+            f"ORDER BY type = 'file', {column} {direction}, path LIMIT ? OFFSET ?",
+            params + [page_size, (page - 1) * page_size])
+
+        return {
+            'entries': [dict(row) for row in rows],
+            'total': total,
+            'page': page,
+            'page_size': page_size
+        }
+
+
+    def files(self, volume, profile=None):
+        """Every indexed file as { 'path', 'size', 'mtime' }, for whole-volume analysis."""
+        rows = self.conn.execute(
+            "SELECT path, size, mtime FROM entries WHERE profile = ? AND volume = ? AND type = 'file'",
+            (resolve_profile(profile), volume))
+        return [dict(row) for row in rows]
+
+
+def _escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _like_prefix(path):
+    return _escape_like(path) + '/%'
@@ -0,0 +1,207 @@
+import collections
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+# Browser <-> volume file transfers streamed through the host.
+#
+# Downloads stream gateway chunks straight into the HTTP response (with Range
+# support, so browsers and download managers can resume). Uploads are split
+# into fixed-size parts the browser may send in parallel; each part is written
+# at its offset in a spool file on local disk, and the completed file is
+# handed to the gateway from disk. Neither direction holds a whole file in
+# memory. Every transfer records bytes moved and throughput.
+
+PART_SIZE = 64 * 1024 * 1024
+MIN_PART_SIZE = 1024 * 1024
+READ_CHUNK = 1024 * 1024
+UPLOAD_TTL = 3600            # seconds an unfinished upload is kept before its spool is deleted
+RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class TransferError(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range `Range` header against a file size.
+    Returns (start, end) inclusive, None when there is no usable header,
+    or raises TransferError if the range is unsatisfiable.
+    """
+    match = RANGE_HEADER.match((header or '').strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        # Suffix range: last N bytes
+        length = int(last)
+        if length == 0:
+            raise TransferError('Range not satisfiable')
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise TransferError('Range not satisfiable')
+    return start, end
+
+
+class TransferTracker:
+    def __init__(self, history=50):
+        self.active = {} # { transfer_id: transfer }
+        self.finished = collections.deque(maxlen=history)
+
+    def begin(self, direction, volume, path, total=None, transfer_id=None):
+        transfer = {
+            'id': transfer_id or uuid.uuid4().hex[:12],
+            'direction': direction,
+            'volume': volume,
+            'path': path,
+            'total': total,
+            'bytes': 0,
+            'started_at': time.time(),
+            'finished_at': None,
+            'status': 'running'
+        }
+        self.active[transfer['id']] = transfer
+        return transfer
+
+    def progress(self, transfer, nbytes):
+        transfer['bytes'] += nbytes
+
+    def finish(self, transfer, status='done', error=None):
+        transfer['finished_at'] = time.time()
+        transfer['status'] = status
+        if error:
+            transfer['error'] = error
+        self.active.pop(transfer['id'], None)
+        self.finished.appendleft(transfer)
+        summary = self.describe(transfer)
+        print(f"Transfer: {transfer['direction']} {transfer['volume']}:{transfer['path']} {status} "
+              f"({summary['bytes']} bytes in {summary['duration_sec']}s, {summary['mb_per_sec']} MB/s)")
+
+    def describe(self, transfer):
+        duration = (transfer['finished_at'] or time.time()) - transfer['started_at']
+        return {
+            **transfer,
+            'duration_sec': round(duration, 3),
+            'mb_per_sec': round(transfer['bytes'] / duration / 1e6, 2) if duration > 0 else None
+        }
+
+    def list(self):
+        return {
+            'active': [self.describe(t) for t in self.active.values()],
+            'recent': [self.describe(t) for t in self.finished]
+        }
+
+
+class UploadManager:
+    def __init__(self, gateway, tracker, spool_dir=None, part_size=PART_SIZE):
+        self.gateway = gateway
+        self.tracker = tracker
+        self.part_size = part_size
+        self.spool_dir = spool_dir or os.path.join(tempfile.gettempdir(), 'mwebui-uploads')
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.uploads = {} # { upload_id: { 'volume', 'path', 'profile', 'size', 'part_size', 'parts', 'received', 'spool', 'transfer', 'touched_at' } }
+
+    def _sweep(self):
+        now = time.time()
+        for upload_id, upload in list(self.uploads.items()):
+            if now - upload['touched_at'] > UPLOAD_TTL:
+                print(f"Transfer: Expiring unfinished upload {upload_id} ({upload['volume']}:{upload['path']})")
+                self.abort(upload_id, status='expired')
+
+    def start(self, volume, path, size, part_size=None, profile=None):
+        """Reserve a spool file. Returns the upload descriptor the browser needs to send parts."""
+        self._sweep()
+        size = int(size)
+        if size < 0:
+            raise TransferError('size must be >= 0')
+        part_size = max(int(part_size or self.part_size), MIN_PART_SIZE)
+        parts = max((size + part_size - 1) // part_size, 1)
+
+        if shutil.disk_usage(self.spool_dir).free < size:
+            raise TransferError('Not enough free disk space to spool this upload')
+
+        transfer = self.tracker.begin('upload', volume, path, total=size)
+        spool = os.path.join(self.spool_dir, transfer['id'])
+        with open(spool, 'wb') as f:
+            f.truncate(size)
+        self.uploads[transfer['id']] = {
+            'volume': volume,
+            'path': path,
+            'profile': profile,
+            'size': size,
+            'part_size': part_size,
+            'parts': parts,
+            'received': set(),
+            'spool': spool,
+            'transfer': transfer,
+            'touched_at': time.time()
+        }
+        return {'upload_id': transfer['id'], 'part_size': part_size, 'parts': parts}
+
+    def _get(self, upload_id):
+        upload = self.uploads.get(upload_id)
+        if not upload:
+            raise TransferError(f"Unknown upload '{upload_id}'")
+        return upload
+
+    def write_part(self, upload_id, index, stream):
+        """Copy one part from a file-like request stream into its slot in the spool file."""
+        upload = self._get(upload_id)
+        index = int(index)
+        if not 0 <= index < upload['parts']:
+            raise TransferError(f'part index must be in [0, {upload["parts"]})')
+        offset = index * upload['part_size']
+        expected = min(upload['part_size'], upload['size'] - offset)
+
+        written = 0
+        with open(upload['spool'], 'r+b') as f:
+            f.seek(offset)
+            while written < expected:
+                chunk = stream.read(min(READ_CHUNK, expected - written))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+                upload['touched_at'] = time.time()
+                self.tracker.progress(upload['transfer'], len(chunk))
+        if written != expected:
+            raise TransferError(f'part {index}: expected {expected} bytes, got {written}')
+
+        upload['received'].add(index)
+        return {'part': index, 'bytes': written, 'received': len(upload['received']), 'parts': upload['parts']}
+
+    def complete(self, upload_id):
+        """Push the assembled spool file to the volume once every part has arrived."""
+        upload = self._get(upload_id)
+        missing = sorted(set(range(upload['parts'])) - upload['received'])
+        if missing:
+            raise TransferError(f'missing parts: {missing[:20]}')
+
+        del self.uploads[upload_id]
+        transfer = upload['transfer']
+        try:
+            self.gateway.put_local_file(upload['volume'], upload['spool'], upload['path'], profile=upload['profile'])
+            self.tracker.finish(transfer)
+        except Exception as e:
+            self.tracker.finish(transfer, status='failed', error=str(e))
+            raise
+        finally:
+            os.remove(upload['spool'])
+        return self.tracker.describe(transfer)
+
+    def abort(self, upload_id, status='aborted'):
+        upload = self.uploads.pop(upload_id, None)
+        if not upload:
+            return False
+        self.tracker.finish(upload['transfer'], status=status)
+        try:
+            os.remove(upload['spool'])
+        except OSError:
+            pass
+        return True
@@ -0,0 +1,246 @@
+import eventlet
+import hashlib
+import time
+
+from volume_index import resolve_profile
+
+# Disk-usage analysis for a volume, built on top of VolumeIndex.
+#
+# Sizes come from the index (no extra Modal calls), rolled up per folder into a
+# treemap tree. Known model folders (see _prepare_directories in
+# restore_model/downloader_base.py) are always reported, even when empty.
+# Duplicates are found in three passes: same size, then same hash of the
+# first PARTIAL_BYTES, then same full hash. Hashes are stored per
+# (path, size, mtime), so re-analysis only reads files that changed; rows of
+# files no longer in the index are dropped on each analysis.
+
+MODEL_FOLDERS = [
+    "checkpoints", "configs", "vae", "loras", "upscale_models",
+    "embeddings", "controlnet", "clip", "clip_vision",
+    "text_encoders", "diffusion_models", "unet", "audio_encoders"
+]
+MODELS_ROOT = 'models'
+MIN_DUPLICATE_SIZE = 1024 * 1024   # smaller files are not worth hashing
+PARTIAL_BYTES = 1024 * 1024
+HASH_CONCURRENCY = 2
+TREEMAP_DEPTH = 3
+TREEMAP_TOP = 30                   # children kept per node; the rest are merged into '(other)'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+    profile TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    partial_hash TEXT,
+    full_hash TEXT,
+    PRIMARY KEY (profile, volume, path)
+);
+"""
+
+
+def build_tree(files):
+    """Nested { name, path, size, files, children: {name: node} } from flat index rows."""
+    root = {'name': '/', 'path': '', 'size': 0, 'files': 0, 'children': {}}
+    models = root['children'].setdefault(MODELS_ROOT, {'name': MODELS_ROOT, 'path': MODELS_ROOT, 'size': 0, 'files': 0, 'children': {}})
+    for folder in MODEL_FOLDERS:
+        path = f'{MODELS_ROOT}/{folder}'
+        models['children'].setdefault(folder, {'name': folder, 'path': path, 'size': 0, 'files': 0, 'children': {}})
+
+    for f in files:
+        parts = f['path'].split('/')
+        node = root
+        node['size'] += f['size']
+        node['files'] += 1
+        for depth, part in enumerate(parts[:-1]):
+            node = node['children'].setdefault(part, {
+                'name': part, 'path': '/'.join(parts[:depth + 1]), 'size': 0, 'files': 0, 'children': {}
+            })
+            node['size'] += f['size']
+            node['files'] += 1
+    return root
+
+
+def to_treemap(node, depth=TREEMAP_DEPTH, top=TREEMAP_TOP):
+    """Treemap payload: children sorted by size, truncated by depth and top-N."""
+    out = {'name': node['name'], 'path': node['path'], 'size': node['size'], 'files': node['files']}
+    children = sorted(node['children'].values(), key=lambda n: n['size'], reverse=True)
+    if depth <= 0 or not children:
+        return out
+
+    kept, rest = children[:top], children[top:]
+    out['children'] = [to_treemap(child, depth - 1, top) for child in kept]
+    loose = node['size'] - sum(c['size'] for c in children) # files directly in this folder
+    if rest or loose:
+        out['children'].append({
+            'name': '(other)',
+            'path': node['path'],
+            'size': loose + sum(c['size'] for c in rest),
+            'files': node['files'] - sum(c['files'] for c in kept)
+        })
+    return out
+
+
+class VolumeUsage:
+    def __init__(self, index, gateway):
+        self.index = index
+        self.gateway = gateway
+        self.conn = index.conn
+        self.conn.executescript(SCHEMA)
+        self.reports = {} # { (profile, volume): { 'status', 'report', 'computed_at', 'error' } }
+
+    # --- HASHING ---
+
+    def _hash(self, profile, volume, path, end=None):
+        digest = hashlib.sha256()
+        for chunk in self.gateway.iter_file(volume, path, end=end, profile=profile):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def _known_hashes(self, profile, volume):
+        rows = self.conn.execute('SELECT * FROM file_hashes WHERE profile = ? AND volume = ?', (profile, volume))
+        return {row['path']: dict(row) for row in rows}
+
+    def _store_hash(self, profile, volume, f, partial=None, full=None):
+        self.conn.execute(
+            'INSERT INTO file_hashes (profile, volume, path, size, mtime, partial_hash, full_hash) VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (profile, volume, path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, '
+            'partial_hash = COALESCE(excluded.partial_hash, file_hashes.partial_hash), '
+            'full_hash = COALESCE(excluded.full_hash, file_hashes.full_hash)',
+            (profile, volume, f['path'], f['size'], f['mtime'], partial, full))
+
+    def _prune_hashes(self, profile, volume, paths):
+        """Drop stored hashes of files that are no longer on the volume."""
+        gone = [(profile, volume, path) for path in self._known_hashes(profile, volume) if path not in paths]
+        self.conn.executemany('DELETE FROM file_hashes WHERE profile = ? AND volume = ? AND path = ?', gone)
+        return len(gone)
+
+    def _hash_pass(self, profile, volume, files, known, column, end):
+        """Fill `column` for every file lacking a current one. Returns { path: hash }."""
+        hashes = {}
+        todo = []
+        for f in files:
+            cached = known.get(f['path'])
+            if cached and cached['size'] == f['size'] and cached['mtime'] == f['mtime'] and cached[column]:
+                hashes[f['path']] = cached[column]
+            else:
+                if cached and (cached['size'] != f['size'] or cached['mtime'] != f['mtime']):
+                    known.pop(f['path']) # Stale: the other hash column is no longer valid either
+                    self.conn.execute('DELETE FROM file_hashes WHERE profile = ? AND volume = ? AND path = ?',
+                                      (profile, volume, f['path']))
+                todo.append(f)
+
+        def work(f):
+            try:
+                value = self._hash(profile, volume, f['path'], end=end)
+            except Exception as e:
+                print(f"VolumeUsage: Failed to hash {volume}:{f['path']}: {e}")
+                return
+            hashes[f['path']] = value
+            if column == 'partial_hash':
+                self._store_hash(profile, volume, f, partial=value)
+            else:
+                self._store_hash(profile, volume, f, full=value)
+
+        pool = eventlet.GreenPool(HASH_CONCURRENCY)
+        for f in todo:
+            pool.spawn_n(work, f)
+        pool.waitall()
+        return hashes, len(todo)
+
+    def find_duplicates(self, volume, files, profile):
+        by_size = {}
+        for f in files:
+            if f['size'] >= MIN_DUPLICATE_SIZE:
+                by_size.setdefault(f['size'], []).append(f)
+        candidates = [f for group in by_size.values() if len(group) > 1 for f in group]
+
+        known = self._known_hashes(profile, volume)
+        partial, partial_reads = self._hash_pass(profile, volume, candidates, known, 'partial_hash', PARTIAL_BYTES - 1)
+
+        by_partial = {}
+        for f in candidates:
+            if f['path'] in partial:
+                by_partial.setdefault((f['size'], partial[f['path']]), []).append(f)
+        suspects = [f for group in by_partial.values() if len(group) > 1 for f in group]
+
+        full, full_reads = self._hash_pass(profile, volume, suspects, known, 'full_hash', None)
+
+        groups = {}
+        for f in suspects:
+            if f['path'] in full:
+                groups.setdefault((f['size'], full[f['path']]), []).append(f['path'])
+        duplicates = [
+            {'size': size, 'hash': digest, 'paths': sorted(paths), 'wasted_bytes': size * (len(paths) - 1)}
+            for (size, digest), paths in groups.items() if len(paths) > 1
+        ]
+        duplicates.sort(key=lambda d: d['wasted_bytes'], reverse=True)
+        return duplicates, {'size_candidates': len(candidates), 'partial_reads': partial_reads, 'full_reads': full_reads}
+
+    # --- REPORTS ---
+
+    def analyze(self, volume, profile=None):
+        profile = resolve_profile(profile)
+        started = time.time()
+        info = self.index.scan_info(volume, profile)
+        if info and info['refreshed_at'] == 0:
+            self.index.full_scan(volume, profile) # Marked stale: a report on the old index would be outdated at once
+        else:
+            self.index.ensure_fresh(volume, profile)
+        files = self.index.files(volume, profile)
+        self._prune_hashes(profile, volume, {f['path'] for f in files})
+
+        tree = build_tree(files)
+        models = tree['children'][MODELS_ROOT]
+        folders = {name: {'size': node['size'], 'files': node['files']} for name, node in models['children'].items()}
+        for name, node in tree['children'].items():
+            if name != MODELS_ROOT:
+                folders[name] = {'size': node['size'], 'files': node['files']}
+
+        duplicates, hashing = self.find_duplicates(volume, files, profile)
+        report = {
+            'volume': volume,
+            'total_size': tree['size'],
+            'total_files': tree['files'],
+            'folders': folders,
+            'treemap': to_treemap(tree),
+            'duplicates': duplicates,
+            'duplicate_wasted_bytes': sum(d['wasted_bytes'] for d in duplicates),
+            'hashing': hashing,
+            'indexed_at': (self.index.scan_info(volume, profile) or {}).get('refreshed_at'),
+            'duration_sec': round(time.time() - started, 3)
+        }
+        print(f"VolumeUsage: Analyzed {volume} ({len(files)} files, {len(duplicates)} duplicate groups) in {report['duration_sec']}s")
+        return report
+
+    def get(self, volume, profile=None, force=False):
+        """
+        Latest report for a volume, starting a background analysis when there is
+        none yet, the index changed since it was computed, or force is set.
+        Returns { 'status': 'ready'|'running'|'error', 'report'?, 'computed_at'?, 'error'? }.
+        """
+        profile = resolve_profile(profile)
+        key = (profile, volume)
+        state = self.reports.setdefault(key, {'status': 'idle', 'report': None, 'computed_at': None})
+        info = self.index.scan_info(volume, profile)
+        # refreshed_at == 0: marked stale (see VolumeIndex.mark_stale), not yet rescanned
+        outdated = (not state['computed_at'] or not info or info['refreshed_at'] == 0
+                    or info['refreshed_at'] > state['computed_at'])
+
+        if state['status'] != 'running' and (force or outdated):
+            state['status'] = 'running'
+
+            def run():
+                try:
+                    state['report'] = self.analyze(volume, profile)
+                    state['computed_at'] = time.time()
+                    state['status'] = 'ready'
+                    state.pop('error', None)
+                except Exception as e:
+                    print(f"VolumeUsage: Analysis of {volume} failed: {e}")
+                    state['status'] = 'error'
+                    state['error'] = str(e)
+            eventlet.spawn_n(run)
+
+        return dict(state)
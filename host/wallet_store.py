@@ -0,0 +1,420 @@
+import contextlib
+import glob
+import json
+import os
+import sqlite3
+import time
+
+# Wallets (credit balance per Modal account) in one SQLite file in WAL mode.
+#
+# Replaces modal-credit-tracker/wallet_<account>.json, which was read and
+# rewritten whole (ever-growing history included) on every heartbeat and
+# usage sync. Each event now touches only the rows it changes, inside one
+# transaction, so a crash never leaves a half-written wallet and several host
+# processes can update wallets at once.
+#
+#   accounts         balance and timestamps, one row per account
+#   history          usage entries (heartbeat blocks and synced VM sessions)
+#   synced_sessions  VM sessions already charged by a usage sync
+#   signals          last heartbeat per (account, session), for elapsed-time billing
+#   ledger           append-only balance changes (see LEDGER_KINDS) with balance_after
+#   sync_cursors     last usage-file revision applied per (account, volume)
+#   snapshots        balance checkpoints: the opening balance, one every
+#                    SNAPSHOT_EVERY events, and one per compaction
+#
+# The balance column of accounts is only ever changed through the ledger
+# (debit / topup / reset), so reading it is O(1) and balance_at() can rebuild
+# any past balance from the nearest snapshot plus the events after it.
+# compact() folds old events (and finished history) into a snapshot row that
+# keeps their count and totals.
+#
+# Existing JSON wallets are imported once on startup (import_json) and renamed
+# to *.json.imported.
+
+DEFAULT_BALANCE = 80.0
+HISTORY_PREVIEW = 50        # history entries returned by load()
+SIGNAL_TTL = 3600           # heartbeat sessions idle longer than this are forgotten
+SNAPSHOT_EVERY = 500        # ledger events between automatic snapshots of an account
+LEDGER_KINDS = ('heartbeat_debit', 'volume_sync_debit', 'topup', 'reset')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account TEXT PRIMARY KEY,
+    balance REAL NOT NULL,
+    last_signal_time REAL,
+    last_synced_at REAL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    session_id TEXT,
+    source TEXT NOT NULL,
+    status TEXT,
+    gpu_type TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    duration_sec REAL NOT NULL DEFAULT 0,
+    cost REAL NOT NULL DEFAULT 0,
+    final_balance REAL
+);
+CREATE INDEX IF NOT EXISTS idx_history_session ON history (account, session_id, status);
+CREATE TABLE IF NOT EXISTS synced_sessions (
+    account TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (account, session_id)
+);
+CREATE TABLE IF NOT EXISTS signals (
+    account TEXT NOT NULL,
+    session_id TEXT NOT NULL,
+    last_signal REAL NOT NULL,
+    PRIMARY KEY (account, session_id)
+);
+CREATE TABLE IF NOT EXISTS sync_cursors (
+    account TEXT NOT NULL,
+    volume TEXT NOT NULL,
+    epoch TEXT,
+    revision INTEGER NOT NULL,
+    synced_at REAL NOT NULL,
+    PRIMARY KEY (account, volume)
+);
+CREATE TABLE IF NOT EXISTS ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    amount REAL NOT NULL,
+    balance_after REAL NOT NULL,
+    session_id TEXT,
+    history_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_ledger_account ON ledger (account);  -- (account, id): id is the rowid
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    ts REAL NOT NULL,
+    balance REAL NOT NULL,
+    ledger_id INTEGER,
+    events INTEGER NOT NULL DEFAULT 0,
+    debited REAL NOT NULL DEFAULT 0,
+    credited REAL NOT NULL DEFAULT 0,
+    history_entries INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_snapshots_account ON snapshots (account, ts);
+"""
+
+
+def history_to_json(row):
+    """A history row in the shape the JSON wallets used (heartbeat blocks had total_* keys)."""
+    if row['source'] == 'heartbeat':
+        return {
+            'session_id': row['session_id'],
+            'start_time': row['start_time'],
+            'end_time': row['end_time'],
+            'gpu_type': row['gpu_type'],
+            'total_duration_sec': row['duration_sec'],
+            'total_cost': row['cost'],
+            'final_balance': row['final_balance']
+        }
+    return {
+        'session_id': row['session_id'],
+        'gpu_type': row['gpu_type'],
+        'start_time': row['start_time'],
+        'end_time': row['end_time'],
+        'duration_sec': row['duration_sec'],
+        'cost': row['cost'],
+        'source': row['source'],
+        'status': row['status']
+    }
+
+
+class WalletStore:
+    def __init__(self, db_path, default_balance=DEFAULT_BALANCE):
+        self.db_path = db_path
+        self.default_balance = default_balance
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(SCHEMA)
+        # Opening snapshot for accounts created before the ledger existed
+        self.conn.execute('INSERT INTO snapshots (account, ts, balance) '
+                          'SELECT account, updated_at, balance FROM accounts '
+                          'WHERE account NOT IN (SELECT account FROM snapshots)')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE ... COMMIT; takes the write lock up front so read-modify-write is safe across processes."""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.conn
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    # --- ACCOUNTS ---
+
+    def account(self, account):
+        """The account row as a dict, created with the default balance on first use."""
+        row = self.conn.execute('SELECT * FROM accounts WHERE account = ?', (account,)).fetchone()
+        if row:
+            return dict(row)
+        self._open(account, self.default_balance)
+        return dict(self.conn.execute('SELECT * FROM accounts WHERE account = ?', (account,)).fetchone())
+
+    def _open(self, account, balance, **fields):
+        now = time.time()
+        self.conn.execute(
+            'INSERT INTO accounts (account, balance, last_signal_time, last_synced_at, updated_at) VALUES (?, ?, ?, ?, ?)',
+            (account, balance, fields.get('last_signal_time'), fields.get('last_synced_at'), now))
+        self.conn.execute('INSERT INTO snapshots (account, ts, balance) VALUES (?, ?, ?)', (account, now, balance))
+
+    def update_account(self, account, **fields):
+        """Update non-balance fields (e.g. last_synced_at=...) of an existing account."""
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        self.conn.execute(f'UPDATE accounts SET {columns}, updated_at = ? WHERE account = ?',
+                          [*fields.values(), time.time(), account])
+
+    def balance(self, account):
+        return self.account(account)['balance']
+
+    def load(self, account, history_limit=HISTORY_PREVIEW):
+        """Wallet in the legacy JSON shape (most recent history_limit entries), for the UI."""
+        with self.transaction():
+            acc = self.account(account)
+        signals = self.conn.execute('SELECT session_id, last_signal FROM signals WHERE account = ?', (account,))
+        rows = self.conn.execute('SELECT * FROM history WHERE account = ? ORDER BY id DESC LIMIT ?',
+                                 (account, history_limit)).fetchall()
+        return {
+            'account': account,
+            'balance': acc['balance'],
+            'last_signal_time': acc['last_signal_time'],
+            'last_synced_at': acc['last_synced_at'],
+            'sessions': {row['session_id']: row['last_signal'] for row in signals},
+            'history': [history_to_json(row) for row in reversed(rows)]
+        }
+
+    def accounts(self):
+        return [row['account'] for row in self.conn.execute('SELECT account FROM accounts ORDER BY account')]
+
+    # --- LEDGER ---
+
+    def _record(self, account, kind, balance, session_id=None, history_id=None):
+        """Set the balance through a ledger event. Call inside a transaction."""
+        if kind not in LEDGER_KINDS:
+            raise ValueError(f"Unknown ledger kind '{kind}'")
+        before = self.account(account)['balance']
+        now = time.time()
+        self.conn.execute('UPDATE accounts SET balance = ?, updated_at = ? WHERE account = ?', (balance, now, account))
+        event_id = self.conn.execute(
+            'INSERT INTO ledger (account, ts, kind, amount, balance_after, session_id, history_id) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (account, now, kind, balance - before, balance, session_id, history_id)).lastrowid
+
+        last = self._last_snapshot(account)
+        since = self.conn.execute('SELECT COUNT(*) FROM ledger WHERE account = ? AND id > ?',
+                                  (account, (last or {}).get('ledger_id') or 0)).fetchone()[0]
+        if since >= SNAPSHOT_EVERY:
+            self.conn.execute('INSERT INTO snapshots (account, ts, balance, ledger_id) VALUES (?, ?, ?, ?)',
+                              (account, now, balance, event_id))
+        return balance
+
+    def debit(self, account, kind, amount, session_id=None, history_id=None):
+        """Take amount off the balance (never below zero). Returns the new balance."""
+        balance = max(0, self.account(account)['balance'] - amount)
+        return self._record(account, kind, balance, session_id=session_id, history_id=history_id)
+
+    def topup(self, account, amount):
+        return self._record(account, 'topup', self.account(account)['balance'] + amount)
+
+    def reset(self, account, balance=None):
+        return self._record(account, 'reset', self.default_balance if balance is None else balance)
+
+    def ledger(self, account, limit=100, before_id=None):
+        """Newest-first ledger events of an account (before_id pages backwards)."""
+        query = 'SELECT * FROM ledger WHERE account = ?'
+        params = [account]
+        if before_id:
+            query += ' AND id < ?'
+            params.append(before_id)
+        rows = self.conn.execute(query + ' ORDER BY id DESC LIMIT ?', [*params, limit])
+        return [dict(row) for row in rows]
+
+    def snapshots(self, account):
+        return [dict(row) for row in self.conn.execute('SELECT * FROM snapshots WHERE account = ? ORDER BY ts, id',
+                                                       (account,))]
+
+    def _last_snapshot(self, account, at=None):
+        query = 'SELECT * FROM snapshots WHERE account = ?'
+        params = [account]
+        if at is not None:
+            query += ' AND ts <= ?'
+            params.append(at)
+        row = self.conn.execute(query + ' ORDER BY ts DESC, id DESC LIMIT 1', params).fetchone()
+        return dict(row) if row else None
+
+    def balance_at(self, account, ts):
+        """Balance as of ts: the nearest snapshot plus the events after it. None before the account existed."""
+        snapshot = self._last_snapshot(account, at=ts)
+        if snapshot is None:
+            return None
+        delta = self.conn.execute(
+            'SELECT COALESCE(SUM(amount), 0) FROM ledger WHERE account = ? AND id > ? AND ts <= ?',
+            (account, snapshot['ledger_id'] or 0, ts)).fetchone()[0]
+        return snapshot['balance'] + delta
+
+    def compact(self, account, before):
+        """
+        Fold ledger events older than `before` into one snapshot row (count and
+        totals kept), and drop history entries they charged, except running ones.
+        Earlier snapshots stay, so balance_at() in the compacted range falls back
+        to snapshot resolution. Synced session ids are kept so the usage file is
+        never charged twice.
+        Returns the snapshot, or None if there was nothing to compact.
+        """
+        last = self.conn.execute('SELECT * FROM ledger WHERE account = ? AND ts < ? ORDER BY id DESC LIMIT 1',
+                                 (account, before)).fetchone()
+        if not last:
+            return None
+        totals = self.conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(CASE WHEN amount < 0 THEN -amount END), 0), '
+            'COALESCE(SUM(CASE WHEN amount > 0 THEN amount END), 0), MAX(history_id) '
+            'FROM ledger WHERE account = ? AND id <= ?', (account, last['id'])).fetchone()
+        history = self.conn.execute(
+            "DELETE FROM history WHERE account = ? AND id <= ? AND COALESCE(status, '') != 'running' "
+            "AND session_id NOT IN (SELECT session_id FROM signals WHERE account = ?)",
+            (account, totals[3] or 0, account)).rowcount
+        self.conn.execute('DELETE FROM ledger WHERE account = ? AND id <= ?', (account, last['id']))
+        snapshot_id = self.conn.execute(
+            'INSERT INTO snapshots (account, ts, balance, ledger_id, events, debited, credited, history_entries) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (account, last['ts'], last['balance_after'], last['id'], totals[0], totals[1], totals[2], history)).lastrowid
+        return dict(self.conn.execute('SELECT * FROM snapshots WHERE id = ?', (snapshot_id,)).fetchone())
+
+    # --- HISTORY ---
+
+    def add_history(self, account, source, session_id=None, status=None, gpu_type=None, start_time=None,
+                    end_time=None, duration_sec=0, cost=0, final_balance=None):
+        cur = self.conn.execute(
+            'INSERT INTO history (account, session_id, source, status, gpu_type, start_time, end_time, '
+            'duration_sec, cost, final_balance) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (account, session_id, source, status, gpu_type, start_time, end_time, duration_sec, cost, final_balance))
+        return cur.lastrowid
+
+    def update_history(self, entry_id, **fields):
+        columns = ', '.join(f'{name} = ?' for name in fields)
+        self.conn.execute(f'UPDATE history SET {columns} WHERE id = ?', [*fields.values(), entry_id])
+
+    def delete_history(self, entry_id):
+        self.conn.execute('DELETE FROM history WHERE id = ?', (entry_id,))
+
+    def last_entry(self, account, session_id, status=None):
+        """Newest history entry of a session (optionally with a given status), or None."""
+        query = 'SELECT * FROM history WHERE account = ? AND session_id = ?'
+        params = [account, session_id]
+        if status:
+            query += ' AND status = ?'
+            params.append(status)
+        row = self.conn.execute(query + ' ORDER BY id DESC LIMIT 1', params).fetchone()
+        return dict(row) if row else None
+
+    def running_entries(self, account):
+        """{ session_id: { 'id', 'cost' } } of the newest `running` entry per session."""
+        rows = self.conn.execute("SELECT id, session_id, cost FROM history WHERE account = ? AND status = 'running' "
+                                 "ORDER BY id", (account,))
+        return {row['session_id']: {'id': row['id'], 'cost': row['cost']} for row in rows}
+
+    # --- SYNCED SESSIONS ---
+
+    def is_synced(self, account, session_id):
+        return self.conn.execute('SELECT 1 FROM synced_sessions WHERE account = ? AND session_id = ?',
+                                 (account, session_id)).fetchone() is not None
+
+    def synced_among(self, account, session_ids, chunk=500):
+        """The subset of session_ids already synced, as a set (one indexed query per chunk)."""
+        session_ids = list({sid for sid in session_ids if sid is not None})
+        synced = set()
+        for i in range(0, len(session_ids), chunk):
+            part = session_ids[i:i + chunk]
+            rows = self.conn.execute(
+                f"SELECT session_id FROM synced_sessions WHERE account = ? AND session_id IN ({', '.join('?' * len(part))})",
+                [account, *part])
+            synced.update(row['session_id'] for row in rows)
+        return synced
+
+    def mark_synced(self, account, session_id):
+        self.conn.execute('INSERT OR IGNORE INTO synced_sessions (account, session_id, synced_at) VALUES (?, ?, ?)',
+                          (account, session_id, time.time()))
+
+    # --- SYNC CURSORS ---
+
+    def cursor(self, account, volume):
+        """(epoch, revision) of the usage file last applied from volume, or (None, None)."""
+        row = self.conn.execute('SELECT epoch, revision FROM sync_cursors WHERE account = ? AND volume = ?',
+                                (account, volume)).fetchone()
+        return (row['epoch'], row['revision']) if row else (None, None)
+
+    def set_cursor(self, account, volume, epoch, revision):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO sync_cursors (account, volume, epoch, revision, synced_at) VALUES (?, ?, ?, ?, ?)',
+            (account, volume, epoch, revision, time.time()))
+
+    # --- HEARTBEAT SIGNALS ---
+
+    def last_signal(self, account, session_id):
+        row = self.conn.execute('SELECT last_signal FROM signals WHERE account = ? AND session_id = ?',
+                                (account, session_id)).fetchone()
+        return row['last_signal'] if row else None
+
+    def touch_signal(self, account, session_id, now):
+        self.conn.execute('INSERT OR REPLACE INTO signals (account, session_id, last_signal) VALUES (?, ?, ?)',
+                          (account, session_id, now))
+        self.conn.execute('DELETE FROM signals WHERE account = ? AND last_signal < ?', (account, now - SIGNAL_TTL))
+
+    # --- IMPORT ---
+
+    def import_json(self, tracker_dir):
+        """Import wallet_<account>.json files once; each is renamed to *.imported afterwards."""
+        imported = 0
+        for path in sorted(glob.glob(os.path.join(tracker_dir, 'wallet_*.json'))):
+            account = os.path.basename(path)[len('wallet_'):-len('.json')]
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                with self.transaction():
+                    self._import_wallet(data.get('account') or account, data)
+                os.replace(path, path + '.imported')
+                imported += 1
+            except Exception as e:
+                print(f"WalletStore: Failed to import {path}: {e}")
+        if imported:
+            print(f"WalletStore: Imported {imported} JSON wallet(s) from {tracker_dir}")
+        return imported
+
+    def _import_wallet(self, account, data):
+        if self.conn.execute('SELECT 1 FROM accounts WHERE account = ?', (account,)).fetchone():
+            print(f"WalletStore: {account} already in the store; skipping its JSON wallet")
+            return
+        self._open(account, data.get('balance', self.default_balance),
+                   last_signal_time=data.get('last_signal_time'), last_synced_at=data.get('last_synced_at'))
+        for entry in data.get('history', []):
+            heartbeat = 'total_cost' in entry or 'total_duration_sec' in entry
+            self.add_history(
+                account,
+                'heartbeat' if heartbeat else entry.get('source', 'volume_sync'),
+                session_id=entry.get('session_id'),
+                status=entry.get('status'),
+                gpu_type=entry.get('gpu_type'),
+                start_time=entry.get('start_time'),
+                end_time=entry.get('end_time'),
+                duration_sec=entry.get('total_duration_sec' if heartbeat else 'duration_sec') or 0,
+                cost=entry.get('total_cost' if heartbeat else 'cost') or 0,
+                final_balance=entry.get('final_balance'))
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO synced_sessions (account, session_id, synced_at) VALUES (?, ?, ?)',
+            [(account, sid, time.time()) for sid in data.get('synced_sessions', [])])
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO signals (account, session_id, last_signal) VALUES (?, ?, ?)',
+            [(account, sid, ts) for sid, ts in (data.get('sessions') or {}).items()])
@@ -10,7 +10,10 @@ import time
 import struct
 import fcntl
 import termios
-from flask import Flask
+import codecs
+import collections
+import uuid
+from flask import Flask, request
 from flask_socketio import SocketIO, emit
 from dotenv import load_dotenv
 
@@ -21,7 +24,62 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'secret!')
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
 
 # Global state
-sessions = {} # { session_id: { 'process': proc, 'master_fd': fd, 'cwd': cwd } }
+sessions = {} # { session_key: { 'process': proc, 'master_fd': fd, 'cwd': cwd, 'owner': client_id, 'session_id': str, 'subscribers': set(sid) } }
+connections = {} # { sid: { 'client_id': str, 'attached': { session_id: session_key } } }
+
+# Sessions whose owner has been gone this long are closed (seconds)
+ORPHAN_TIMEOUT = int(os.getenv('ORPHAN_TIMEOUT', '3600'))
+
+# Per-session output journal, replayed to hosts after a link drop
+JOURNAL_MAX_BYTES = int(os.getenv('JOURNAL_MAX_BYTES', str(256 * 1024)))
+journal_metrics = {'replayed_chunks': 0, 'replayed_bytes': 0, 'truncated_gaps': 0}
+
+# Exec RPC config
+EXEC_POOL_SIZE = int(os.getenv('EXEC_POOL_SIZE', '4'))            # concurrent exec jobs
+EXEC_DEFAULT_TIMEOUT = float(os.getenv('EXEC_DEFAULT_TIMEOUT', '600'))  # seconds, 0 = none
+EXEC_MAX_OUTPUT = int(os.getenv('EXEC_MAX_OUTPUT', str(1024 * 1024)))  # chars retained per stream
+
+exec_slots = eventlet.semaphore.Semaphore(EXEC_POOL_SIZE)
+exec_jobs = {} # { (sid, request_id): { 'process': proc or None, 'cancelled': bool } }
+
+# --- SESSION OWNERSHIP ---
+# Each connection identifies itself with auth['client_id'] (hosts send their worker id,
+# so a reconnecting host gets its sessions back). Sessions are namespaced per client and
+# their output goes only to the Socket.IO room of that session.
+
+def session_key(client_id, session_id):
+    return f"{client_id}/{session_id}"
+
+def session_room(key):
+    return f"session:{key}"
+
+def current_client():
+    conn = connections.get(request.sid)
+    return conn['client_id'] if conn else request.sid
+
+def resolve_session(session_id):
+    """Find the session a connection means by session_id: its own first, then attached ones."""
+    if not session_id:
+        return None
+    key = session_key(current_client(), session_id)
+    if key in sessions:
+        return key
+    conn = connections.get(request.sid)
+    if conn:
+        key = conn['attached'].get(session_id)
+        if key in sessions:
+            return key
+    return None
+
+def subscribe(sid, key):
+    socketio.server.enter_room(sid, session_room(key), namespace='/')
+    sessions[key]['subscribers'].add(sid)
+    sessions[key]['orphaned_at'] = None
+
+def unsubscribe(sid, key):
+    socketio.server.leave_room(sid, session_room(key), namespace='/')
+    if key in sessions:
+        sessions[key]['subscribers'].discard(sid)
 
 @socketio.on('connect')
 def handle_connect(auth):
@@ -34,21 +92,52 @@ def handle_connect(auth):
         return False # Reject connection
 
     print("Authentication successful")
+    client_id = auth.get('client_id') or request.sid
+    connections[request.sid] = {'client_id': client_id, 'attached': {}}
     emit('output', {'output': f'Connected to Worker Node (Multi-Tab Enabled)\n'})
+
+    # Re-subscribe a returning client to the sessions it owns. Clients that
+    # resume (auth['resume']) subscribe via resume_sessions instead, so replayed
+    # output can't interleave with live output.
+    if not auth.get('resume'):
+        for key, session in sessions.items():
+            if session['owner'] == client_id:
+                subscribe(request.sid, key)
     
     # Auto-create default session 'session-1' if it doesn't exist
-    if 'session-1' not in sessions:
-        print("Initializing default session-1")
-        create_session_internal('session-1')
+    if session_key(client_id, 'session-1') not in sessions:
+        print(f"Initializing default session-1 for {client_id}")
+        create_session_internal(client_id, 'session-1', request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print("Client disconnected")
+    connections.pop(request.sid, None)
+    for key, session in sessions.items():
+        session['subscribers'].discard(request.sid)
+        if not session['subscribers'] and not session.get('orphaned_at'):
+            session['orphaned_at'] = time.time()
 
-def close_session_internal(session_id):
-    if session_id in sessions:
-        session = sessions[session_id]
-        print(f"Closing session {session_id}")
+    # Nobody is left to receive results of this client's exec jobs
+    for (sid, request_id), job in list(exec_jobs.items()):
+        if sid == request.sid:
+            job['cancelled'] = True
+
+def reap_orphaned_sessions():
+    """Close sessions nobody has been subscribed to for ORPHAN_TIMEOUT."""
+    while True:
+        socketio.sleep(60)
+        now = time.time()
+        for key, session in list(sessions.items()):
+            orphaned_at = session.get('orphaned_at')
+            if orphaned_at and now - orphaned_at > ORPHAN_TIMEOUT:
+                print(f"Reaping orphaned session {key}")
+                close_session_internal(key)
+
+def close_session_internal(key):
+    if key in sessions:
+        session = sessions[key]
+        print(f"Closing session {key}")
         
         # Close FD
         if session['master_fd']:
@@ -69,16 +158,23 @@ def close_session_internal(session_id):
                 except:
                     pass
         
-        del sessions[session_id]
-        socketio.emit('session_closed', {'session_id': session_id})
+        del sessions[key]
+        room = session_room(key)
+        socketio.emit('session_closed', {'session_id': session['session_id']}, to=room)
+        socketio.server.close_room(room, namespace='/')
+        for conn in connections.values():
+            if conn['attached'].get(session['session_id']) == key:
+                del conn['attached'][session['session_id']]
 
-def read_output_loop(fd, session_id):
-    """Reads from the PTY master file descriptor and emits to socket."""
-    print(f"Starting read loop for Session: {session_id} (FD: {fd})")
+def read_output_loop(fd, key):
+    """Reads from the PTY master file descriptor and emits to the session's room."""
+    print(f"Starting read loop for Session: {key} (FD: {fd})")
+    session_id = sessions[key]['session_id']
+    room = session_room(key)
     while True:
         try:
             # Check if session still exists
-            if session_id not in sessions:
+            if key not in sessions:
                 break
                 
             # Wait for data to be available
@@ -89,26 +185,31 @@ def read_output_loop(fd, session_id):
                     break
                 # Decode bytes to string
                 output_str = data.decode('utf-8', errors='replace')
-                socketio.emit('term_output', {'session_id': session_id, 'output': output_str})
+                seq = journal_append(sessions[key], output_str)
+                socketio.emit('term_output', {'session_id': session_id, 'output': output_str, 'seq': seq,
+                                              'incarnation': sessions[key]['incarnation']}, to=room)
             
             # Check if process is still alive
-            session = sessions.get(session_id)
+            session = sessions.get(key)
             if session and session['process'].poll() is not None:
                 break
         except OSError:
             break
         except Exception as e:
-            print(f"Read loop error for {session_id}: {e}")
+            print(f"Read loop error for {key}: {e}")
             break
     
-    print(f"Read loop finished for {session_id}")
-    socketio.emit('term_output', {'session_id': session_id, 'output': '\n[Process exited]\n'})
+    print(f"Read loop finished for {key}")
+    socketio.emit('term_output', {'session_id': session_id, 'output': '\n[Process exited]\n'}, to=room)
     # Cleanup session if process exited
-    if session_id in sessions:
-        close_session_internal(session_id)
+    if key in sessions:
+        close_session_internal(key)
 
-def create_session_internal(session_id):
-    if session_id in sessions:
+def create_session_internal(client_id, session_id, sid):
+    key = session_key(client_id, session_id)
+    if key in sessions:
+        subscribe(sid, key)
+        socketio.emit('session_created', {'session_id': session_id, 'incarnation': sessions[key]['incarnation']}, to=sid)
         return # Already exists
         
     try:
@@ -149,7 +250,7 @@ def create_session_internal(session_id):
                 shell_cmd = shell
                 break
         
-        print(f"Starting session {session_id} with shell: {shell_cmd}")
+        print(f"Starting session {key} with shell: {shell_cmd}")
         
         process = subprocess.Popen(
             [shell_cmd],
@@ -163,40 +264,123 @@ def create_session_internal(session_id):
         
         os.close(slave_fd)
         
-        sessions[session_id] = {
+        sessions[key] = {
             'process': process,
             'master_fd': master_fd,
-            'cwd': initial_cwd
+            'cwd': initial_cwd,
+            'owner': client_id,
+            'session_id': session_id,
+            'subscribers': set(),
+            'orphaned_at': None,
+            'seq': 0,
+            'incarnation': uuid.uuid4().hex[:8], # seqs restart when a session id is reused
+            'journal': collections.deque(), # (seq, output)
+            'journal_bytes': 0
         }
+        subscribe(sid, key)
         
-        socketio.start_background_task(target=read_output_loop, fd=master_fd, session_id=session_id)
-        socketio.emit('session_created', {'session_id': session_id})
+        socketio.start_background_task(target=read_output_loop, fd=master_fd, key=key)
+        socketio.emit('session_created', {'session_id': session_id, 'incarnation': sessions[key]['incarnation']},
+                      to=session_room(key))
         
     except Exception as e:
         print(f"Failed to create session: {e}")
-        socketio.emit('output', {'output': f"Error creating session: {e}\n"})
+        socketio.emit('output', {'output': f"Error creating session: {e}\n"}, to=sid)
+
+# --- OUTPUT JOURNAL ---
+
+def journal_append(session, output):
+    """Record an output chunk, trimming the oldest chunks past JOURNAL_MAX_BYTES. Returns its seq."""
+    session['seq'] += 1
+    session['journal'].append((session['seq'], output))
+    session['journal_bytes'] += len(output)
+    while session['journal_bytes'] > JOURNAL_MAX_BYTES and len(session['journal']) > 1:
+        _, dropped = session['journal'].popleft()
+        session['journal_bytes'] -= len(dropped)
+    return session['seq']
+
+@socketio.on('resume_sessions')
+def handle_resume_sessions(data):
+    """
+    Replay output a reconnecting client missed, then subscribe it to live output.
+    data: { 'acks': { session_id: last_seq_received }, 'incarnations': { session_id: incarnation } }
+    An ack for another incarnation of the session id (e.g. before a worker restart) counts as 0.
+    """
+    acks = data.get('acks') or {}
+    incarnations = data.get('incarnations') or {}
+    client_id = current_client()
+    for key, session in sessions.items():
+        if session['owner'] != client_id:
+            continue
+        session_id = session['session_id']
+        ack = acks.get(session_id, 0)
+        if incarnations.get(session_id) != session['incarnation']:
+            ack = 0
+        journal = session['journal']
+
+        if journal and ack < journal[0][0] - 1:
+            journal_metrics['truncated_gaps'] += 1
+            emit('term_output', {'session_id': session_id, 'replay': True,
+                                 'output': '\r\n[... output lost while disconnected ...]\r\n'})
+        for seq, output in journal:
+            if seq > ack:
+                journal_metrics['replayed_chunks'] += 1
+                journal_metrics['replayed_bytes'] += len(output)
+                emit('term_output', {'session_id': session_id, 'output': output, 'seq': seq,
+                                     'incarnation': session['incarnation'], 'replay': True})
+        subscribe(request.sid, key)
 
 @socketio.on('create_session')
 def handle_create_session(data):
     session_id = data.get('session_id')
     print(f"Creating session: {session_id}")
-    create_session_internal(session_id)
+    create_session_internal(current_client(), session_id, request.sid)
+
+@socketio.on('attach_session')
+def handle_attach_session(data):
+    """Subscribe to another client's session (e.g. a debug client watching a host's shell)."""
+    session_id = data.get('session_id')
+    key = session_key(data.get('owner'), session_id)
+    if key not in sessions:
+        emit('output', {'output': f"Error: No session {session_id} owned by {data.get('owner')}\n"})
+        return
+    connections[request.sid]['attached'][session_id] = key
+    subscribe(request.sid, key)
+    emit('session_created', {'session_id': session_id, 'incarnation': sessions[key]['incarnation']})
+
+@socketio.on('list_sessions')
+def handle_list_sessions(data=None):
+    return [{
+        'session_id': s['session_id'],
+        'owner': s['owner'],
+        'subscribers': len(s['subscribers'])
+    } for s in sessions.values()]
 
 @socketio.on('close_session')
 def handle_close_session(data):
-    session_id = data.get('session_id')
-    close_session_internal(session_id)
+    key = resolve_session(data.get('session_id'))
+    if not key:
+        return
+
+    if sessions[key]['owner'] == current_client():
+        close_session_internal(key)
+    else:
+        # Attached clients only detach; the owner's shell keeps running
+        unsubscribe(request.sid, key)
+        connections[request.sid]['attached'].pop(data.get('session_id'), None)
+        emit('session_closed', {'session_id': data.get('session_id')})
 
 @socketio.on('command')
 def handle_command(data):
     session_id = data.get('session_id')
     cmd = data.get('cmd')
+    key = resolve_session(session_id)
     
-    if not session_id or session_id not in sessions:
+    if not key:
         print(f"Invalid session: {session_id}")
         return
 
-    session = sessions[session_id]
+    session = sessions[key]
     master_fd = session['master_fd']
     
     # In PTY mode, we just write input to the master FD
@@ -206,46 +390,46 @@ def handle_command(data):
             input_data = cmd + '\n'
             os.write(master_fd, input_data.encode('utf-8'))
     except Exception as e:
-        print(f"Error writing to session {session_id}: {e}")
+        print(f"Error writing to session {key}: {e}")
 
 @socketio.on('term_input')
 def handle_term_input(data):
-    session_id = data.get('session_id')
     input_data = data.get('input')
+    key = resolve_session(data.get('session_id'))
     
-    if not session_id or session_id not in sessions:
+    if not key:
         return
 
-    session = sessions[session_id]
+    session = sessions[key]
     master_fd = session['master_fd']
     
     try:
         if input_data:
             os.write(master_fd, input_data.encode('utf-8'))
     except Exception as e:
-        print(f"Error writing to session {session_id}: {e}")
+        print(f"Error writing to session {key}: {e}")
 
 @socketio.on('resize')
 def handle_resize(data):
-    session_id = data.get('session_id')
     cols = data.get('cols')
     rows = data.get('rows')
+    key = resolve_session(data.get('session_id'))
     
-    if session_id in sessions:
+    if key:
         try:
-            master_fd = sessions[session_id]['master_fd']
+            master_fd = sessions[key]['master_fd']
             winsize = struct.pack("HHHH", rows, cols, 0, 0)
             fcntl.ioctl(master_fd, termios.TIOCSWINSZ, winsize)
         except Exception as e:
-            print(f"Error resizing session {session_id}: {e}")
+            print(f"Error resizing session {key}: {e}")
 
 @socketio.on('send_signal')
 def handle_signal(data):
-    session_id = data.get('session_id')
     sig_type = data.get('signal', 'SIGINT')
+    key = resolve_session(data.get('session_id'))
     
-    if session_id in sessions:
-        session = sessions[session_id]
+    if key:
+        session = sessions[key]
         proc = session['process']
         if proc.poll() is None:
             try:
@@ -258,5 +442,181 @@ def handle_signal(data):
             except Exception as e:
                 print(f"Error sending signal: {e}")
 
+# --- LOAD STATS ---
+# Sampled from /proc so hosts can place new sessions on the least loaded worker.
+
+STATS_INTERVAL = 5 # seconds between CPU samples
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+worker_stats = {'cpu_percent': 0.0, 'rss_mb': 0.0}
+_last_cpu_sample = {'ticks': 0, 'time': None}
+
+def sample_session_usage():
+    """Total CPU ticks and RSS bytes of every process in our PTY sessions (plus the worker)."""
+    session_ids = {s['process'].pid for s in sessions.values()}
+    own_pid = os.getpid()
+    ticks = rss = 0
+    try:
+        pids = [p for p in os.listdir('/proc') if p.isdigit()]
+    except OSError:
+        return 0, 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                # Fields after the ")" that closes the command name
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        # fields[3] = session id, [11]/[12] = utime/stime, [21] = rss pages
+        if int(pid) == own_pid or int(fields[3]) in session_ids:
+            ticks += int(fields[11]) + int(fields[12])
+            rss += int(fields[21]) * PAGE_SIZE
+    return ticks, rss
+
+def stats_sampler_loop():
+    while True:
+        ticks, rss = sample_session_usage()
+        now = time.time()
+        if _last_cpu_sample['time'] is not None:
+            elapsed = now - _last_cpu_sample['time']
+            used = (ticks - _last_cpu_sample['ticks']) / CLOCK_TICKS
+            worker_stats['cpu_percent'] = round(max(used, 0) / elapsed * 100, 1) if elapsed > 0 else 0.0
+        _last_cpu_sample.update({'ticks': ticks, 'time': now})
+        worker_stats['rss_mb'] = round(rss / (1024 * 1024), 1)
+        socketio.sleep(STATS_INTERVAL)
+
+@socketio.on('get_stats')
+def handle_get_stats(data=None):
+    """Returned through the Socket.IO ack, so callers can time the round trip."""
+    return {
+        'sessions': len(sessions),
+        'cpu_percent': worker_stats['cpu_percent'],
+        'rss_mb': worker_stats['rss_mb'],
+        'cpu_count': os.cpu_count() or 1,
+        'load_avg': os.getloadavg()[0] if hasattr(os, 'getloadavg') else 0.0,
+        'exec_jobs': len(exec_jobs),
+        'journal_bytes': sum(s['journal_bytes'] for s in sessions.values()),
+        'journal_entries': sum(len(s['journal']) for s in sessions.values()),
+        **journal_metrics
+    }
+
+# --- EXEC RPC ---
+
+def kill_exec_process(proc):
+    """Terminate an exec job's whole process group (shell=True spawns children)."""
+    if proc.poll() is not None:
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=2)
+    except Exception:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except Exception:
+            pass
+
+def release_exec_job(sid, request_id, job):
+    if exec_jobs.get((sid, request_id)) is job:
+        del exec_jobs[(sid, request_id)]
+
+def run_exec_job(job, request_id, command, cwd, timeout, sid, profile=None):
+    """Runs one exec job, streaming output as exec_chunk and finishing with exec_result."""
+    result = {'id': request_id, 'stdout': '', 'stderr': '', 'returncode': -1}
+
+    with exec_slots:
+        if job['cancelled']:
+            result.update({'stderr': 'Cancelled', 'cancelled': True})
+            socketio.emit('exec_result', result, to=sid)
+            release_exec_job(sid, request_id, job)
+            return
+
+        try:
+            cwd = os.path.expanduser(cwd if cwd else os.getcwd())
+            proc = subprocess.Popen(
+                command,
+                shell=True,
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                start_new_session=True,
+                # An explicit Modal profile applies to this command only, never the active one
+                env={**os.environ, 'TERM': 'xterm', **({'MODAL_PROFILE': profile} if profile else {})}
+            )
+            job['process'] = proc
+
+            streams = {proc.stdout.fileno(): 'stdout', proc.stderr.fileno(): 'stderr'}
+            decoders = {name: codecs.getincrementaldecoder('utf-8')(errors='replace') for name in streams.values()}
+            truncated = False
+            deadline = time.time() + timeout if timeout else None
+
+            while streams:
+                if job['cancelled']:
+                    kill_exec_process(proc)
+                    result['cancelled'] = True
+                    break
+                if deadline and time.time() > deadline:
+                    kill_exec_process(proc)
+                    result['timed_out'] = True
+                    break
+
+                r, w, e = select.select(list(streams), [], [], 0.1)
+                for fd in r:
+                    name = streams[fd]
+                    data = os.read(fd, 4096)
+                    if not data:
+                        del streams[fd]
+                        continue
+                    text = decoders[name].decode(data)
+                    socketio.emit('exec_chunk', {'id': request_id, 'stream': name, 'data': text}, to=sid)
+
+                    room = EXEC_MAX_OUTPUT - len(result[name])
+                    if len(text) > room:
+                        truncated = True
+                    result[name] += text[:max(room, 0)]
+
+            proc.stdout.close()
+            proc.stderr.close()
+            proc.wait()
+            if result.get('timed_out'):
+                result['returncode'] = 124 # Same code as coreutils `timeout`
+            elif result.get('cancelled'):
+                result['returncode'] = 130
+            else:
+                result['returncode'] = proc.returncode
+            if truncated:
+                result['truncated'] = True
+        except Exception as e:
+            result.update({'error': str(e), 'returncode': -1})
+        finally:
+            release_exec_job(sid, request_id, job)
+
+    socketio.emit('exec_result', result, to=sid)
+
+@socketio.on('exec_command')
+def handle_exec_command(data):
+    request_id = data.get('id')
+    command = data.get('command')
+    if not command:
+        emit('exec_result', {'id': request_id, 'stdout': '', 'stderr': 'No command provided', 'returncode': -1})
+        return
+
+    timeout = data.get('timeout', EXEC_DEFAULT_TIMEOUT)
+    print(f"Exec [{request_id}]: {command}")
+    job = {'process': None, 'cancelled': False}
+    exec_jobs[(request.sid, request_id)] = job
+    socketio.start_background_task(run_exec_job, job, request_id, command, data.get('cwd'), timeout, request.sid,
+                                   data.get('profile'))
+
+@socketio.on('cancel_exec')
+def handle_cancel_exec(data):
+    job = exec_jobs.get((request.sid, data.get('id')))
+    if job:
+        print(f"Cancelling exec {data.get('id')}")
+        job['cancelled'] = True
+
 if __name__ == '__main__':
+    socketio.start_background_task(reap_orphaned_sessions)
+    socketio.start_background_task(stats_sampler_loop)
     socketio.run(app, host='0.0.0.0', port=5001, debug=True, allow_unsafe_werkzeug=True)